@@ -2,4 +2,20 @@ __version__ = "0.0.8"
 
 from . import schema
 
-from ._aiide import Aiide, Tool
\ No newline at end of file
+# Aiide pulls in the chat machinery, it is imported on first access so that `import aiide` and
+# `aiide.schema` stay cheap; litellm, pandas and PIL are only imported once they are used
+_LAZY = {"Aiide": "._aiide", "Tool": "._aiide", "CompletionCache": "._completion_cache", "SessionManager": "._session", "Transport": "._transport", "RateLimiter": "._rate_limit", "image_cache": "._utils"}
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        import importlib
+
+        value = getattr(importlib.import_module(_LAZY[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY))
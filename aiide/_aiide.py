@@ -1,17 +1,42 @@
-import copy
+import asyncio
+import concurrent.futures
+import contextlib
+import inspect
 import json
 import os
-from openai import OpenAI, NotGiven
-from ._utils import find_inner_classes, create_messages_dataframe, CustomConverter, parse_json
+import threading
+import weakref
+from typing import TYPE_CHECKING, Iterable
+from ._utils import history_messages, openai_messages_to_rows
+from ._store import MessageStore, StreamingText, parse_commit_policy
+from ._partial_json import PartialJSONParser
+from ._loop import background_loop
+from ._usage import UsageLedger
+from ._context import parse_context_window
+from ._completion_cache import CompletionCache, parse_completion_cache
+from ._transport import Transport, parse_transport
+from ._routing import parse_routing
+from ._stream_policy import parse_stream_policy
+from ._rate_limit import RateLimiter, asettled, parse_priority, parse_rate_limiter, settled
+from ._prompt_cache import apply_prompt_cache, parse_prompt_cache, uses_cache_control
 import warnings
-from litellm import completion as litellm_completion
-from litellm import stream_chunk_builder as litellm_stream_chunk_builder
-from litellm.cost_calculator import cost_per_token as litellm_cost_per_token
-import litellm
 import abc
-import pandas as pd
-from jiter import from_json
-litellm.drop_params = True
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+# litellm takes seconds to import, so it is only imported by the first LLM call
+def litellm_completion(**kwargs):
+    from litellm import completion
+
+    return completion(**kwargs)
+
+
+async def litellm_acompletion(**kwargs):
+    from litellm import acompletion
+
+    return await acompletion(**kwargs)
 
 
 class Tool(abc.ABC):
@@ -19,6 +44,14 @@ class Tool(abc.ABC):
     This is a base class for tools in the AIIDE module.
     """
 
+    # maximum number of calls of this tool running at once when the agent runs tool calls concurrently, None for no limit
+    max_concurrency: int | None = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # main may be a coroutine function, checked once per tool class instead of on every call
+        cls._async_main = inspect.iscoroutinefunction(cls.main)
+
     @abc.abstractmethod
     def __init__(self, parent):
         """
@@ -30,17 +63,35 @@ class Tool(abc.ABC):
         """
         pass
 
+    # set to True for tools whose definition depends on runtime state, tool_def is then called on every LLM call
+    dynamic: bool = False
+
     @abc.abstractmethod
     def tool_def(self):
         """
-        This method is called every time an LLM call is made.
+        Returns the tool definition. It is called once and cached on the tool instance, unless the tool is `dynamic` or `invalidate` is called.
         """
         return {}
 
+    def invalidate(self):
+        """
+        Drops the cached tool definition, tool_def is called again on the next LLM call.
+        """
+        self.__dict__.pop("_tool_def_cache", None)
+
+    def _definition(self) -> dict:
+        if self.dynamic:
+            return self.tool_def()
+        try:
+            return self.__dict__["_tool_def_cache"]
+        except KeyError:
+            definition = self.__dict__["_tool_def_cache"] = self.tool_def()
+            return definition
+
     @abc.abstractmethod
     def main(self):
         """
-        The main method of the TOOL class.
+        The main method of the TOOL class. Can also be defined with `async def`, it is then awaited in `achat` and run on a background event loop in `chat`.
         """
         return str("")
 
@@ -52,42 +103,165 @@ class Aiide:
     def setup(
         self,
         system_message: str | None = None,
-        model: str = "gpt-4o-mini-2024-07-18",
+        model: "str | list[str]" = "gpt-4o-mini-2024-07-18",
         temperature: float = 1.0,
         api_key: str | None = None,
-        history_openai_format: list | None = None,
+        history_openai_format: "Iterable[dict] | str | None" = None,
+        stream_commit: str | dict = "chunk",
+        tool_concurrency: int = 1,
+        eager_tools: bool = False,
+        context_window: dict | None = None,
+        prompt_cache: bool | str = False,
+        completion_cache: "str | CompletionCache | None" = None,
+        transport: "bool | Transport | None" = None,
+        rate_limiter: "RateLimiter | None" = None,
+        priority: str = "interactive",
+        stream_policy: dict | None = None,
+        routing: dict | None = None,
         **kwargs
     ):
         """
         Setup the AIIDE instance.
         Takes the following arguments:
         - system_message: The system message for the LLM.
-        - model: The model to use for the conversation.
+        - model: The model to use for the conversation, or a list of equivalent models (e.g. the same model on several providers) to route the calls between. An entry of the list is a model name or a dict with the "model", an optional "name" and LiteLLM arguments such as "api_key" and "api_base" used for its calls instead of the agent's. Each call goes to the healthy model with the fastest recent streams and falls back to the next one when it fails before streaming.
         - temperature: The temperature to use for the conversation.
         - api_key: The API key to use for the conversation.
-        - history_openai_format: The history of the conversation in OpenAI format. Useful got migrating from OpenAI to AIIDE.
+        - history_openai_format: The history of the conversation in OpenAI format. Useful got migrating from OpenAI to AIIDE. A list, any iterable of messages, or the path of a JSONL file with one message per line. Images are decoded only when they are used.
+        - stream_commit: How often streamed text is written to self.messages. "chunk" (default) on every chunk, "finish" once the response is complete, {"chars": n} every n characters or {"ms": n} at most every n milliseconds.
+        - tool_concurrency: How many tool calls of a turn run at once. 1 (default) runs them one after another, with a higher value they run in a thread pool and tool responses are yielded as they complete. Set `max_concurrency` on a Tool to limit that tool further.
+        - eager_tools: If True, each tool call starts in the background as soon as its arguments have finished streaming, overlapping the rest of the response. Tool responses are still yielded and stored in call order.
+        - context_window: Keeps the prompt within a token budget, {"max_prompt_tokens": n, "completion_reserve": n, "pinned_roles": ["system"]}. Messages with a pinned role are always sent, the oldest of the others are left out of the request when they don't fit, but stay in self.messages. Tool calls are never separated from their tool responses. None (default) sends the whole history.
+        - prompt_cache: Keeps the start of every request byte-identical (tool definitions ordered by name) so the provider can serve it from its prompt cache. True or "auto" also adds cache_control breakpoints to the tools, the system message and the last message for Claude models, "cache_control" adds them for any model. Cached tokens are counted in self.usage. False (default) sends the request as is.
+        - completion_cache: A path to a SQLite file, or a CompletionCache, where streamed completions are stored and replayed from when the same request is made again. None (default) always calls the LLM.
+        - transport: True to send requests through the pooled HTTP clients shared by all agents in the process, or a Transport with its own connection limits. Connections are kept alive between calls instead of being set up again. None (default) leaves the connections to LiteLLM.
+        - rate_limiter: A RateLimiter shared by the agents of the process. Every LLM call waits until it fits in the requests and tokens per minute quotas of its model. None (default) calls the LLM right away.
+        - priority: The priority class of this agent's calls in the rate limiter, "interactive" (default) or "batch". Batch calls wait until no interactive call is queued.
+        - stream_policy: Timeouts, retries and hedging of the streamed LLM calls, {"first_chunk_timeout": s, "chunk_timeout": s, "retries": 2, "retry_backoff": 0.5, "hedge_percentile": p, "hedge_delay": 2.0, "hedge_min_samples": 20}. Calls that fail or don't stream within first_chunk_timeout are retried, with hedge_percentile a duplicate call is made when the first chunk is later than that percentile of recent calls and the first to stream is used. A gap longer than chunk_timeout raises a TimeoutError. None (default) waits on the LLM for as long as it takes.
+        - routing: How calls are routed when model is a list, {"alpha": 0.3, "error_threshold": 0.5, "cooldown": 30, "explore": 0.05}. alpha weighs the latest call in the moving averages of time to first chunk, tokens per second and error rate, a model whose error rate reaches error_threshold is skipped for cooldown seconds, and explore is the chance of trying another healthy model.
         - kwargs: Additional arguments that are compatible with the LiteLLM API.
         """
         self._api_key = api_key
         self._setup = True
-        self._model = model
+        self._router = parse_routing(model, routing)
+        # the first model is the one requests are built, counted and cached for
+        self._model = model if self._router is None else self._router.routes[self._router.models[0]]["model"]
         self._temperature = temperature
-        self.messages: pd.DataFrame = create_messages_dataframe(history_openai_format)
-        
+        parse_commit_policy(stream_commit)
+        self._stream_commit = stream_commit
+        if not isinstance(tool_concurrency, int) or tool_concurrency < 1:
+            raise ValueError(f"Invalid tool_concurrency {tool_concurrency!r}, expected a positive integer")
+        self._tool_concurrency = tool_concurrency
+        # per tool semaphores enforcing Tool.max_concurrency
+        self._tool_limits = weakref.WeakKeyDictionary()
+        self._tool_limits_lock = threading.Lock()
+        self._eager_tools = eager_tools
+        self._context_window = parse_context_window(context_window)
+        self._prompt_cache = parse_prompt_cache(prompt_cache)
+        self._completion_cache = parse_completion_cache(completion_cache)
+        self._transport = parse_transport(transport)
+        self._rate_limiter = parse_rate_limiter(rate_limiter)
+        parse_priority(priority)
+        self._priority = priority
+        # agents take turns in the rate limiter's queues, copies made by batch() share their parent's turn
+        self._rate_limit_session = object()
+        self._stream_policy = parse_stream_policy(stream_policy)
+        # source of truth for self.messages, also keeps the OpenAI format up to date incrementally
+        self._store = MessageStore(openai_messages_to_rows(history_messages(history_openai_format)))
+
         self.usage = {
             "prompt_tokens": 0.0,
             "completion_tokens": 0.0,
+            "cache_read_tokens": 0.0,
+            "cache_write_tokens": 0.0,
             "usd": 0.0,
         }
+        # per call usage, adding up to self.usage
+        self.usage_ledger = UsageLedger(self.usage)
         if system_message:
-            self.messages.loc[len(self.messages)] = { # type: ignore
-                "role": "system",
-                "content": system_message,
-                "arguments": None,
-                "response": None,
-            }
+            self._store.append("system", system_message)
         self._kwargs = kwargs
 
+    @property
+    def messages(self) -> "pd.DataFrame":
+        """
+        The chat history as a DataFrame with role, content, arguments and response columns.
+        The DataFrame is rebuilt only after new messages are written and edits made to it are synced back into the conversation.
+        Assign a new DataFrame to replace the history.
+        """
+        return self._store.dataframe()
+
+    @messages.setter
+    def messages(self, df_messages: "pd.DataFrame"):
+        if not hasattr(self, "_store"):
+            self._store = MessageStore()
+        self._store.load_dataframe(df_messages)
+
+    def batch(
+        self,
+        inputs,
+        tools: list | None = None,
+        stop_words: list | None = None,
+        tool_choice: str = "auto",
+        json_mode: bool = False,
+        concurrency: int = 8,
+        retries: int = 2,
+        retry_backoff: float = 1.0,
+        results_path: str | None = None,
+    ):
+        """
+        Runs `chat` over many inputs at once and yields a result dict for each input as it finishes.
+
+        Each input is a user message, or a dict with "user_message", "history" (messages in OpenAI format) and "id" keys.
+        Every input runs on its own copy of this instance, starting from its current messages followed by the input's
+        history, so inputs don't see each other's messages. Tools are shared and may be called from several threads.
+        - concurrency: How many inputs run at once.
+        - retries: How many times an input is retried after a transient error (rate limits, timeouts, connection and server errors).
+        - retry_backoff: Seconds of the first retry's backoff, doubled for every further retry and jittered.
+        - results_path: A JSONL file the results are appended to. Inputs whose id already has a successful result in it are skipped, so an interrupted run can be resumed. Ids default to the position of the input.
+
+        Results have the keys id, ok, content (the final assistant message), error, attempts, usage and calls (the usage of
+        the input, also added to self.usage) and messages (the input's conversation in OpenAI format).
+        """
+        from ._batch import run_batch
+
+        return run_batch(
+            self,
+            inputs,
+            concurrency=concurrency,
+            retries=retries,
+            retry_backoff=retry_backoff,
+            results_path=results_path,
+            tools=tools,
+            stop_words=stop_words,
+            tool_choice=tool_choice,
+            json_mode=json_mode,
+        )
+
+    def model_stats(self) -> dict:
+        """
+        When `model` is a list, the moving averages of time to first chunk, tokens per second and error rate of each model, and whether it is healthy.
+        """
+        return self._router.stats() if self._router is not None else {}
+
+    def save_session(self, path: str):
+        """
+        Saves the conversation to a Parquet file (or an Arrow IPC file for paths ending with .arrow or .feather):
+        the messages with images as their encoded bytes, the usage and the setup parameters. The API key is not saved.
+        """
+        from ._session import save_session
+
+        save_session(self, path)
+
+    def load_session(self, path: str):
+        """
+        Restores a conversation saved with `save_session`, replacing the messages, usage and setup parameters of this instance.
+        The API key and any setup arguments that couldn't be saved are kept. Images are only decoded when they are used.
+        """
+        from ._session import load_session
+
+        load_session(self, path)
+
     def structured_outputs(self):
         """
         Structured Outputs is a feature that ensures the model will always generate responses in a specific format. Return JSON Schema definition for the generation.
@@ -136,207 +310,499 @@ class Aiide:
                     "response":""
                 }
         """
-        if json_mode:
-            response_format = {"type": "json_schema"}
-        else:
-            response_format = None
+        self._begin_chat(user_message, completion)
+        tool_mapping = self._tool_mapping(tools)
+        while True:
+            request, structured = self._build_request(tools, tool_choice, json_mode, stop_words)
+            eager = _EagerToolCalls(self, tool_mapping) if self._eager_tools and tool_mapping else None
+            stream = _ChatStream(self, structured, eager)
+            try:
+                for response_chunk in self._completion(request, stream):
+                    event = stream.feed(response_chunk)
+                    if event is not None:
+                        yield event
+            finally:
+                # keeping the text streamed so far also when the caller stops early or the stream fails
+                stream.flush()
+            # the usage chunk is streamed after the finish reason, so the turn is handled once the stream is done
+            self._record_usage(stream, request)
+            # print("finish_reason", finish_reason)
+            if stream.finish_reason == "tool_calls":  # type: ignore
+                # calling functions
+                yield from self._run_tool_calls(stream, tool_mapping, eager)
+                if self._forced_tool_choice(request):
+                    # If a tool has been forcefully called for more than 100 times, we exit after the final tool execution to avoid usage blowup
+                        # warnings.warn("Tools have been called 100 times consecutively. If this is the expected behaviour, please raise an issue on our GitHub Repository!")
+                    return
+            elif stream.finish_reason == "length":  # type: ignore
+                warnings.warn("Output token limit reached. Continuing the generation.")
+            elif stream.finish_reason:
+                return
+
+    async def achat(
+        self,
+        user_message: str | list | dict | None = None,
+        completion: str | None = None,
+        tools: list | None = None,
+        stop_words: list | None = None,
+        tool_choice: str = "auto",
+        json_mode: bool = False,
+    ):
+        """
+        Asynchronous version of `chat`. Takes the same arguments and yields the same deltas from an async generator:
+
+            async for delta in agent.achat("What's the weather like in SF?", tools=[agent.weatherTool]):
+                ...
+
+        The completion is streamed with litellm.acompletion so a single event loop can drive many conversations at once.
+        """
+        self._begin_chat(user_message, completion)
+        tool_mapping = self._tool_mapping(tools)
+        while True:
+            request, structured = self._build_request(tools, tool_choice, json_mode, stop_words)
+            eager = _EagerToolCalls(self, tool_mapping, asynchronous=True) if self._eager_tools and tool_mapping else None
+            stream = _ChatStream(self, structured, eager)
+            try:
+                async for response_chunk in await self._acompletion(request, stream):
+                    event = stream.feed(response_chunk)
+                    if event is not None:
+                        yield event
+            finally:
+                stream.flush()
+            self._record_usage(stream, request)
+            if stream.finish_reason == "tool_calls":
+                async for event in self._arun_tool_calls(stream, tool_mapping, eager):
+                    yield event
+                if self._forced_tool_choice(request):
+                    return
+            elif stream.finish_reason == "length":
+                warnings.warn("Output token limit reached. Continuing the generation.")
+            elif stream.finish_reason:
+                return
+
+    def _completion(self, request, stream):
+        """
+        Streams the completion for the request, replaying it from the completion cache if it is there.
+        """
+        cache = self._completion_cache
+        if cache is None:
+            return self._call_llm(request, stream)
+        key = cache.key(request)
+        records = cache.get(key)
+        if records is not None:
+            stream.cached = True
+            return cache.replay(records)
+        return cache.record(key, self._call_llm(request, stream))
+
+    async def _acompletion(self, request, stream):
+        cache = self._completion_cache
+        if cache is None:
+            return await self._acall_llm(request, stream)
+        key = cache.key(request)
+        # the SQLite lookup runs in a thread, the event loop keeps serving the other sessions
+        records = await asyncio.to_thread(cache.get, key)
+        if records is not None:
+            stream.cached = True
+            return cache.areplay(records)
+        return cache.arecord(key, await self._acall_llm(request, stream))
+
+    def _call_llm(self, request, stream):
+        if self._router is not None:
+            return self._router.stream(request, self._call_model, stream)
+        return self._call_model(request)
+
+    async def _acall_llm(self, request, stream):
+        if self._router is not None:
+            return self._router.astream(request, self._acall_model, stream)
+        return await self._acall_model(request)
+
+    def _call_model(self, request):
+        policy = self._stream_policy
+        if policy is not None:
+            return policy.stream(request["model"], lambda: self._acquire(request), lambda grant: self._send(request, grant))
+        return self._send(request, self._acquire(request))
+
+    async def _acall_model(self, request):
+        policy = self._stream_policy
+        if policy is not None:
+            return policy.astream(request["model"], lambda: self._aacquire(request), lambda grant: self._asend(request, grant))
+        return await self._asend(request, await self._aacquire(request))
+
+    def _acquire(self, request):
+        limiter = self._rate_limiter
+        return limiter.acquire(request, self._rate_limit_session, self._priority) if limiter is not None else None
+
+    async def _aacquire(self, request):
+        limiter = self._rate_limiter
+        return await limiter.aacquire(request, self._rate_limit_session, self._priority) if limiter is not None else None
+
+    def _send(self, request, grant):
+        if grant is None:
+            return litellm_completion(**self._with_transport(request))
+        try:
+            response = litellm_completion(**self._with_transport(request))
+        except BaseException as e:
+            grant.settle(error=e)
+            raise
+        return settled(grant, response)
+
+    async def _asend(self, request, grant):
+        if grant is None:
+            return await litellm_acompletion(**self._with_transport(request, asynchronous=True))
+        try:
+            response = await litellm_acompletion(**self._with_transport(request, asynchronous=True))
+        except BaseException as e:
+            grant.settle(error=e)
+            raise
+        return asettled(grant, response)
+
+    def _with_transport(self, request, asynchronous=False):
+        # the pooled client is passed per call, unless one was given in the setup kwargs
+        if self._transport is None or "client" in request:
+            return request
+        client = self._transport.request_client(request, asynchronous)
+        return request if client is None else {**request, "client": client}
+
+    def _begin_chat(self, user_message, completion):
         if not hasattr(self, "_setup"):
             raise Exception("Please call self.setup() in __init__")
-        # self.setup()
+        if user_message:
+            self._store.append("user", user_message)
         if completion:
-            if user_message:
-                self.messages = pd.concat([
-                    self.messages,
-                    pd.DataFrame({
-                        "role": ["user", "assistant"],
-                        "content": [user_message, completion],
-                        "arguments": [None, None],
-                        "response": [None, None],
-                    })
-                ])
+            self._store.append("assistant", completion)
+
+    @staticmethod
+    def _tool_mapping(tools) -> dict:
+        """
+        Returns the tool name to instance mapping, built once per chat call.
+        """
+        return {each_tool_instance._definition()["function"]["name"]: each_tool_instance for each_tool_instance in tools or ()}
+
+    def _build_request(self, tools, tool_choice, json_mode, stop_words):
+        """
+        Returns the completion arguments for the next call and whether structured outputs are used.
+        """
+        # getting tools
+        __tool_definations = None
+        if tools and len(tools) > 0:
+            __tool_definations = [each_tool_instance._definition() for each_tool_instance in tools]
+        else:
+            tool_choice = None  # type: ignore
+        # structured outputs schema is resolved once per turn
+        structured = False
+        response_format = None
+        if json_mode:
+            response_format = {"type": "json_schema"}
+            # calling structured_output function
+            schema = self.structured_outputs()
+            if schema != {}:
+                structured = True
+                response_format["json_schema"] = schema  # type: ignore
+                # response_format["strict"] = True
+        messages = self._store.to_openai_dict()
+        if self._context_window is not None:
+            messages = self._context_window.apply(messages, self._model)
+        request = dict(
+            model=self._model,
+            messages=messages,
+            tools=__tool_definations,
+            tool_choice=tool_choice,  # auto is default, but we'll be explicit
+            stream=True,
+            temperature=self._temperature,
+            stop=stop_words,
+            response_format=response_format,
+            api_key=self._api_key,
+            # adding kwargs
+            **self._kwargs,
+            # max_tokens=4096,
+            # parallel_tool_calls=True,
+        )
+        # the provider reports the usage of the call in the last chunk
+        request.setdefault("stream_options", {"include_usage": True})
+        # parameters a provider doesn't support are dropped instead of failing the call
+        request.setdefault("drop_params", True)
+        if self._prompt_cache is not None:
+            apply_prompt_cache(request, uses_cache_control(self._prompt_cache, self._model))
+        return request, structured
+
+    @staticmethod
+    def _forced_tool_choice(request):
+        return type(request["tool_choice"]) == dict or request["tool_choice"] == "required"
+
+    def _run_tool_calls(self, stream, tool_mapping, eager=None):
+        """
+        Adds the tool calls of a turn to the messages, runs them and yields the tool_call and tool_response deltas.
+        """
+        if eager is not None:
+            # merging the tool calls started while streaming in call order
+            for tool_index, each_func_call in enumerate(stream.tool_calls):
+                tool_row = stream.add_tool_call(each_func_call)
+                yield stream.tool_call_event(tool_index)
+                function_response = eager.result(tool_index, each_func_call)
+                self._store.set(tool_row, "response", function_response)
+                yield stream.tool_response_event(tool_index, function_response)
+            return
+        if self._tool_concurrency == 1 or len(stream.tool_calls) == 1:
+            for tool_index, each_func_call in enumerate(stream.tool_calls):
+                tool_row = stream.add_tool_call(each_func_call)
+                yield stream.tool_call_event(tool_index)
+                function_response = self._call_tool(tool_mapping, each_func_call)
+                # adding the response to the tool call row
+                self._store.set(tool_row, "response", function_response)
+                yield stream.tool_response_event(tool_index, function_response)
+            return
+        # the rows keep the model's tool call order, responses are filled in as the calls complete
+        tool_rows = []
+        for tool_index, each_func_call in enumerate(stream.tool_calls):
+            tool_rows.append(stream.add_tool_call(each_func_call))
+            yield stream.tool_call_event(tool_index)
+        # async tools run on the background loop, sync tools in its thread pool
+        limit = asyncio.Semaphore(self._tool_concurrency)
+        futures = {
+            background_loop.submit(self._acall_tool_limited(limit, tool_mapping, each_func_call)): tool_index
+            for tool_index, each_func_call in enumerate(stream.tool_calls)
+        }
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                tool_index = futures[future]
+                function_response = future.result()
+                self._store.set(tool_rows[tool_index], "response", function_response)
+                yield stream.tool_response_event(tool_index, function_response)
+        finally:
+            # tools already started finish even when the caller stops early
+            concurrent.futures.wait(futures)
+
+    async def _arun_tool_calls(self, stream, tool_mapping, eager=None):
+        """
+        Asynchronous version of `_run_tool_calls`, async tools are awaited on the caller's event loop.
+        """
+        if eager is not None:
+            for tool_index, each_func_call in enumerate(stream.tool_calls):
+                tool_row = stream.add_tool_call(each_func_call)
+                yield stream.tool_call_event(tool_index)
+                function_response = await eager.aresult(tool_index, each_func_call)
+                self._store.set(tool_row, "response", function_response)
+                yield stream.tool_response_event(tool_index, function_response)
+            return
+        if self._tool_concurrency == 1 or len(stream.tool_calls) == 1:
+            for tool_index, each_func_call in enumerate(stream.tool_calls):
+                tool_row = stream.add_tool_call(each_func_call)
+                yield stream.tool_call_event(tool_index)
+                function_response = await self._acall_tool_limited(None, tool_mapping, each_func_call)
+                self._store.set(tool_row, "response", function_response)
+                yield stream.tool_response_event(tool_index, function_response)
+            return
+        tool_rows = []
+        for tool_index, each_func_call in enumerate(stream.tool_calls):
+            tool_rows.append(stream.add_tool_call(each_func_call))
+            yield stream.tool_call_event(tool_index)
+        limit = asyncio.Semaphore(self._tool_concurrency)
+
+        async def run(tool_index, each_func_call):
+            return tool_index, await self._acall_tool_limited(limit, tool_mapping, each_func_call)
+
+        for next_done in asyncio.as_completed([run(*each) for each in enumerate(stream.tool_calls)]):
+            tool_index, function_response = await next_done
+            self._store.set(tool_rows[tool_index], "response", function_response)
+            yield stream.tool_response_event(tool_index, function_response)
+
+    async def _acall_tool_limited(self, limit, tool_mapping, each_func_call):
+        # limit is the turn's tool_concurrency semaphore, None when the tools are called one after another
+        tool = tool_mapping[each_func_call["name"]]
+        async with limit or contextlib.nullcontext():
+            if tool.max_concurrency is None:
+                return await self._acall_tool(tool_mapping, each_func_call)
+            async with self._tool_limit(each_func_call["name"], tool.max_concurrency):
+                return await self._acall_tool(tool_mapping, each_func_call)
+
+    def _tool_limit(self, name, max_concurrency) -> asyncio.Semaphore:
+        # asyncio semaphores can't be shared between loops, so there is one per tool and loop
+        with self._tool_limits_lock:
+            limits = self._tool_limits.setdefault(asyncio.get_running_loop(), {})
+            if name not in limits:
+                limits[name] = asyncio.Semaphore(max_concurrency)
+            return limits[name]
+
+    def _call_tool(self, tool_mapping, each_func_call):
+        tool = tool_mapping[each_func_call["name"]]
+        try:
+            function_args = json.loads(each_func_call["arguments"])
+            if tool._async_main:
+                function_response = background_loop.run(tool.main(**function_args))
             else:
-                self.messages = pd.concat([
-                    self.messages,
-                    pd.DataFrame({
-                        "role": ["assistant"],
-                        "content": [completion],
-                        "arguments": [None],
-                        "response": [None],
-                    })
-                ])
-        elif user_message:
-            self.messages = pd.concat([
-                self.messages,
-                pd.DataFrame({
-                    "role": ["user"],
-                    "content": [user_message],
-                    "arguments": [None],
-                    "response": [None],
-                })
-            ])
-
-        # print(self.messages.aiide.to_openai_dict())
-        while True:
-            # getting tools
-            if tools and len(tools) > 0:
-                __tool_definations = []
-                __tool_function_mapping = {}
-                for each_tool_instance in tools:
-                    __tool_definations.append(each_tool_instance.tool_def())
-                    __tool_function_mapping[
-                        each_tool_instance.tool_def()["function"]["name"]
-                    ] = each_tool_instance
+                function_response = tool.main(**function_args)
+        except Exception as e:
+            function_response = self._tool_error(e)
+        return function_response
 
+    async def _acall_tool(self, tool_mapping, each_func_call):
+        tool = tool_mapping[each_func_call["name"]]
+        if not tool._async_main:
+            # sync tools run in the loop's default executor, the event loop isn't blocked while they run
+            return await asyncio.to_thread(self._call_tool, tool_mapping, each_func_call)
+        try:
+            function_args = json.loads(each_func_call["arguments"])
+            function_response = await tool.main(**function_args)
+        except Exception as e:
+            function_response = self._tool_error(e)
+        return function_response
+
+    @staticmethod
+    def _tool_error(e):
+        # remove prefix string upto first () from error message
+        e = str(e).split(')', 1)[1]
+        return ("Error in function call:\n"+ str(e)+ "\nPlease call the function with the correct format of arguments.")
+
+    def _record_usage(self, stream, request):
+        self.usage_ledger.record_stream(stream.model or request["model"], stream.usage, request["messages"], stream.completion_text(), cached=stream.cached, route=stream.route)
+
+
+class _ChatStream:
+    """
+    Bookkeeping for one streamed completion, shared by `chat` and `achat`.
+    Writes the streamed text into the agent's messages, collects the tool calls and builds the deltas.
+    """
+
+    def __init__(self, agent: Aiide, structured: bool, eager=None):
+        self._store = agent._store
+        self.tool_calls = []
+        self.finish_reason = None
+        self.usage = None
+        # replayed from the completion cache
+        self.cached = False
+        # the model entry that streamed and its model, when the agent routes between models
+        self.route = None
+        self.model = None
+        # streamed text goes into the trailing assistant message if there is one
+        assistant_row = len(self._store) - 1 if len(self._store) and self._store.row(-1)[0] == "assistant" else None
+        self._text = StreamingText(self._store, agent._stream_commit, assistant_row)
+        # parsing only the new deltas of the structured output
+        self._partial_json = PartialJSONParser() if structured else None
+        # tool calls are started as soon as their arguments are complete when eager dispatch is on
+        self._eager = eager
+        self._arguments = []
+
+    def feed(self, response_chunk):
+        """
+        Processes a streamed chunk and returns the text delta for it, if any.
+        """
+        usage = getattr(response_chunk, "usage", None)
+        if usage is not None:
+            self.usage = usage
+        if not response_chunk.choices:
+            return None
+        deltas = response_chunk.choices[0].delta  # type: ignore
+        if response_chunk.choices[0].finish_reason:  # type: ignore
+            self.finish_reason = response_chunk.choices[0].finish_reason  # type: ignore
+        event = None
+        if deltas.content:
+            self._text.write(deltas.content)
+            if self._partial_json is not None:
+                self._partial_json.feed(deltas.content)
+                content = self._partial_json.value()
             else:
-                __tool_definations = None
-                tool_choice = None  # type: ignore
-            if json_mode:
-                # calling structured_output function
-                schema = self.structured_outputs()
-                if schema != {}:
-                    response_format["json_schema"] = schema  # type: ignore
-                    # response_format["strict"] = True
-            messages_prev = copy.deepcopy(self.messages.aiide.to_openai_dict())
-            response_generator = litellm_completion(
-                model=self._model,
-                messages=self.messages.aiide.to_openai_dict(),
-                tools=__tool_definations,
-                tool_choice=tool_choice,  # auto is default, but we'll be explicit
-                stream=True,
-                temperature=self._temperature,
-                stop=stop_words,
-                response_format=response_format,
-                api_key=self._api_key,
-                # adding kwargs
-                **self._kwargs,
-                # max_tokens=4096,
-                # parallel_tool_calls=True,
-            )
-            response_text = ""
-            temp_function_call = []
-            chunks = []
-            for response_chunk in response_generator:
-                chunks.append(response_chunk)
-                self.messages.reset_index(drop=True, inplace=True)
-                deltas = response_chunk.choices[0].delta  # type: ignore
-                finish_reason = response_chunk.choices[0].finish_reason  # type: ignore
-                # print("deltas",deltas)
-                if deltas.content:
-                    response_text += deltas.content
-                    if json_mode == True and self.structured_outputs() != {}:
-                        yield_response_text = from_json(response_text.encode(), partial_mode=True)
-                    else:
-                        yield_response_text = response_text
-                    if self.messages.iloc[-1]["role"] == "assistant":
-                        self.messages.loc[self.messages.index[-1], "content"] = response_text
-                    else:
-                        self.messages = pd.concat([
-                            self.messages,
-                            pd.DataFrame({
-                                "role": ["assistant"],
-                                "content": [response_text],
-                                "arguments": [None],
-                                "response": [None],
-                            })
-                        ])
-                    yield {"type": "text", "content": yield_response_text, "delta": deltas.content}
-                
-                #! Temporarily disabled yielding of tool calls as they are generated
-                # # to yield a tool call, we first check if tool calls have been created, and if so, we check if if the model is actively creating a tool call or if it has finished. hopefully, we can simplify this logic in the future
-                # if len(temp_function_call) > 0 and ((deltas.tool_calls != None and deltas.tool_calls[0].function.name) or finish_reason!= None):
-                #     # adding the tool call row to self.messages
-                #     self.messages.loc[len(self.messages)] = { # type: ignore
-                #         "role": "tool",
-                #         "content": {
-                #             "name": temp_function_call[-1]["name"],
-                #             "id": temp_function_call[-1]["tool_call_id"],
-                #         },
-                #         "arguments": temp_function_call[-1]["arguments"],
-                #         "response": None,
-                #     } 
-                #     yield {
-                #         "type": "tool_call",
-                #         "name": temp_function_call[-1]["name"],
-                #         "arguments": temp_function_call[-1]["arguments"],
-                #         "finish": bool(finish_reason),
-                #     }
-                if deltas.tool_calls != None:
-                    # print("tool_calls")
-                    if deltas.tool_calls[0].function.name:
-                        # new function called
-                        temp_function_call.append(
-                            {
-                                "tool_call_id": deltas.tool_calls[0].id,
-                                "name": deltas.tool_calls[0].function.name,
-                                "arguments": "",
-                            }
-                        )
-                    if deltas.tool_calls[0].function.arguments != "":
-                        # print("adding arguments", deltas.tool_calls[0].function.arguments)
-                        temp_function_call[-1]["arguments"] += deltas.tool_calls[0].function.arguments
-
-                if finish_reason:  # type: ignore
-                    # print("finish_reason", finish_reason)
-                    if finish_reason == "tool_calls":  # type: ignore
-                        # calling functions
-                        # print("calling funcs", temp_function_call)
-
-                        for tool_index,each_func_call in enumerate(temp_function_call):
-                            self.messages.reset_index(drop=True, inplace=True)
-                            # adding the tool call row to self.messages
-                            self.messages.loc[len(self.messages)] = { # type: ignore
-                                "role": "tool",
-                                "content": {
-                                    "name": each_func_call["name"],
-                                    "id": each_func_call["tool_call_id"],
-                                },
-                                "arguments": each_func_call["arguments"],
-                                "response": None,
-                            } 
-                            yield {
-                                "type": "tool_call",
-                                "name": each_func_call["name"],
-                                "arguments": each_func_call["arguments"],
-                                "finish": True if tool_index == len(temp_function_call)-1 else False,
-                            }
-
-                            function_to_call = __tool_function_mapping[each_func_call["name"]].main # type: ignore
-                            try:
-                                function_args = json.loads(each_func_call["arguments"])
-                                function_response = function_to_call(**function_args)
-                            except Exception as e:
-                                # remove prefix string upto first () from error message
-                                e = str(e).split(')', 1)[1]
-                                function_response = ("Error in function call:\n"+ str(e)+ "\nPlease call the function with the correct format of arguments.")
-                            # finding the tool call row in the self.messages dataframe and adding the response
-                            # iterating over rows
-                            for index, row in self.messages.iterrows():
-                                if row["role"] == "tool" and row["content"]["id"] == each_func_call["tool_call_id"]:
-                                    # updating the response
-                                    self.messages.at[index, "response"] = function_response
-                                    break
-                            yield {
-                                "type": "tool_response",
-                                "name": each_func_call["name"],
-                                "arguments": each_func_call["arguments"],
-                                "response": function_response,
-                            }
-                        if type(tool_choice) == dict or tool_choice == "required":
-                            # If a tool has been forcefully called for more than 100 times, we exit after the final tool execution to avoid usage blowup
-                                # warnings.warn("Tools have been called 100 times consecutively. If this is the expected behaviour, please raise an issue on our GitHub Repository!")
-                            self.usage["prompt_tokens"] += litellm_stream_chunk_builder(chunks, messages_prev)['usage']["prompt_tokens"]
-                            self.usage["completion_tokens"] += litellm_stream_chunk_builder(chunks, messages_prev)['usage']["completion_tokens"]
-                            self.usage["usd"] += sum(litellm_cost_per_token(model=self._model, prompt_tokens=self.usage["prompt_tokens"], completion_tokens=self.usage["completion_tokens"]))
-                            return
-                    elif finish_reason == "length":  # type: ignore
-                        warnings.warn("Output token limit reached. Continuing the generation.")
-                    else:
-                        # print("!!!!!!!GPT STOP")
-                        self.usage["prompt_tokens"] += litellm_stream_chunk_builder(chunks, messages_prev)['usage']["prompt_tokens"]
-                        self.usage["completion_tokens"] += litellm_stream_chunk_builder(chunks, messages_prev)['usage']["completion_tokens"]
-                        self.usage["usd"] += sum(litellm_cost_per_token(model=self._model, prompt_tokens=self.usage["prompt_tokens"], completion_tokens=self.usage["completion_tokens"]))
-                        return
-            self.usage["prompt_tokens"] += litellm_stream_chunk_builder(chunks, messages_prev)['usage']["prompt_tokens"]
-            self.usage["completion_tokens"] += litellm_stream_chunk_builder(chunks, messages_prev)['usage']["completion_tokens"]
-            self.usage["usd"] += sum(litellm_cost_per_token(model=self._model, prompt_tokens=self.usage["prompt_tokens"], completion_tokens=self.usage["completion_tokens"]))
-        return
+                content = self._text.text
+            event = {"type": "text", "content": content, "delta": deltas.content}
+        if deltas.tool_calls != None:
+            if deltas.tool_calls[0].function.name:
+                # new function called
+                self.tool_calls.append(
+                    {
+                        "tool_call_id": deltas.tool_calls[0].id,
+                        "name": deltas.tool_calls[0].function.name,
+                        "arguments": "",
+                    }
+                )
+                if self._eager is not None:
+                    self._arguments.append(PartialJSONParser())
+            if deltas.tool_calls[0].function.arguments != "":
+                self.tool_calls[-1]["arguments"] += deltas.tool_calls[0].function.arguments
+                if self._eager is not None:
+                    self._feed_arguments(deltas.tool_calls[0].function.arguments)
+        return event
+
+    def _feed_arguments(self, arguments):
+        parser = self._arguments[-1]
+        if parser is None or parser.done:
+            return
+        try:
+            parser.feed(arguments)
+        except ValueError:
+            # invalid arguments are left to the usual error handling once the stream ends
+            self._arguments[-1] = None
+            return
+        if parser.done:
+            self._eager.start(len(self.tool_calls) - 1, self.tool_calls[-1])
+
+    def flush(self):
+        self._text.flush()
+
+    def completion_text(self) -> str:
+        """
+        The text and tool calls streamed, used to count the completion tokens when the provider doesn't report usage.
+        """
+        return self._text.text + "".join(each["name"] + each["arguments"] for each in self.tool_calls)
+
+    def add_tool_call(self, each_func_call) -> int:
+        """
+        Adds the tool call row to the messages and returns its index.
+        """
+        return self._store.append(
+            "tool",
+            {
+                "name": each_func_call["name"],
+                "id": each_func_call["tool_call_id"],
+            },
+            each_func_call["arguments"],
+        )
+
+    def tool_call_event(self, tool_index):
+        each_func_call = self.tool_calls[tool_index]
+        return {
+            "type": "tool_call",
+            "name": each_func_call["name"],
+            "arguments": each_func_call["arguments"],
+            "finish": True if tool_index == len(self.tool_calls)-1 else False,
+        }
+
+    def tool_response_event(self, tool_index, function_response):
+        each_func_call = self.tool_calls[tool_index]
+        return {
+            "type": "tool_response",
+            "name": each_func_call["name"],
+            "arguments": each_func_call["arguments"],
+            "response": function_response,
+        }
+
+
+class _EagerToolCalls:
+    """
+    Tool calls started in the background while the completion is still streaming, used with `eager_tools`.
+    Sync tools run in the background loop's thread pool, async tools on the background loop or, in `achat`, on the caller's loop.
+    """
+
+    def __init__(self, agent: Aiide, tool_mapping: dict, asynchronous: bool = False):
+        self._agent = agent
+        self._tool_mapping = tool_mapping
+        self._asynchronous = asynchronous
+        self._limit = asyncio.Semaphore(agent._tool_concurrency)
+        self._futures = {}
+
+    def start(self, tool_index, each_func_call):
+        if tool_index in self._futures or each_func_call["name"] not in self._tool_mapping:
+            return
+        coroutine = self._agent._acall_tool_limited(self._limit, self._tool_mapping, each_func_call)
+        self._futures[tool_index] = asyncio.ensure_future(coroutine) if self._asynchronous else background_loop.submit(coroutine)
+
+    def result(self, tool_index, each_func_call):
+        """
+        Returns the response of a tool call, calling the tool now if it wasn't started while streaming.
+        """
+        if tool_index not in self._futures:
+            return self._agent._call_tool(self._tool_mapping, each_func_call)
+        return self._futures[tool_index].result()
+
+    async def aresult(self, tool_index, each_func_call):
+        if tool_index not in self._futures:
+            return await self._agent._acall_tool_limited(None, self._tool_mapping, each_func_call)
+        return await self._futures[tool_index]
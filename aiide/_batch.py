@@ -0,0 +1,141 @@
+import concurrent.futures
+import copy
+import json
+import os
+import random
+import threading
+import time
+import weakref
+from ._context import ContextWindow
+from ._store import MessageStore
+from ._usage import UsageLedger
+from ._utils import history_messages, is_transient_error, openai_messages_to_rows
+
+
+def _batch_items(inputs):
+    # (id, user message, history) for every input, ids default to the position in `inputs`
+    for index, item in enumerate(inputs):
+        if isinstance(item, dict) and ("user_message" in item or "history" in item):
+            yield item.get("id", index), item.get("user_message"), item.get("history")
+        else:
+            yield index, item, None
+
+
+def _completed_ids(results_path: str) -> set:
+    completed = set()
+    if not os.path.exists(results_path):
+        return completed
+    with open(results_path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # a line cut short by an interrupted run
+                continue
+            if result.get("ok"):
+                completed.add(json.dumps(result["id"]))
+    return completed
+
+
+class _BatchRun:
+    """
+    One `Aiide.batch` call: runs every item on its own copy of the agent in a thread pool.
+    """
+
+    def __init__(self, agent, chat_kwargs: dict, concurrency: int, retries: int, retry_backoff: float):
+        self.agent = agent
+        self.chat_kwargs = chat_kwargs
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        # every item starts from the agent's messages at the time of the call
+        agent._store.sync()
+        self.base_rows = list(zip(*agent._store._columns))
+
+    def _item_agent(self, history, usage_ledger):
+        item_agent = copy.copy(self.agent)
+        item_agent._store = MessageStore(self.base_rows)
+        if history is not None:
+            item_agent._store.extend(openai_messages_to_rows(history_messages(history)))
+        item_agent.usage = usage_ledger.totals
+        item_agent.usage_ledger = usage_ledger
+        # batch requests wait behind interactive ones in a shared rate limiter
+        item_agent._priority = "batch"
+        item_agent._tool_limits = weakref.WeakKeyDictionary()
+        item_agent._tool_limits_lock = threading.Lock()
+        # the token count cache isn't thread-safe, every item counts its own messages
+        context_window = self.agent._context_window
+        if context_window is not None:
+            item_agent._context_window = ContextWindow(context_window.max_prompt_tokens, context_window.completion_reserve, context_window.pinned_roles)
+        return item_agent
+
+    def run_item(self, item_id, user_message, history) -> dict:
+        usage_ledger = UsageLedger({"prompt_tokens": 0.0, "completion_tokens": 0.0, "cache_read_tokens": 0.0, "cache_write_tokens": 0.0, "usd": 0.0})
+        attempts = 0
+        while True:
+            attempts += 1
+            # a failed attempt leaves partial messages behind, every attempt starts from a fresh copy
+            item_agent = self._item_agent(history, usage_ledger)
+            try:
+                for _ in item_agent.chat(user_message, **self.chat_kwargs):
+                    pass
+            except Exception as e:
+                if attempts <= self.retries and is_transient_error(e):
+                    # exponential backoff with full jitter
+                    time.sleep(random.uniform(0, self.retry_backoff * 2 ** (attempts - 1)))
+                    continue
+                return self._result(item_id, item_agent, usage_ledger, attempts, error=f"{type(e).__name__}: {e}")
+            return self._result(item_id, item_agent, usage_ledger, attempts)
+
+    @staticmethod
+    def _result(item_id, item_agent, usage_ledger, attempts, error=None) -> dict:
+        role, content = item_agent._store.row(-1)[:2] if len(item_agent._store) else (None, None)
+        return {
+            "id": item_id,
+            "ok": error is None,
+            "content": content if error is None and role == "assistant" else None,
+            "error": error,
+            "attempts": attempts,
+            "usage": dict(usage_ledger.totals),
+            "calls": usage_ledger.calls,
+            "messages": item_agent._store.to_openai_dict(),
+        }
+
+    def __call__(self, inputs, results_path=None):
+        completed = _completed_ids(results_path) if results_path is not None else set()
+        items = (item for item in _batch_items(inputs) if json.dumps(item[0]) not in completed)
+        results_file = open(results_path, "a", encoding="utf-8") if results_path is not None else None
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="aiide-batch")
+        pending = set()
+        try:
+            for item in items:
+                pending.add(pool.submit(self.run_item, *item))
+                # inputs are read as items finish, so an iterator over a large dataset is never held in memory
+                if len(pending) >= 2 * self.concurrency:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    yield from self._finish(done, results_file)
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                yield from self._finish(done, results_file)
+        finally:
+            # items that haven't started are dropped when the caller stops early, running ones complete
+            pool.shutdown(wait=True, cancel_futures=True)
+            if results_file is not None:
+                results_file.close()
+
+    def _finish(self, done, results_file):
+        for future in done:
+            result = future.result()
+            self.agent.usage_ledger.merge(result["calls"], result["usage"])
+            if results_file is not None:
+                results_file.write(json.dumps(result, default=repr) + "\n")
+                results_file.flush()
+            yield result
+
+
+def run_batch(agent, inputs, concurrency=8, retries=2, retry_backoff=1.0, results_path=None, **chat_kwargs):
+    if not isinstance(concurrency, int) or concurrency < 1:
+        raise ValueError(f"Invalid concurrency {concurrency!r}, expected a positive integer")
+    if not isinstance(retries, int) or retries < 0:
+        raise ValueError(f"Invalid retries {retries!r}, expected a non-negative integer")
+    return _BatchRun(agent, chat_kwargs, concurrency, retries, retry_backoff)(inputs, os.fspath(results_path) if results_path is not None else None)
@@ -0,0 +1,184 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+
+# request arguments that don't change the completion, so they are left out of the cache key
+_UNKEYED = frozenset(("api_key", "api_base", "base_url", "client", "stream", "stream_options", "drop_params", "timeout", "num_retries", "metadata"))
+
+
+def _record(chunk) -> list:
+    # [content, tool calls, finish reason, usage], the parts of a streamed chunk the chat loop reads
+    usage = getattr(chunk, "usage", None)
+    if usage is not None:
+        usage = [
+            usage.prompt_tokens or 0,
+            usage.completion_tokens or 0,
+            getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None) or 0,
+            getattr(usage, "cache_creation_input_tokens", None) or 0,
+        ]
+    if not chunk.choices:
+        return [None, None, None, usage]
+    choice = chunk.choices[0]
+    tool_calls = choice.delta.tool_calls
+    if tool_calls is not None:
+        tool_calls = [[tool_call.id, tool_call.function.name, tool_call.function.arguments] for tool_call in tool_calls]
+    return [choice.delta.content, tool_calls, choice.finish_reason, usage]
+
+
+def _replay(record):
+    content, tool_calls, finish_reason, usage = record
+    if usage is not None:
+        prompt_tokens, completion_tokens, cache_read_tokens, cache_write_tokens = usage
+        usage = SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=cache_read_tokens),
+            cache_creation_input_tokens=cache_write_tokens,
+        )
+    if content is None and tool_calls is None and finish_reason is None:
+        return SimpleNamespace(choices=[], usage=usage)
+    if tool_calls is not None:
+        tool_calls = [
+            SimpleNamespace(index=index, id=tool_call_id, type="function", function=SimpleNamespace(name=name, arguments=arguments))
+            for index, (tool_call_id, name, arguments) in enumerate(tool_calls)
+        ]
+    delta = SimpleNamespace(role="assistant", content=content, tool_calls=tool_calls)
+    return SimpleNamespace(choices=[SimpleNamespace(index=0, delta=delta, finish_reason=finish_reason)], usage=usage)
+
+
+class CompletionCache:
+    """
+    Streamed completions stored in a local SQLite file, to replay them instead of calling the LLM again.
+
+    Completions are keyed by a hash of the request: the model, messages, tools, response format,
+    temperature, stop words and the other completion arguments, except credentials, the endpoint and
+    streaming options. A hit is replayed chunk by chunk through the normal streaming path, tool calls
+    included. Only completions that were streamed to the end are stored.
+
+    When the file grows over `max_bytes`, the least recently used completions are evicted. With
+    `read_only=True` the cache is only looked up, misses call the LLM without storing anything, which
+    suits CI runs against a cache recorded beforehand.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024, read_only: bool = False):
+        if not isinstance(max_bytes, int) or max_bytes < 1:
+            raise ValueError(f"Invalid max_bytes {max_bytes!r}, expected a positive integer")
+        self.path = os.fspath(path)
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        if read_only:
+            self._db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, chunks BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)")
+            self._db.commit()
+
+    @staticmethod
+    def key(request: dict) -> str:
+        """
+        Canonical hash of the completion arguments.
+        """
+        keyed = {name: value for name, value in request.items() if name not in _UNKEYED and value is not None}
+        canonical = json.dumps(keyed, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=repr)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get(self, key: str) -> list | None:
+        """
+        Returns the recorded chunks of a completion, or None if it isn't cached.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT chunks FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if not self.read_only:
+                self._db.execute("UPDATE completions SET last_used = ? WHERE key = ?", (time.time(), key))
+                self._db.commit()
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key: str, records: list):
+        """
+        Stores the recorded chunks of a completion and evicts the least recently used ones over max_bytes.
+        """
+        if self.read_only:
+            return
+        blob = zlib.compress(json.dumps(records, separators=(",", ":")).encode())
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions (key, chunks, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, blob, len(blob), time.time()),
+            )
+            excess = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0] - self.max_bytes
+            if excess > 0:
+                evicted = []
+                # the completion just stored is kept even if it is larger than max_bytes on its own
+                for evicted_key, size in self._db.execute("SELECT key, size FROM completions WHERE key != ? ORDER BY last_used", (key,)):
+                    evicted.append((evicted_key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                self._db.executemany("DELETE FROM completions WHERE key = ?", evicted)
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM completions")
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def replay(self, records: list):
+        """
+        Yields chunks shaped like litellm's streamed chunks from recorded ones.
+        """
+        for record in records:
+            yield _replay(record)
+
+    async def areplay(self, records: list):
+        for record in records:
+            yield _replay(record)
+
+    def record(self, key: str, chunks):
+        """
+        Yields the chunks of a streamed completion and stores them once the stream is complete.
+        """
+        records = []
+        for chunk in chunks:
+            records.append(_record(chunk))
+            yield chunk
+        self.put(key, records)
+
+    async def arecord(self, key: str, chunks):
+        records = []
+        async for chunk in chunks:
+            records.append(_record(chunk))
+            yield chunk
+        # compressing and writing the completion would hold up every other session on the event loop
+        await asyncio.to_thread(self.put, key, records)
+
+
+def parse_completion_cache(cache) -> CompletionCache | None:
+    """
+    Returns the completion cache for a path or a CompletionCache, or None if there is no cache.
+    """
+    if cache is None or isinstance(cache, CompletionCache):
+        return cache
+    if isinstance(cache, (str, os.PathLike)):
+        return CompletionCache(cache)
+    raise ValueError(f"Invalid completion_cache {cache!r}, expected a path or a CompletionCache")
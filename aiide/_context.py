@@ -0,0 +1,88 @@
+from ._usage import _tokenizer_model
+
+
+def parse_context_window(policy) -> "ContextWindow | None":
+    """
+    Validates a context window policy and returns it as a ContextWindow, or None if there is no policy.
+    """
+    if policy is None:
+        return None
+    if isinstance(policy, dict) and set(policy) <= {"max_prompt_tokens", "completion_reserve", "pinned_roles"}:
+        max_prompt_tokens = policy.get("max_prompt_tokens")
+        completion_reserve = policy.get("completion_reserve", 0)
+        pinned_roles = policy.get("pinned_roles", ["system"])
+        if (
+            isinstance(max_prompt_tokens, int)
+            and isinstance(completion_reserve, int)
+            and 0 <= completion_reserve < max_prompt_tokens
+            and isinstance(pinned_roles, (list, tuple, set))
+        ):
+            return ContextWindow(max_prompt_tokens, completion_reserve, pinned_roles)
+    raise ValueError(
+        f"Invalid context_window {policy!r}, expected "
+        '{"max_prompt_tokens": n, "completion_reserve": n, "pinned_roles": ["system"]} with max_prompt_tokens > completion_reserve >= 0'
+    )
+
+
+class ContextWindow:
+    """
+    Picks the part of the history sent to the LLM so that the prompt fits a token budget.
+
+    Messages with a pinned role are always sent. The rest of the budget (`max_prompt_tokens` minus
+    `completion_reserve` and the pinned messages) is filled with the most recent messages, and the
+    oldest ones that don't fit are left out of the request. They stay in `Aiide.messages`. An
+    assistant message and the tool responses to its tool calls are kept or left out together, and the
+    latest message is always sent even if it is over the budget on its own.
+
+    Token counts are cached per message, and only the messages from the end of the history back to the
+    edge of the window are looked at, so the check stays cheap however long the conversation gets.
+    """
+
+    def __init__(self, max_prompt_tokens: int, completion_reserve: int = 0, pinned_roles=("system",)):
+        self.max_prompt_tokens = max_prompt_tokens
+        self.completion_reserve = completion_reserve
+        self.pinned_roles = frozenset(pinned_roles)
+        # id(message) -> (message, number of tool calls, tokens), the message is kept so its id isn't reused
+        self._counts = {}
+
+    def _tokens(self, message: dict, model: str) -> int:
+        # assistant messages get tool calls appended in place as the tool rows are added
+        tool_calls = len(message.get("tool_calls") or ())
+        cached = self._counts.get(id(message))
+        if cached is not None and cached[0] is message and cached[1] == tool_calls:
+            return cached[2]
+        from litellm import token_counter as litellm_token_counter
+
+        tokens = litellm_token_counter(model=_tokenizer_model(model), messages=[message])
+        self._counts[id(message)] = (message, tool_calls, tokens)
+        return tokens
+
+    def apply(self, messages: list, model: str) -> list:
+        """
+        Returns the messages to send, in their original order.
+        """
+        budget = self.max_prompt_tokens - self.completion_reserve
+        pinned = [index for index, message in enumerate(messages) if message["role"] in self.pinned_roles]
+        budget -= sum(self._tokens(messages[index], model) for index in pinned)
+        pinned = set(pinned)
+        start = len(messages)
+        while start > 0:
+            # the unit ending at start: a message, or an assistant message with the tool responses after it
+            unit_start = start - 1
+            if messages[unit_start]["role"] == "tool":
+                while unit_start > 0 and messages[unit_start - 1]["role"] == "tool":
+                    unit_start -= 1
+                if unit_start > 0 and messages[unit_start - 1].get("tool_calls"):
+                    unit_start -= 1
+            tokens = sum(self._tokens(messages[index], model) for index in range(unit_start, start) if index not in pinned)
+            if tokens > budget and start < len(messages):
+                break
+            budget -= tokens
+            start = unit_start
+        if len(self._counts) > 2 * len(messages) + 64:
+            # forgetting messages that were removed from the history
+            current = {id(message) for message in messages}
+            self._counts = {key: value for key, value in self._counts.items() if key in current}
+        if start == 0:
+            return messages
+        return [message for index, message in enumerate(messages) if index >= start or index in pinned]
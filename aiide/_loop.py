@@ -0,0 +1,45 @@
+import asyncio
+import concurrent.futures
+import threading
+
+
+class BackgroundLoop:
+    """
+    An asyncio event loop running in a daemon thread, used to run coroutines from synchronous code.
+
+    The loop is started on first use and shared by every agent in the process, so async tools called
+    from `chat` overlap with each other instead of each getting a fresh loop.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=loop.run_forever, name="aiide-background-loop", daemon=True)
+                self._thread.start()
+                self._loop = loop
+        return self._loop
+
+    def submit(self, coroutine) -> concurrent.futures.Future:
+        """
+        Schedules a coroutine on the loop and returns a future for its result.
+        """
+        loop = self._start()
+        if threading.current_thread() is self._thread:
+            coroutine.close()
+            raise RuntimeError("Cannot wait on the background loop from a coroutine running on it, use achat instead")
+        return asyncio.run_coroutine_threadsafe(coroutine, loop)
+
+    def run(self, coroutine):
+        """
+        Runs a coroutine on the loop and blocks until it returns.
+        """
+        return self.submit(coroutine).result()
+
+
+background_loop = BackgroundLoop()
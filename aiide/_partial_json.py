@@ -0,0 +1,221 @@
+import json
+import re
+
+# plain string characters, numbers and literals are consumed a run at a time instead of per character
+_STRING_RUN = re.compile(r'[^"\\]+')
+_NUMBER_RUN = re.compile(r"[-+0-9.eE]+")
+_LITERAL_RUN = re.compile(r"[a-z]+")
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_LITERALS = {"true": True, "false": False, "null": None}
+
+# what the parser expects next
+_VALUE, _KEY, _COLON, _AFTER_VALUE, _STRING, _NUMBER, _LITERAL, _DONE = range(8)
+
+
+class PartialJSONParser:
+    """
+    Incremental parser for a JSON document that arrives in chunks.
+
+    `feed` consumes only the new text and keeps the container stack and any unfinished token between
+    calls. `value` returns the document parsed so far like `jiter.from_json(..., partial_mode=True)`:
+    unfinished strings, keys and literals are left out and a trailing number is kept if it is valid.
+    Completed containers are shared between the values returned, only the containers that are still
+    open are copied.
+    """
+
+    def __init__(self):
+        self._root = None
+        # open containers from the outermost one: [container, current key]
+        self._stack = []
+        self._state = _VALUE
+        # unfinished string, number or literal
+        self._token = []
+        self._token_is_key = False
+        self._escape = False
+        self._snapshot = None
+        self._changed = False
+
+    def feed(self, text: str):
+        """
+        Parses the next chunk of the document.
+        """
+        pos = 0
+        end = len(text)
+        self._changed = True
+        while pos < end:
+            state = self._state
+            if state == _STRING:
+                pos = self._feed_string(text, pos)
+                continue
+            if state == _NUMBER:
+                match = _NUMBER_RUN.match(text, pos)
+                if match:
+                    self._token.append(match.group())
+                    pos = match.end()
+                    continue
+                self._add_value(self._number("".join(self._token)))
+                continue
+            if state == _LITERAL:
+                match = _LITERAL_RUN.match(text, pos)
+                if match:
+                    self._token.append(match.group())
+                    pos = match.end()
+                    literal = "".join(self._token)
+                    if literal in _LITERALS:
+                        self._add_value(_LITERALS[literal])
+                    elif not any(each.startswith(literal) for each in _LITERALS):
+                        raise ValueError(f"Invalid literal {literal!r}")
+                    continue
+                raise ValueError(f"Invalid literal {''.join(self._token)!r}")
+            pos = _WHITESPACE.match(text, pos).end()
+            if pos == end:
+                break
+            char = text[pos]
+            pos += 1
+            if state == _VALUE:
+                if char == '"':
+                    self._start_token(_STRING, False)
+                elif char == "{":
+                    self._open({})
+                elif char == "[":
+                    self._open([])
+                elif char == "]" and self._stack and type(self._stack[-1][0]) is list and not self._stack[-1][0]:
+                    self._close()
+                elif char in "-0123456789":
+                    self._start_token(_NUMBER)
+                    self._token.append(char)
+                elif char in "tfn":
+                    self._start_token(_LITERAL)
+                    pos -= 1
+                else:
+                    raise ValueError(f"Unexpected character {char!r} while expecting a value")
+            elif state == _KEY:
+                if char == '"':
+                    self._start_token(_STRING, True)
+                elif char == "}" and not self._stack[-1][0]:
+                    self._close()
+                else:
+                    raise ValueError(f"Unexpected character {char!r} while expecting a key")
+            elif state == _COLON:
+                if char != ":":
+                    raise ValueError(f"Unexpected character {char!r} while expecting ':'")
+                self._state = _VALUE
+            elif state == _AFTER_VALUE:
+                container = self._stack[-1][0]
+                if char == ",":
+                    self._state = _KEY if type(container) is dict else _VALUE
+                elif char == ("}" if type(container) is dict else "]"):
+                    self._close()
+                else:
+                    raise ValueError(f"Unexpected character {char!r} after a value")
+            else:
+                raise ValueError(f"Unexpected character {char!r} after the end of the document")
+
+    def _feed_string(self, text, pos):
+        end = len(text)
+        token = self._token
+        while pos < end:
+            if self._escape:
+                # the escaped character, \\uXXXX digits are validated when the string is decoded
+                token.append(text[pos])
+                self._escape = False
+                pos += 1
+                continue
+            match = _STRING_RUN.match(text, pos)
+            if match:
+                token.append(match.group())
+                pos = match.end()
+                continue
+            char = text[pos]
+            pos += 1
+            if char == "\\":
+                token.append(char)
+                self._escape = True
+            else:
+                raw = "".join(token)
+                value = json.loads(f'"{raw}"') if "\\" in raw else raw
+                if self._token_is_key:
+                    self._stack[-1][1] = value
+                    self._state = _COLON
+                else:
+                    self._add_value(value)
+                break
+        return pos
+
+    def _start_token(self, state, is_key=False):
+        self._state = state
+        self._token = []
+        self._token_is_key = is_key
+
+    @staticmethod
+    def _number(text):
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            raise ValueError(f"Invalid number {text!r}")
+
+    def _attach(self, value):
+        if not self._stack:
+            self._root = value
+        else:
+            frame = self._stack[-1]
+            if type(frame[0]) is list:
+                frame[0].append(value)
+            else:
+                frame[0][frame[1]] = value
+
+    def _add_value(self, value):
+        self._attach(value)
+        self._state = _AFTER_VALUE if self._stack else _DONE
+
+    def _open(self, container):
+        self._attach(container)
+        self._stack.append([container, None])
+        self._state = _KEY if type(container) is dict else _VALUE
+
+    def _close(self):
+        self._stack.pop()
+        self._state = _AFTER_VALUE if self._stack else _DONE
+
+    @property
+    def done(self) -> bool:
+        """
+        Whether a complete JSON document has been parsed.
+        """
+        return self._state == _DONE
+
+    def value(self):
+        """
+        Returns the document parsed so far, or None if no value has started yet.
+        """
+        if self._changed:
+            self._snapshot = self._take_snapshot()
+            self._changed = False
+        return self._snapshot
+
+    def _take_snapshot(self):
+        pending = ()
+        if self._state == _NUMBER:
+            try:
+                pending = (json.loads("".join(self._token)),)
+            except json.JSONDecodeError:
+                pass
+        if not self._stack:
+            return pending[0] if pending else self._root
+        # copying the open containers from the innermost one, everything they hold is complete
+        child = None
+        for depth in range(len(self._stack) - 1, -1, -1):
+            container, key = self._stack[depth]
+            container = container.copy()
+            if child is not None:
+                if type(container) is list:
+                    container[-1] = child
+                else:
+                    container[key] = child
+            elif pending:
+                if type(container) is list:
+                    container.append(pending[0])
+                else:
+                    container[key] = pending[0]
+            child = container
+        return child
@@ -0,0 +1,67 @@
+PROMPT_CACHE_MODES = ("auto", "cache_control")
+
+_CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def parse_prompt_cache(policy) -> str | None:
+    """
+    Validates a prompt cache option and returns its mode, or None if prompt caching is off.
+    """
+    if policy is None or policy is False:
+        return None
+    if policy is True:
+        return "auto"
+    if policy in PROMPT_CACHE_MODES:
+        return policy
+    raise ValueError(f"Invalid prompt_cache {policy!r}, expected True, False, \"auto\" or \"cache_control\"")
+
+
+def uses_cache_control(mode: str, model: str) -> bool:
+    """
+    Whether cache_control breakpoints are added for the model. In "auto" mode they are only added for
+    Claude models, other providers such as OpenAI cache the longest matching prefix on their own.
+    """
+    if mode == "cache_control":
+        return True
+    model = model.lower()
+    return model.startswith("anthropic/") or "claude" in model
+
+
+def _mark(message: dict) -> dict:
+    # a copy, the messages of the request are shared with the message store
+    content = message["content"]
+    if isinstance(content, str):
+        blocks = [{"type": "text", "text": content, "cache_control": _CACHE_CONTROL}]
+    else:
+        blocks = list(content)
+        blocks[-1] = {**blocks[-1], "cache_control": _CACHE_CONTROL}
+    return {**message, "content": blocks}
+
+
+def apply_prompt_cache(request: dict, cache_control: bool):
+    """
+    Keeps the start of the request byte-identical from one call to the next, so providers can reuse
+    it from their prompt cache.
+
+    Tool definitions are ordered by name, whatever order the tools are passed in. With `cache_control`
+    the last tool definition, the last system message and the last message get a cache breakpoint, so
+    the tools, the system message and the conversation so far are cached incrementally.
+    """
+    tools = request.get("tools")
+    if tools:
+        tools = sorted(tools, key=lambda tool: tool["function"]["name"])
+        if cache_control:
+            tools[-1] = {**tools[-1], "cache_control": _CACHE_CONTROL}
+        request["tools"] = tools
+    if not cache_control:
+        return
+    messages = list(request["messages"])
+    marked = set()
+    for role in ("system", None):
+        for index in range(len(messages) - 1, -1, -1):
+            if (role is None or messages[index]["role"] == role) and messages[index].get("content"):
+                if index not in marked:
+                    messages[index] = _mark(messages[index])
+                    marked.add(index)
+                break
+    request["messages"] = messages
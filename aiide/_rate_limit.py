@@ -0,0 +1,402 @@
+import asyncio
+import collections
+import sys
+import threading
+import time
+from ._utils import aclose_stream, close_stream
+
+# priority classes, served in this order
+PRIORITIES = ("interactive", "batch")
+
+# rough token counts for the estimate made before a call, it is corrected with the reported usage afterwards
+_CHARS_PER_TOKEN = 4
+_MESSAGE_TOKENS = 4
+_IMAGE_TOKENS = 765
+
+
+def parse_priority(priority: str) -> int:
+    if priority not in PRIORITIES:
+        raise ValueError(f"Invalid priority {priority!r}, expected one of {', '.join(PRIORITIES)}")
+    return PRIORITIES.index(priority)
+
+
+def _content_tokens(content) -> int:
+    if content is None:
+        return 0
+    if type(content) is str:
+        return len(content) // _CHARS_PER_TOKEN
+    tokens = 0
+    for part in content:
+        if part.get("type") == "text":
+            tokens += len(part.get("text") or "") // _CHARS_PER_TOKEN
+        else:
+            tokens += _IMAGE_TOKENS
+    return tokens
+
+
+def estimate_tokens(request: dict, completion_tokens: int = 256) -> int:
+    """
+    Estimated prompt and completion tokens of a request, from the length of the messages and tools and the output token limit.
+    """
+    tokens = 0
+    for message in request["messages"]:
+        tokens += _MESSAGE_TOKENS + _content_tokens(message.get("content"))
+        for tool_call in message.get("tool_calls") or ():
+            tokens += len(tool_call["function"]["arguments"] or "") // _CHARS_PER_TOKEN
+    for tool in request.get("tools") or ():
+        tokens += len(str(tool)) // _CHARS_PER_TOKEN
+    return tokens + (request.get("max_completion_tokens") or request.get("max_tokens") or completion_tokens)
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    if getattr(error, "status_code", None) == 429:
+        return True
+    litellm = sys.modules.get("litellm")
+    return litellm is not None and isinstance(error, litellm.RateLimitError)
+
+
+class _Bucket:
+    # token bucket refilled continuously at `per_minute` / 60 per second, holding up to `burst_seconds` of refill
+    __slots__ = ("capacity", "rate", "level", "updated")
+
+    def __init__(self, per_minute: float, burst_seconds: float, now: float):
+        self.rate = per_minute / 60
+        self.capacity = max(self.rate * burst_seconds, 1)
+        self.level = self.capacity
+        self.updated = now
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, amount: float) -> float:
+        # more than the capacity is granted once the bucket is full, leaving it in debt
+        missing = min(amount, self.capacity) - self.level
+        return missing / self.rate if missing > 0 else 0.0
+
+
+class _Ticket:
+    __slots__ = ("session", "priority", "tokens", "enqueued", "granted", "wake")
+
+    def __init__(self, session, priority, tokens, enqueued, wake):
+        self.session = session
+        self.priority = priority
+        self.tokens = tokens
+        self.enqueued = enqueued
+        self.granted = False
+        self.wake = wake
+
+
+class _ModelQueue:
+    """
+    Buckets and waiting requests of one model. Every priority class has a queue per session, and sessions take turns.
+    """
+
+    def __init__(self, rpm, tpm, burst_seconds, now):
+        self.requests = _Bucket(rpm, burst_seconds, now) if rpm else None
+        self.tokens = _Bucket(tpm, burst_seconds, now) if tpm else None
+        self.queues = [collections.OrderedDict() for _ in PRIORITIES]  # session -> deque of tickets
+        self.in_flight = 0
+        self.granted = 0
+        self.rate_limited = 0
+        self.waited_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def head(self) -> "_Ticket | None":
+        for queue in self.queues:
+            if queue:
+                return next(iter(queue.values()))[0]
+        return None
+
+    def pop_head(self, ticket):
+        queue = self.queues[ticket.priority]
+        tickets = queue[ticket.session]
+        tickets.popleft()
+        if tickets:
+            # the session goes to the back, behind the other sessions waiting in its class
+            queue.move_to_end(ticket.session)
+        else:
+            del queue[ticket.session]
+
+    def remove(self, ticket):
+        queue = self.queues[ticket.priority]
+        tickets = queue.get(ticket.session)
+        if tickets is not None and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del queue[ticket.session]
+
+    def refill(self, now):
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.refill(now)
+
+    def wait(self, ticket) -> float:
+        return max(
+            self.requests.wait(1) if self.requests is not None else 0.0,
+            self.tokens.wait(ticket.tokens) if self.tokens is not None else 0.0,
+        )
+
+
+class RateLimiter:
+    """
+    Process-wide scheduler keeping the requests of every agent using it within the provider's quotas.
+
+    Each model has token buckets for requests per minute (`rpm`) and tokens per minute (`tpm`), holding up to
+    `burst_seconds` of quota since providers enforce their per minute limits over shorter periods. `models` sets
+    the quotas of single models, {"gpt-4o-mini": {"rpm": 500, "tpm": 200_000}}, others get `rpm` and `tpm`.
+    Tokens are estimated before the call and corrected with the reported usage once the completion is done.
+
+    Waiting requests are granted by priority class, "interactive" before "batch", and within a class the
+    sessions (agents) take turns so a busy one can't hold back the others. A 429 from the provider empties the
+    model's buckets so the queued requests back off.
+    """
+
+    def __init__(
+        self,
+        rpm: float | None = None,
+        tpm: float | None = None,
+        models: dict | None = None,
+        burst_seconds: float = 10.0,
+        completion_tokens: int = 256,
+        clock=time.monotonic,
+    ):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.models = {model: dict(limits) for model, limits in (models or {}).items()}
+        for model, limits in self.models.items():
+            if set(limits) - {"rpm", "tpm"}:
+                raise ValueError(f"Invalid limits {limits!r} for {model}, expected rpm and tpm")
+        if burst_seconds <= 0:
+            raise ValueError(f"Invalid burst_seconds {burst_seconds!r}, expected a positive number")
+        self.burst_seconds = burst_seconds
+        self.completion_tokens = completion_tokens
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._states = {}  # model -> _ModelQueue
+
+    def _state(self, model) -> _ModelQueue:
+        state = self._states.get(model)
+        if state is None:
+            limits = self.models.get(model, {})
+            state = self._states[model] = _ModelQueue(
+                limits.get("rpm", self.rpm), limits.get("tpm", self.tpm), self.burst_seconds, self._clock()
+            )
+        return state
+
+    def _enqueue(self, request, session, priority, wake) -> tuple:
+        tokens = estimate_tokens(request, self.completion_tokens)
+        with self._lock:
+            state = self._state(request["model"])
+            ticket = _Ticket(session, parse_priority(priority), tokens, self._clock(), wake)
+            state.queues[ticket.priority].setdefault(session, collections.deque()).append(ticket)
+        return state, ticket
+
+    def _dispatch(self, state) -> float | None:
+        # grants the waiting requests in turn while the buckets allow, returns the seconds until the next one can be
+        now = self._clock()
+        state.refill(now)
+        while True:
+            ticket = state.head()
+            if ticket is None:
+                return None
+            wait = state.wait(ticket)
+            if wait > 0:
+                return wait
+            state.pop_head(ticket)
+            if state.requests is not None:
+                state.requests.level -= 1
+            if state.tokens is not None:
+                state.tokens.level -= ticket.tokens
+            state.in_flight += 1
+            state.granted += 1
+            waited = now - ticket.enqueued
+            state.waited_seconds += waited
+            state.max_wait_seconds = max(state.max_wait_seconds, waited)
+            ticket.granted = True
+            ticket.wake()
+
+    def _cancel(self, state, ticket):
+        with self._lock:
+            if ticket.granted:
+                self._settle(state, ticket.tokens, 0, False)
+            else:
+                state.remove(ticket)
+                self._dispatch(state)
+
+    def _settle(self, state, estimated, used, rate_limited):
+        state.in_flight -= 1
+        if state.tokens is not None:
+            state.tokens.level = min(state.tokens.capacity, state.tokens.level + estimated - used)
+        if rate_limited:
+            state.rate_limited += 1
+            for bucket in (state.requests, state.tokens):
+                if bucket is not None:
+                    bucket.level = min(bucket.level, 0)
+        self._dispatch(state)
+
+    def acquire(self, request: dict, session=None, priority: str = "interactive") -> "RateLimitGrant":
+        """
+        Waits until the request fits in the quotas of its model. Settle the returned grant once the completion is done.
+        """
+        event = threading.Event()
+        state, ticket = self._enqueue(request, session, priority, event.set)
+        try:
+            while True:
+                with self._lock:
+                    wait = None if ticket.granted else self._dispatch(state)
+                if ticket.granted:
+                    return RateLimitGrant(self, state, ticket.tokens)
+                event.wait(wait)
+        except BaseException:
+            self._cancel(state, ticket)
+            raise
+
+    async def aacquire(self, request: dict, session=None, priority: str = "interactive") -> "RateLimitGrant":
+        """
+        Asynchronous version of `acquire`, waiting without blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+
+        def wake():
+            # granted from whichever thread settled a request
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass
+
+        state, ticket = self._enqueue(request, session, priority, wake)
+        try:
+            while True:
+                with self._lock:
+                    wait = None if ticket.granted else self._dispatch(state)
+                if ticket.granted:
+                    return RateLimitGrant(self, state, ticket.tokens)
+                try:
+                    await asyncio.wait_for(event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+        except BaseException:
+            self._cancel(state, ticket)
+            raise
+
+    def stats(self) -> dict:
+        """
+        Live queue depths and waits per model.
+        """
+        with self._lock:
+            now = self._clock()
+            stats = {}
+            for model, state in self._states.items():
+                state.refill(now)
+                queued = {name: sum(map(len, queue.values())) for name, queue in zip(PRIORITIES, state.queues)}
+                stats[model] = {
+                    "queued": sum(queued.values()),
+                    "queued_by_priority": queued,
+                    "waiting_sessions": sum(len(queue) for queue in state.queues),
+                    "in_flight": state.in_flight,
+                    "granted": state.granted,
+                    "rate_limited": state.rate_limited,
+                    "mean_wait_seconds": state.waited_seconds / state.granted if state.granted else 0.0,
+                    "max_wait_seconds": state.max_wait_seconds,
+                    "requests_available": state.requests.level if state.requests is not None else None,
+                    "tokens_available": state.tokens.level if state.tokens is not None else None,
+                }
+            return stats
+
+
+class RateLimitGrant:
+    """
+    A request let through by the RateLimiter, settled once with the tokens the completion used.
+    """
+
+    __slots__ = ("_limiter", "_state", "_tokens", "_settled")
+
+    def __init__(self, limiter, state, tokens):
+        self._limiter = limiter
+        self._state = state
+        self._tokens = tokens
+        self._settled = False
+
+    def settle(self, tokens: int | None = None, error: BaseException | None = None):
+        """
+        Corrects the estimate with the tokens reported in the usage. Without usage the estimate is kept,
+        unless the call failed outright. A rate limit error empties the model's buckets.
+        """
+        limiter = self._limiter
+        with limiter._lock:
+            if self._settled:
+                return
+            self._settled = True
+            used = tokens if tokens is not None else (0 if error is not None else self._tokens)
+            limiter._settle(self._state, self._tokens, used, error is not None and is_rate_limited(error))
+
+
+def parse_rate_limiter(rate_limiter) -> RateLimiter | None:
+    if rate_limiter is None or isinstance(rate_limiter, RateLimiter):
+        return rate_limiter
+    raise ValueError(f"Invalid rate_limiter {rate_limiter!r}, expected a RateLimiter")
+
+
+def _usage_tokens(chunk, tokens):
+    usage = getattr(chunk, "usage", None)
+    if usage is None:
+        return tokens
+    return (getattr(usage, "prompt_tokens", 0) or 0) + (getattr(usage, "completion_tokens", 0) or 0)
+
+
+def settled(grant: RateLimitGrant, response) -> "_Settled":
+    """
+    Streams `response`, settling the grant with the reported usage once it is done or the caller stops.
+    """
+    return _Settled(grant, response)
+
+
+class _Settled:
+    # an iterator rather than a generator, so another thread can reach `response` and abort it
+    __slots__ = ("grant", "response", "_chunks", "_tokens")
+
+    def __init__(self, grant: RateLimitGrant, response):
+        self.grant = grant
+        self.response = response
+        self._chunks = iter(response)
+        self._tokens = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self.close()
+            raise
+        except Exception as e:
+            self.grant.settle(self._tokens, error=e)
+            self.close()
+            raise
+        self._tokens = _usage_tokens(chunk, self._tokens)
+        return chunk
+
+    def close(self):
+        close_stream(self.response)
+        self.grant.settle(self._tokens)
+
+    def __del__(self):
+        self.close()
+
+
+async def asettled(grant: RateLimitGrant, response):
+    tokens = None
+    try:
+        async for chunk in response:
+            tokens = _usage_tokens(chunk, tokens)
+            yield chunk
+    except Exception as e:
+        grant.settle(tokens, error=e)
+        raise
+    finally:
+        await aclose_stream(response)
+        grant.settle(tokens)
@@ -0,0 +1,245 @@
+import random
+import threading
+import time
+from ._utils import aclose_stream, close_stream
+
+_KEYS = frozenset(("alpha", "error_threshold", "cooldown", "explore"))
+
+# statuses of requests that would fail on any model, they aren't retried on the next one
+_REQUEST_ERROR_STATUS = frozenset((400, 422))
+
+# where and how a call is sent, an entry setting any of them gets none of the agent's
+_CONNECTION_KEYS = frozenset(("api_key", "api_base", "base_url", "api_version", "organization", "client"))
+
+
+def _route(entry) -> tuple:
+    # (name, completion arguments) of a model entry, a model name or a dict with "model" and LiteLLM arguments
+    if isinstance(entry, str):
+        return entry, {"model": entry}
+    if isinstance(entry, dict) and isinstance(entry.get("model"), str):
+        settings = dict(entry)
+        name = settings.pop("name", None) or settings["model"]
+        return name, settings
+    raise ValueError(f"Invalid model {entry!r}, expected a model name or a dict with a \"model\" key")
+
+
+def parse_routing(models, routing: dict | None) -> "ModelRouter | None":
+    if isinstance(models, str):
+        if routing is not None:
+            raise ValueError("routing needs a list of models")
+        return None
+    models = list(models)
+    if not models:
+        raise ValueError("Invalid model [], expected a model name or a list of models")
+    routing = routing or {}
+    if not isinstance(routing, dict) or set(routing) - _KEYS:
+        raise ValueError(f"Invalid routing {routing!r}, expected a dict with keys {', '.join(sorted(_KEYS))}")
+    return ModelRouter(models, **routing)
+
+
+def _falls_back(error: BaseException) -> bool:
+    return getattr(error, "status_code", None) not in _REQUEST_ERROR_STATUS
+
+
+class _ModelStats:
+    __slots__ = ("first_chunk_seconds", "tokens_per_second", "completion_tokens", "error_rate", "calls", "errors", "failed_at")
+
+    def __init__(self):
+        # exponentially weighted moving averages, None until the model has streamed
+        self.first_chunk_seconds = None
+        self.tokens_per_second = None
+        self.completion_tokens = None
+        self.error_rate = 0.0
+        self.calls = 0
+        self.errors = 0
+        self.failed_at = None
+
+
+def _ewma(average, value, alpha):
+    return value if average is None else average + alpha * (value - average)
+
+
+class ModelRouter:
+    """
+    Routes the calls of an agent between equivalent models, e.g. the same model on several providers or deployments.
+
+    Each entry of `models` is a model name, or a dict with the "model" and the LiteLLM arguments of that
+    deployment, e.g. its "api_key" and "api_base", merged into the request of the calls it gets. An entry
+    setting any connection argument gets none of the agent's, so the agent's key isn't sent to another
+    provider. Entries are told apart by their optional "name", the model by default.
+
+    Every streamed call updates the model's moving averages of time to first chunk, tokens per second and
+    error rate (weight `alpha` on the latest call). Models that haven't streamed yet are tried first, in list
+    order, then calls go to the healthy model expected to finish first, with a chance of `explore` of trying
+    another healthy model so the averages stay current. A model whose error rate reaches `error_threshold`
+    is skipped for `cooldown` seconds after its last error, and then tried again.
+
+    A call that fails before streaming is made again on the next model. Once chunks have been yielded an
+    error is raised, the call isn't repeated.
+    """
+
+    def __init__(self, models: list, alpha: float = 0.3, error_threshold: float = 0.5, cooldown: float = 30.0, explore: float = 0.05):
+        if not 0 < alpha <= 1:
+            raise ValueError(f"Invalid alpha {alpha!r}, expected a number between 0 and 1")
+        # entry names, in list order, and the completion arguments of each
+        self.models = []
+        self.routes = {}
+        for entry in models:
+            name, settings = _route(entry)
+            if name in self.routes:
+                raise ValueError(f"Duplicate model {name!r}, give the entries distinct names")
+            self.models.append(name)
+            self.routes[name] = settings
+        self.alpha = alpha
+        self.error_threshold = error_threshold
+        self.cooldown = cooldown
+        self.explore = explore
+        self._lock = threading.Lock()
+        self._stats = {model: _ModelStats() for model in self.models}
+
+    def _healthy(self, stats, now) -> bool:
+        return stats.error_rate < self.error_threshold or now - stats.failed_at >= self.cooldown
+
+    def _expected_seconds(self, stats) -> float:
+        seconds = stats.first_chunk_seconds
+        if stats.tokens_per_second and stats.completion_tokens:
+            seconds += stats.completion_tokens / stats.tokens_per_second
+        return seconds
+
+    def order(self) -> list:
+        """
+        The models in the order a call tries them.
+        """
+        now = time.monotonic()
+        with self._lock:
+            healthy, unhealthy = [], []
+            for index, model in enumerate(self.models):
+                stats = self._stats[model]
+                (healthy if self._healthy(stats, now) else unhealthy).append((stats, index, model))
+            measured = sorted((self._expected_seconds(stats), index, model) for stats, index, model in healthy if stats.first_chunk_seconds is not None)
+            order = [model for stats, _, model in healthy if stats.first_chunk_seconds is None] + [model for _, _, model in measured]
+            # models in their cooldown are the last resort, the one that failed longest ago first
+            order += [model for _, _, model in sorted(unhealthy, key=lambda item: item[0].failed_at)]
+        if self.explore and len(healthy) > 1 and random.random() < self.explore:
+            order.insert(0, order.pop(random.randrange(1, len(healthy))))
+        return order
+
+    def _succeeded(self, model, first_chunk_seconds, completion_tokens, stream_seconds):
+        with self._lock:
+            stats = self._stats[model]
+            stats.calls += 1
+            stats.error_rate = _ewma(stats.error_rate, 0.0, self.alpha)
+            stats.first_chunk_seconds = _ewma(stats.first_chunk_seconds, first_chunk_seconds, self.alpha)
+            if completion_tokens and stream_seconds > 0:
+                stats.tokens_per_second = _ewma(stats.tokens_per_second, completion_tokens / stream_seconds, self.alpha)
+                stats.completion_tokens = _ewma(stats.completion_tokens, completion_tokens, self.alpha)
+
+    def _failed(self, model):
+        with self._lock:
+            stats = self._stats[model]
+            stats.calls += 1
+            stats.errors += 1
+            stats.error_rate = _ewma(stats.error_rate, 1.0, self.alpha)
+            stats.failed_at = time.monotonic()
+
+    def stats(self) -> dict:
+        """
+        The moving averages and call counts per model, and whether it is healthy.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {
+                model: {
+                    "healthy": self._healthy(stats, now),
+                    "first_chunk_seconds": stats.first_chunk_seconds,
+                    "tokens_per_second": stats.tokens_per_second,
+                    "error_rate": stats.error_rate,
+                    "calls": stats.calls,
+                    "errors": stats.errors,
+                }
+                for model, stats in self._stats.items()
+            }
+
+    def request(self, request: dict, model: str) -> dict:
+        """
+        The request with the completion arguments of the entry `model` merged in.
+        """
+        settings = self.routes[model]
+        if not _CONNECTION_KEYS.isdisjoint(settings):
+            request = {name: value for name, value in request.items() if name not in _CONNECTION_KEYS}
+        return {**request, **settings}
+
+    def stream(self, request: dict, call, chat_stream):
+        """
+        Streams the completion from the first model in `order()` that starts streaming, `call(request)` makes
+        the call. The entry and the model used are set on the chat stream, for its usage.
+        """
+        error = None
+        for model in self.order():
+            start = time.monotonic()
+            try:
+                response = iter(call(self.request(request, model)))
+                chunk = next(response, None)
+            except Exception as e:
+                self._failed(model)
+                if not _falls_back(e):
+                    raise
+                error = e
+                continue
+            first_chunk = time.monotonic()
+            chat_stream.route = model
+            chat_stream.model = self.routes[model]["model"]
+            completion_tokens = 0
+            try:
+                while chunk is not None:
+                    completion_tokens = _completion_tokens(chunk, completion_tokens)
+                    yield chunk
+                    chunk = next(response, None)
+            except Exception:
+                self._failed(model)
+                raise
+            finally:
+                close_stream(response)
+            self._succeeded(model, first_chunk - start, completion_tokens, time.monotonic() - first_chunk)
+            return
+        raise error
+
+    async def astream(self, request: dict, acall, chat_stream):
+        error = None
+        for model in self.order():
+            start = time.monotonic()
+            try:
+                response = (await acall(self.request(request, model))).__aiter__()
+                chunk = await anext(response, None)
+            except Exception as e:
+                self._failed(model)
+                if not _falls_back(e):
+                    raise
+                error = e
+                continue
+            first_chunk = time.monotonic()
+            chat_stream.route = model
+            chat_stream.model = self.routes[model]["model"]
+            completion_tokens = 0
+            try:
+                while chunk is not None:
+                    completion_tokens = _completion_tokens(chunk, completion_tokens)
+                    yield chunk
+                    chunk = await anext(response, None)
+            except Exception:
+                self._failed(model)
+                raise
+            finally:
+                await aclose_stream(response)
+            self._succeeded(model, first_chunk - start, completion_tokens, time.monotonic() - first_chunk)
+            return
+        raise error
+
+
+def _completion_tokens(chunk, tokens):
+    # the reported usage when there is one, the content chunks otherwise
+    usage = getattr(chunk, "usage", None)
+    if usage is not None and getattr(usage, "completion_tokens", None):
+        return usage.completion_tokens
+    choices = getattr(chunk, "choices", None)
+    return tokens + 1 if choices and getattr(choices[0].delta, "content", None) else tokens
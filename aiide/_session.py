@@ -0,0 +1,412 @@
+import base64
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from ._store import MessageStore
+from ._utils import MESSAGE_COLUMNS, LazyImage, _is_image, image_cache
+
+SESSION_FORMAT_VERSION = 1
+
+# Arrow IPC for these suffixes, Parquet otherwise
+_ARROW_SUFFIXES = (".arrow", ".feather", ".ipc")
+
+# placeholder for an image inside a JSON encoded cell, pointing into the row's images
+_IMAGE_KEY = "__aiide_image__"
+
+# setup arguments that are never written to a session file
+_SECRET_KWARGS = frozenset(("api_key", "aws_secret_access_key", "aws_session_token", "azure_ad_token"))
+
+
+def _image_bytes(image) -> tuple:
+    # the encoded bytes the image is sent as, so nothing is encoded again when saving or sending
+    encoded = getattr(image, "_aiide_encoded", None)
+    if encoded is not None:
+        return encoded
+    data_url = image_cache.data_url(image)
+    header, data = data_url.split(",", 1)
+    return header[len("data:") :].split(";", 1)[0], base64.b64decode(data)
+
+
+def _encode_cell(value, images: list):
+    if _is_image(value):
+        mime, data = _image_bytes(value)
+        images.append(data)
+        return {_IMAGE_KEY: len(images) - 1, "mime": mime}
+    if isinstance(value, list):
+        return [_encode_cell(item, images) for item in value]
+    if isinstance(value, dict):
+        return {key: _encode_cell(item, images) for key, item in value.items()}
+    return value
+
+
+def _decode_cell(value, images: list):
+    if isinstance(value, list):
+        return [_decode_cell(item, images) for item in value]
+    if isinstance(value, dict):
+        if _IMAGE_KEY in value:
+            return _open_image(value["mime"], images[value[_IMAGE_KEY]])
+        return {key: _decode_cell(item, images) for key, item in value.items()}
+    return value
+
+
+def _open_image(mime: str, data: bytes):
+    import io
+    from PIL import Image
+
+    # only the header is read here, the pixels are decoded on first use
+    image = Image.open(io.BytesIO(data))
+    image._aiide_encoded = (mime, data)
+    return image
+
+
+def _writable(settings: dict) -> dict:
+    # without the secrets and the objects that can't be written as JSON
+    writable = {}
+    for name, value in settings.items():
+        if name in _SECRET_KWARGS:
+            continue
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            continue
+        writable[name] = value
+    return writable
+
+
+def _route_entries(router) -> list:
+    entries = []
+    for name in router.models:
+        settings = _writable(router.routes[name])
+        if name != settings["model"]:
+            settings["name"] = name
+        entries.append(settings["model"] if len(settings) == 1 else settings)
+    return entries
+
+
+def _with_secrets(entries: list, router) -> list:
+    # the keys and clients of the routed models come from the agent the session is loaded into, by entry name
+    if router is None:
+        return entries
+    restored = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            current = router.routes.get(entry.get("name") or entry["model"], {})
+            entry = {**{name: value for name, value in current.items() if name not in entry}, **entry}
+        restored.append(entry)
+    return restored
+
+
+def _setup_parameters(agent) -> dict:
+    context_window = agent._context_window
+    if context_window is not None:
+        context_window = {
+            "max_prompt_tokens": context_window.max_prompt_tokens,
+            "completion_reserve": context_window.completion_reserve,
+            "pinned_roles": sorted(context_window.pinned_roles),
+        }
+    stream_policy = agent._stream_policy
+    if stream_policy is not None:
+        stream_policy = {
+            "first_chunk_timeout": stream_policy.first_chunk_timeout,
+            "chunk_timeout": stream_policy.chunk_timeout,
+            "retries": stream_policy.retries,
+            "retry_backoff": stream_policy.retry_backoff,
+            "hedge_percentile": stream_policy.hedge_percentile,
+            "hedge_delay": stream_policy.hedge_delay,
+            "hedge_min_samples": stream_policy.hedge_min_samples,
+        }
+    router = agent._router
+    routing = None
+    if router is not None:
+        routing = {"alpha": router.alpha, "error_threshold": router.error_threshold, "cooldown": router.cooldown, "explore": router.explore}
+    # clients and other objects can't be written, they are taken from the agent the session is loaded into
+    kwargs = _writable(agent._kwargs)
+    return {
+        "model": _route_entries(router) if router is not None else agent._model,
+        "temperature": agent._temperature,
+        "stream_commit": agent._stream_commit,
+        "tool_concurrency": agent._tool_concurrency,
+        "eager_tools": agent._eager_tools,
+        "context_window": context_window,
+        "prompt_cache": agent._prompt_cache or False,
+        "priority": agent._priority,
+        "stream_policy": stream_policy,
+        "routing": routing,
+        "kwargs": kwargs,
+    }
+
+
+def save_session(agent, path: str):
+    """
+    Writes the messages, usage and setup parameters of an agent to a Parquet file, or an Arrow IPC
+    file if `path` ends with .arrow, .feather or .ipc.
+
+    Every cell is stored as JSON, with images taken out into a binary column as their encoded bytes.
+    API keys are not written.
+    """
+    import pyarrow as pa
+
+    path = os.fspath(path)
+    agent._store.sync()
+    roles, contents, arguments, responses = agent._store._columns
+    cells = ([], [], [])
+    row_images = []
+    for row in range(len(roles)):
+        images = []
+        for encoded, column in zip(cells, (contents, arguments, responses)):
+            value = column[row]
+            if value is None:
+                encoded.append(None)
+                continue
+            try:
+                encoded.append(json.dumps(value if type(value) is str else _encode_cell(value, images)))
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"Message {row} can't be saved: {e}") from None
+        row_images.append(images or None)
+    metadata = {
+        "version": SESSION_FORMAT_VERSION,
+        "setup": _setup_parameters(agent),
+        "usage": agent.usage,
+        "usage_ledger": agent.usage_ledger.calls,
+    }
+    table = pa.table(
+        {
+            "role": pa.array(roles, pa.string()),
+            "content": pa.array(cells[0], pa.string()),
+            "arguments": pa.array(cells[1], pa.string()),
+            "response": pa.array(cells[2], pa.string()),
+            "images": pa.array(row_images, pa.list_(pa.binary())),
+        }
+    ).replace_schema_metadata({"aiide": json.dumps(metadata)})
+    if path.endswith(_ARROW_SUFFIXES):
+        with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        import pyarrow.parquet as pq
+
+        pq.write_table(table, path)
+
+
+def load_session(agent, path: str):
+    """
+    Restores the messages, usage and setup parameters written by `save_session` into an agent.
+
+    The agent keeps its API key, completion cache and any setup arguments that couldn't be saved.
+    Images are decoded lazily, on first use.
+    """
+    import pyarrow as pa
+
+    path = os.fspath(path)
+    if path.endswith(_ARROW_SUFFIXES):
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all()
+    else:
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path)
+    metadata = json.loads((table.schema.metadata or {}).get(b"aiide", b"null"))
+    if not isinstance(metadata, dict) or metadata.get("version") != SESSION_FORMAT_VERSION:
+        raise ValueError(f"{path} is not an aiide session file")
+    columns = {name: table.column(name).to_pylist() for name in (*MESSAGE_COLUMNS, "images")}
+    images = columns.pop("images")
+    for name in MESSAGE_COLUMNS[1:]:
+        column = columns[name]
+        for row, value in enumerate(column):
+            if value is not None:
+                value = json.loads(value)
+                # only cells holding images need to be walked
+                column[row] = _decode_cell(value, images[row]) if images[row] and type(value) is not str else value
+
+    setup = metadata["setup"]
+    kwargs = {**getattr(agent, "_kwargs", {}), **setup.pop("kwargs")}
+    if isinstance(setup["model"], list):
+        setup["model"] = _with_secrets(setup["model"], getattr(agent, "_router", None))
+    agent.setup(
+        api_key=getattr(agent, "_api_key", None),
+        completion_cache=getattr(agent, "_completion_cache", None),
+        transport=getattr(agent, "_transport", None),
+        rate_limiter=getattr(agent, "_rate_limiter", None),
+        **setup,
+        **kwargs,
+    )
+    agent._store = MessageStore(zip(*(columns[name] for name in MESSAGE_COLUMNS)))
+    agent.usage.update(metadata["usage"])
+    agent.usage_ledger.calls[:] = metadata["usage_ledger"]
+
+
+def _cell_bytes(value) -> int:
+    if value is None:
+        return 0
+    if type(value) is str:
+        return sys.getsizeof(value)
+    if type(value) is LazyImage:
+        # the data URL, and the pixels once it has been decoded
+        return sys.getsizeof(value._aiide_data_url) + (_cell_bytes(value._image) if value._image is not None else 0)
+    if _is_image(value):
+        encoded = getattr(value, "_aiide_encoded", None)
+        # Image.open only reads the header, the pixels take memory once the image is loaded
+        pixels = value.width * value.height * len(value.getbands()) if getattr(value, "im", None) is not None else 0
+        return pixels + (len(encoded[1]) if encoded is not None else 0)
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_cell_bytes(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_cell_bytes(key) + _cell_bytes(item) for key, item in value.items())
+    return sys.getsizeof(value)
+
+
+def session_bytes(agent) -> int:
+    """
+    Estimated memory held by the messages of an agent, images included.
+    """
+    agent._store.sync()
+    return sum(_cell_bytes(value) for column in agent._store._columns for value in column)
+
+
+class SessionManager:
+    """
+    Agents kept by session id, with the least recently used ones spilled to disk to stay under a memory ceiling.
+
+    `factory(session_id)` creates the agent of a new session and of a session being rehydrated, which
+    is then restored with `load_session` from `directory`. The memory of a session is estimated from
+    its messages, again on the next call after it was handed out since it may have grown. Once the sessions in memory add up to more than
+    `max_bytes`, or there are more than `max_sessions` of them, the least recently used ones are saved
+    with `save_session` and dropped from memory. Sessions used through `session()` are never spilled
+    while the block runs.
+    """
+
+    def __init__(self, factory, directory: str, max_bytes: int = 512 * 1024 * 1024, max_sessions: int | None = None):
+        if not isinstance(max_bytes, int) or max_bytes < 1:
+            raise ValueError(f"Invalid max_bytes {max_bytes!r}, expected a positive integer")
+        if max_sessions is not None and (not isinstance(max_sessions, int) or max_sessions < 1):
+            raise ValueError(f"Invalid max_sessions {max_sessions!r}, expected a positive integer or None")
+        self.factory = factory
+        self.directory = os.fspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # session id -> agent, least recently used first
+        self._bytes = {}  # session id -> estimated bytes
+        # sessions handed out since they were last measured
+        self._stale = set()
+        self._pins = {}  # session id -> number of session() blocks using it
+        self._lock = threading.RLock()
+        self.stats = {
+            "created": 0,
+            "hits": 0,
+            "rehydrated": 0,
+            "spilled": 0,
+            "spilled_bytes": 0,
+            "spill_seconds": 0.0,
+            "rehydrate_seconds": 0.0,
+        }
+
+    def _path(self, session_id) -> str:
+        return os.path.join(self.directory, urllib.parse.quote(str(session_id), safe="") + ".arrow")
+
+    def get(self, session_id):
+        """
+        Returns the agent of a session, rehydrating it from disk or creating it if needed.
+        """
+        with self._lock:
+            agent = self._sessions.get(session_id)
+            if agent is not None:
+                self._sessions.move_to_end(session_id)
+                self.stats["hits"] += 1
+            else:
+                agent = self.factory(session_id)
+                path = self._path(session_id)
+                if os.path.exists(path):
+                    start = time.perf_counter()
+                    agent.load_session(path)
+                    os.remove(path)
+                    self.stats["rehydrate_seconds"] += time.perf_counter() - start
+                    self.stats["rehydrated"] += 1
+                else:
+                    self.stats["created"] += 1
+                self._sessions[session_id] = agent
+            self._stale.add(session_id)
+            self._evict(keep=session_id)
+            return agent
+
+    @contextlib.contextmanager
+    def session(self, session_id):
+        """
+        Context manager handing out the agent of a session, which is not spilled until the block exits.
+        """
+        with self._lock:
+            agent = self.get(session_id)
+            self._pins[session_id] = self._pins.get(session_id, 0) + 1
+        try:
+            yield agent
+        finally:
+            with self._lock:
+                self._pins[session_id] -= 1
+                if not self._pins[session_id]:
+                    del self._pins[session_id]
+                self._stale.add(session_id)
+                self._evict()
+
+    def _evict(self, keep=None):
+        for session_id in self._stale:
+            if session_id in self._sessions:
+                self._bytes[session_id] = session_bytes(self._sessions[session_id])
+        self._stale.clear()
+        if keep is not None:
+            # the session being handed out is measured again next time, after it has been used
+            self._stale.add(keep)
+        # least recently used first, skipping the session being handed out and the ones in use
+        for session_id in list(self._sessions):
+            if self.memory_bytes <= self.max_bytes and (self.max_sessions is None or len(self._sessions) <= self.max_sessions):
+                return
+            if session_id != keep and session_id not in self._pins:
+                self.spill(session_id)
+
+    def spill(self, session_id):
+        """
+        Saves a session to disk and drops it from memory.
+        """
+        with self._lock:
+            agent = self._sessions.pop(session_id)
+            self._stale.discard(session_id)
+            start = time.perf_counter()
+            agent.save_session(self._path(session_id))
+            self.stats["spill_seconds"] += time.perf_counter() - start
+            self.stats["spilled"] += 1
+            self.stats["spilled_bytes"] += self._bytes.pop(session_id)
+
+    def spill_all(self):
+        """
+        Saves every session in memory to disk, e.g. before shutting down.
+        """
+        with self._lock:
+            for session_id in list(self._sessions):
+                self.spill(session_id)
+
+    def drop(self, session_id):
+        """
+        Forgets a session, in memory and on disk.
+        """
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            self._bytes.pop(session_id, None)
+            self._stale.discard(session_id)
+            if os.path.exists(self._path(session_id)):
+                os.remove(self._path(session_id))
+
+    @property
+    def memory_bytes(self) -> int:
+        """
+        Estimated memory of the sessions in memory.
+        """
+        return sum(self._bytes.values())
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions or os.path.exists(self._path(session_id))
+
+    def __len__(self):
+        return len(self._sessions)
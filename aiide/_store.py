@@ -0,0 +1,180 @@
+import io
+import time
+from typing import TYPE_CHECKING
+from ._utils import MESSAGE_COLUMNS, OpenAIMessageCache, _first_changed_row, register_accessor
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+class MessageStore:
+    """
+    Append-only columnar storage behind `Aiide.messages`.
+
+    Messages are kept as one Python list per column, so appending a row or updating a cell is O(1)
+    no matter how long the conversation is. The pandas DataFrame handed out by `Aiide.messages` is
+    built lazily from the columns and reused until the next write. Edits made to that DataFrame are
+    synced back into the columns on the next read or write of the store.
+    """
+
+    def __init__(self, rows=None):
+        self._columns = tuple([] for _ in MESSAGE_COLUMNS)
+        # DataFrame handed out since the last write
+        self._view = None
+        # first row changed since the OpenAI format was last brought up to date
+        self._dirty = None
+        self._openai_messages = OpenAIMessageCache()
+        if rows:
+            self.extend(rows)
+
+    def __len__(self):
+        return len(self._columns[0])
+
+    def _mark(self, row: int):
+        if self._dirty is None or row < self._dirty:
+            self._dirty = row
+
+    def _replace_columns(self, columns: tuple):
+        self._mark(_first_changed_row(self._columns, columns))
+        self._columns = columns
+
+    def sync(self):
+        """
+        Pulls edits made to the handed out DataFrame back into the store.
+        """
+        if self._view is not None:
+            self._replace_columns(tuple(self._view[column].tolist() for column in MESSAGE_COLUMNS))
+
+    def _write(self):
+        # edits made to the DataFrame so far are kept, after the write it is stale and rebuilt on access
+        if self._view is not None:
+            self.sync()
+            self._view = None
+
+    def append(self, role, content, arguments=None, response=None) -> int:
+        """
+        Appends a message and returns its row index.
+        """
+        self._write()
+        for column, value in zip(self._columns, (role, content, arguments, response)):
+            column.append(value)
+        return len(self) - 1
+
+    def extend(self, rows):
+        """
+        Appends (role, content, arguments, response) rows.
+        """
+        self._write()
+        for row in rows:
+            for column, value in zip(self._columns, row):
+                column.append(value)
+
+    def set(self, row: int, column: str, value):
+        """
+        Updates a single cell.
+        """
+        self._write()
+        self._columns[MESSAGE_COLUMNS.index(column)][row] = value
+        self._mark(row)
+
+    def row(self, row: int) -> tuple:
+        """
+        Returns the (role, content, arguments, response) of a row, negative indexes count from the end.
+        """
+        self.sync()
+        return tuple(column[row] for column in self._columns)
+
+    def load_dataframe(self, df_messages: "pd.DataFrame"):
+        """
+        Replaces the stored messages with the rows of `df_messages`.
+        """
+        self._view = None
+        self._replace_columns(tuple(df_messages[column].tolist() for column in MESSAGE_COLUMNS))
+
+    def dataframe(self) -> "pd.DataFrame":
+        """
+        Returns the messages as a DataFrame, built once per write.
+        """
+        if self._view is None:
+            import pandas as pd
+
+            register_accessor()
+            self._view = pd.DataFrame(dict(zip(MESSAGE_COLUMNS, self._columns)))
+        return self._view
+
+    def to_openai_dict(self) -> list:
+        """
+        Returns the messages in OpenAI format, converting only the rows added or changed since the last call.
+        """
+        self.sync()
+        if self._dirty is not None:
+            self._openai_messages.invalidate(self._dirty)
+            self._dirty = None
+        return self._openai_messages.extend(self._columns)
+
+
+def parse_commit_policy(policy) -> tuple:
+    """
+    Validates a streaming commit policy and returns it as (kind, amount).
+    """
+    if policy in ("chunk", "finish"):
+        return policy, 0
+    if isinstance(policy, dict) and len(policy) == 1:
+        (kind, amount), = policy.items()
+        if kind in ("chars", "ms") and isinstance(amount, (int, float)) and amount > 0:
+            return kind, amount
+    raise ValueError(f'Invalid stream_commit {policy!r}, expected "chunk", "finish", {{"chars": n}} or {{"ms": n}}')
+
+
+class StreamingText:
+    """
+    Accumulates streamed text and commits it to an assistant row of a MessageStore.
+
+    How often the row is written depends on the commit policy:
+    - "chunk": on every chunk
+    - "finish": only when `flush` is called at the end of the stream
+    - {"chars": n}: once at least n characters are pending
+    - {"ms": n}: at most once every n milliseconds
+    """
+
+    def __init__(self, store: MessageStore, policy="chunk", row: int | None = None):
+        self._store = store
+        self._kind, self._amount = parse_commit_policy(policy)
+        self.row = row
+        self._buffer = io.StringIO()
+        self._text = ""
+        self._pending = 0
+        self._committed_at = time.monotonic()
+
+    @property
+    def text(self) -> str:
+        """
+        The text streamed so far.
+        """
+        if self._text is None:
+            self._text = self._buffer.getvalue()
+        return self._text
+
+    def write(self, delta: str):
+        self._buffer.write(delta)
+        self._text = None
+        self._pending += len(delta)
+        if (
+            self._kind == "chunk"
+            or (self._kind == "chars" and self._pending >= self._amount)
+            or (self._kind == "ms" and (time.monotonic() - self._committed_at) * 1000 >= self._amount)
+        ):
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the pending text to the assistant row, appending the row on the first commit.
+        """
+        if not self._pending:
+            return
+        if self.row is None:
+            self.row = self._store.append("assistant", self.text)
+        else:
+            self._store.set(self.row, "content", self.text)
+        self._pending = 0
+        self._committed_at = time.monotonic()
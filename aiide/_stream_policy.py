@@ -0,0 +1,301 @@
+import asyncio
+import collections
+import queue
+import random
+import threading
+import time
+from ._utils import abort_stream, aclose_stream, close_stream, is_transient_error
+
+_KEYS = frozenset(
+    ("first_chunk_timeout", "chunk_timeout", "retries", "retry_backoff", "hedge_percentile", "hedge_delay", "hedge_min_samples")
+)
+
+# what an attempt reports to the call waiting on it
+_SENT, _CHUNK, _DONE, _ERROR = range(4)
+
+
+def parse_stream_policy(policy: dict | None) -> "StreamPolicy | None":
+    if policy is None:
+        return None
+    if not isinstance(policy, dict) or set(policy) - _KEYS:
+        raise ValueError(f"Invalid stream_policy {policy!r}, expected a dict with keys {', '.join(sorted(_KEYS))}")
+    return StreamPolicy(**policy)
+
+
+class StreamPolicy:
+    """
+    Timeouts, retries and hedging around streamed completions.
+
+    Until the first chunk arrives nothing has been yielded, so a call that fails with a transient error or
+    doesn't start streaming within `first_chunk_timeout` seconds is retried, up to `retries` times with full
+    jitter backoff. With `hedge_percentile`, a duplicate call is made once the first one has waited longer than
+    that percentile of the model's recent times to first chunk (`hedge_delay` until `hedge_min_samples` are
+    known). Whichever streams first is used and the other is cancelled, its connection is closed.
+
+    Once a chunk has been used the call is never made again, a gap of more than `chunk_timeout` seconds
+    between chunks raises a TimeoutError and the deltas yielded so far are kept.
+    """
+
+    def __init__(
+        self,
+        first_chunk_timeout: float | None = None,
+        chunk_timeout: float | None = None,
+        retries: int = 2,
+        retry_backoff: float = 0.5,
+        hedge_percentile: float | None = None,
+        hedge_delay: float = 2.0,
+        hedge_min_samples: int = 20,
+    ):
+        for name, value in (("first_chunk_timeout", first_chunk_timeout), ("chunk_timeout", chunk_timeout)):
+            if value is not None and not value > 0:
+                raise ValueError(f"Invalid {name} {value!r}, expected a positive number of seconds")
+        if not isinstance(retries, int) or retries < 0:
+            raise ValueError(f"Invalid retries {retries!r}, expected a non-negative integer")
+        if hedge_percentile is not None and not 0 < hedge_percentile < 100:
+            raise ValueError(f"Invalid hedge_percentile {hedge_percentile!r}, expected a number between 0 and 100")
+        self.first_chunk_timeout = first_chunk_timeout
+        self.chunk_timeout = chunk_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.hedge_min_samples = hedge_min_samples
+        self._lock = threading.Lock()
+        self._first_chunk_seconds = {}  # model -> recent times to first chunk
+
+    def _hedge_deadline(self, model) -> float | None:
+        if self.hedge_percentile is None:
+            return None
+        with self._lock:
+            samples = sorted(self._first_chunk_seconds.get(model, ()))
+        if len(samples) < self.hedge_min_samples:
+            return self.hedge_delay
+        return samples[min(len(samples) - 1, int(len(samples) * self.hedge_percentile / 100))]
+
+    def _observe(self, model, seconds):
+        with self._lock:
+            samples = self._first_chunk_seconds.get(model)
+            if samples is None:
+                samples = self._first_chunk_seconds[model] = collections.deque(maxlen=256)
+            samples.append(seconds)
+
+    def _chunk_timeout_error(self):
+        return TimeoutError(f"No chunk streamed for {self.chunk_timeout} seconds")
+
+    def stream(self, model: str, acquire, send):
+        """
+        Streams the chunks of the first attempt to start streaming. `acquire()` waits for the rate limiter and
+        returns its grant or None, `send(grant)` makes the call and returns the streamed response.
+        """
+        items = queue.SimpleQueue()
+
+        def launch():
+            attempt = _Attempt()
+            attempt.handle = threading.Thread(target=_run, args=(attempt, items, acquire, send), name="aiide-stream", daemon=True)
+            attempt.handle.start()
+            return attempt
+
+        race = _Race(self, model, launch, _cancel)
+        try:
+            winner = kind = value = None
+            while winner is None:
+                try:
+                    attempt, kind, value = items.get(timeout=race.poll(time.monotonic()))
+                except queue.Empty:
+                    continue
+                winner = race.receive(attempt, kind, value, time.monotonic())
+            while kind != _DONE:
+                if kind == _ERROR:
+                    raise value
+                if kind == _CHUNK:
+                    yield value
+                while True:
+                    try:
+                        attempt, kind, value = items.get(timeout=self.chunk_timeout)
+                    except queue.Empty:
+                        raise self._chunk_timeout_error() from None
+                    if attempt is winner:
+                        break
+        finally:
+            race.cancel_all()
+
+    async def astream(self, model: str, acquire, send):
+        """
+        Asynchronous version of `stream`, `acquire` and `send` are coroutine functions.
+        """
+        items = asyncio.Queue()
+
+        def launch():
+            attempt = _Attempt()
+            attempt.handle = asyncio.ensure_future(_arun(attempt, items, acquire, send))
+            return attempt
+
+        race = _Race(self, model, launch, lambda attempt: attempt.handle.cancel())
+        try:
+            winner = kind = value = None
+            while winner is None:
+                try:
+                    attempt, kind, value = await asyncio.wait_for(items.get(), race.poll(time.monotonic()))
+                except asyncio.TimeoutError:
+                    continue
+                winner = race.receive(attempt, kind, value, time.monotonic())
+            while kind != _DONE:
+                if kind == _ERROR:
+                    raise value
+                if kind == _CHUNK:
+                    yield value
+                while True:
+                    try:
+                        attempt, kind, value = await asyncio.wait_for(items.get(), self.chunk_timeout)
+                    except asyncio.TimeoutError:
+                        raise self._chunk_timeout_error() from None
+                    if attempt is winner:
+                        break
+        finally:
+            race.cancel_all()
+
+
+class _Attempt:
+    __slots__ = ("sent", "cancelled", "handle", "response")
+
+    def __init__(self):
+        self.sent = None
+        self.cancelled = False
+        self.handle = None
+        self.response = None
+
+
+def _cancel(attempt):
+    # the thread may be blocked reading the response, aborting it fails the read instead of waiting for the next chunk
+    attempt.cancelled = True
+    abort_stream(attempt.response)
+
+
+def _run(attempt, items, acquire, send):
+    # reads one attempt on its own thread, a cancelled attempt stops once its response is aborted, or once the
+    # call returns when it was cancelled while waiting for the response headers
+    response = None
+    try:
+        grant = acquire()
+        if attempt.cancelled:
+            if grant is not None:
+                grant.settle(0)
+            return
+        items.put((attempt, _SENT, time.monotonic()))
+        response = attempt.response = send(grant)
+        if attempt.cancelled:
+            abort_stream(response)
+            return
+        for chunk in response:
+            if attempt.cancelled:
+                return
+            items.put((attempt, _CHUNK, chunk))
+        # a finished response is closed normally, its connection goes back to the pool
+        attempt.response = None
+        items.put((attempt, _DONE, None))
+    except Exception as e:
+        attempt.response = None
+        items.put((attempt, _ERROR, e))
+    finally:
+        if response is not None:
+            close_stream(response)
+
+
+async def _arun(attempt, items, acquire, send):
+    response = None
+    try:
+        grant = await acquire()
+        items.put_nowait((attempt, _SENT, time.monotonic()))
+        response = await send(grant)
+        async for chunk in response:
+            items.put_nowait((attempt, _CHUNK, chunk))
+        items.put_nowait((attempt, _DONE, None))
+    except Exception as e:
+        items.put_nowait((attempt, _ERROR, e))
+    finally:
+        if response is not None:
+            await aclose_stream(response)
+
+
+class _Race:
+    """
+    The attempts at one call until the first of them streams: first chunk timeouts, retries and the hedge.
+    """
+
+    def __init__(self, policy: StreamPolicy, model: str, launch, cancel):
+        self.policy = policy
+        self.model = model
+        self.launch = launch
+        self.cancel = cancel
+        self.hedge_deadline = policy._hedge_deadline(model)
+        self.hedged = False
+        self.retries = 0
+        self.retry_at = None
+        self.attempts = [launch()]
+
+    def _drop(self, attempt):
+        self.attempts.remove(attempt)
+        self.cancel(attempt)
+
+    def _failed(self, error, now):
+        if self.attempts:
+            # the other attempt may still stream
+            return
+        if self.retries >= self.policy.retries or not is_transient_error(error):
+            raise error
+        self.retries += 1
+        self.retry_at = now + random.uniform(0, self.policy.retry_backoff * 2 ** (self.retries - 1))
+
+    def poll(self, now) -> float | None:
+        """
+        Starts the retry or the hedge that are due and times out attempts, returns the seconds until the next deadline.
+        """
+        deadlines = []
+        if self.retry_at is not None:
+            if now >= self.retry_at:
+                self.retry_at = None
+                self.attempts.append(self.launch())
+            else:
+                deadlines.append(self.retry_at - now)
+        timeout = self.policy.first_chunk_timeout
+        for attempt in list(self.attempts):
+            if attempt.sent is None or timeout is None:
+                continue
+            if now - attempt.sent >= timeout:
+                self._drop(attempt)
+                self._failed(TimeoutError(f"No chunk streamed within {timeout} seconds"), now)
+                return self.poll(now)
+            deadlines.append(attempt.sent + timeout - now)
+        if not self.hedged and self.hedge_deadline is not None and len(self.attempts) == 1 and self.attempts[0].sent is not None:
+            hedge_at = self.attempts[0].sent + self.hedge_deadline
+            if now >= hedge_at:
+                self.hedged = True
+                self.attempts.append(self.launch())
+            else:
+                deadlines.append(hedge_at - now)
+        return min(deadlines) if deadlines else None
+
+    def receive(self, attempt, kind, value, now) -> "_Attempt | None":
+        """
+        Handles what an attempt reported, returns the attempt once it streams and the others are cancelled.
+        """
+        if attempt not in self.attempts:
+            return None
+        if kind == _SENT:
+            attempt.sent = value
+            return None
+        if kind == _ERROR:
+            self._drop(attempt)
+            self._failed(value, now)
+            return None
+        # the first chunk, or a stream that ended without any
+        for other in list(self.attempts):
+            if other is not attempt:
+                self._drop(other)
+        self.policy._observe(self.model, now - attempt.sent)
+        return attempt
+
+    def cancel_all(self):
+        for attempt in self.attempts:
+            self.cancel(attempt)
+        self.attempts = []
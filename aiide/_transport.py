@@ -0,0 +1,182 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import threading
+import weakref
+
+# providers litellm calls through the OpenAI SDK, which takes the client to use per call
+OPENAI_CLIENT_PROVIDERS = frozenset(("openai", "custom_openai"))
+
+
+class Transport:
+    """
+    Pooled HTTP clients with keep-alive, shared by every agent set up with them.
+
+    Connections to the provider are kept open between calls and turns instead of being set up again,
+    up to `max_connections` at once and `max_keepalive_connections` idle ones, each kept for
+    `keepalive_expiry` seconds. The synchronous client is shared by all threads, async calls get one
+    client per event loop since connections can't move between loops.
+
+    The clients are passed to litellm for providers it calls through the OpenAI SDK (OpenAI and
+    OpenAI compatible endpoints), litellm manages the connections of the other providers itself.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        timeout: float = 600.0,
+        connect_timeout: float = 10.0,
+        http2: bool = False,
+    ):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.http2 = http2
+        self._lock = threading.Lock()
+        self._http_client = None
+        self._async_http_clients = weakref.WeakKeyDictionary()  # event loop -> httpx.AsyncClient
+        self._openai_clients = {}  # (api key hash, base url, max retries) -> openai.OpenAI
+        self._async_openai_clients = weakref.WeakKeyDictionary()  # event loop -> {key: openai.AsyncOpenAI}
+
+    def _options(self) -> dict:
+        import httpx
+
+        return dict(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+            http2=self.http2,
+            follow_redirects=True,
+        )
+
+    @property
+    def http_client(self):
+        """
+        The pooled httpx.Client.
+        """
+        with self._lock:
+            if self._http_client is None:
+                import httpx
+
+                self._http_client = httpx.Client(**self._options())
+            return self._http_client
+
+    def async_http_client(self):
+        """
+        The pooled httpx.AsyncClient of the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_http_clients.get(loop)
+            if client is None:
+                import httpx
+
+                client = self._async_http_clients[loop] = httpx.AsyncClient(**self._options())
+            return client
+
+    @staticmethod
+    def _client_key(api_key, base_url, max_retries) -> tuple:
+        # the key is hashed so it isn't kept around in plain text
+        return hashlib.sha256(api_key.encode()).hexdigest() if api_key else None, base_url, max_retries
+
+    def openai_client(self, api_key: str | None = None, base_url: str | None = None, max_retries: int = 2, asynchronous: bool = False):
+        """
+        An OpenAI SDK client for the endpoint, on the pooled HTTP client. Clients are cached per API key and endpoint.
+        """
+        import openai
+
+        key = self._client_key(api_key, base_url, max_retries)
+        if asynchronous:
+            http_client = self.async_http_client()
+            with self._lock:
+                clients = self._async_openai_clients.setdefault(asyncio.get_running_loop(), {})
+                if key not in clients:
+                    clients[key] = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=max_retries, http_client=http_client)
+                return clients[key]
+        http_client = self.http_client
+        with self._lock:
+            if key not in self._openai_clients:
+                self._openai_clients[key] = openai.OpenAI(api_key=api_key, base_url=base_url, max_retries=max_retries, http_client=http_client)
+            return self._openai_clients[key]
+
+    def request_client(self, request: dict, asynchronous: bool = False):
+        """
+        The client litellm should make the request with, or None if litellm manages the connections of the provider.
+        """
+        from litellm import get_llm_provider as litellm_get_llm_provider
+
+        try:
+            _, provider, api_key, api_base = litellm_get_llm_provider(request["model"], api_base=request.get("api_base"))
+        except Exception:
+            return None
+        if provider not in OPENAI_CLIENT_PROVIDERS:
+            return None
+        max_retries = request.get("max_retries")
+        return self.openai_client(
+            api_key=request.get("api_key") or api_key,
+            base_url=api_base,
+            max_retries=max_retries if isinstance(max_retries, int) else 2,
+            asynchronous=asynchronous,
+        )
+
+    def prewarm(self, url: str, connections: int = 1):
+        """
+        Opens `connections` keep-alive connections to `url`, e.g. the API base, before the first call needs them.
+        The responses don't matter, only the connections are kept.
+        """
+        client = self.http_client
+
+        def touch():
+            try:
+                client.get(url).read()
+            except Exception:
+                pass
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as pool:
+            for _ in range(connections):
+                pool.submit(touch)
+
+    def close(self):
+        """
+        Closes the synchronous client's connections. Async clients are closed with their event loop.
+        """
+        with self._lock:
+            if self._http_client is not None:
+                self._http_client.close()
+                self._http_client = None
+            self._openai_clients.clear()
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_transport() -> Transport:
+    """
+    The Transport shared by every agent set up with `transport=True`.
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = Transport()
+        return _shared
+
+
+def parse_transport(transport) -> Transport | None:
+    """
+    Returns the Transport for a transport option, or None to let litellm manage the connections.
+    """
+    if transport is None or transport is False:
+        return None
+    if transport is True:
+        return shared_transport()
+    if isinstance(transport, Transport):
+        return transport
+    raise ValueError(f"Invalid transport {transport!r}, expected True, False or a Transport")
@@ -0,0 +1,123 @@
+class UsageLedger:
+    """
+    Token usage and cost of every LLM call made by an agent.
+
+    Each call is recorded with its own prompt and completion tokens, and the prompt tokens read from or
+    written to the provider's prompt cache, so the cost is computed per call and then added to the
+    running totals in `totals` (the agent's `usage` dict). Completions replayed from the completion
+    cache are recorded with the usage of the original call, but cost nothing and aren't added to the
+    totals.
+    """
+
+    def __init__(self, totals: dict):
+        self.totals = totals
+        # one dict per LLM call: model, prompt_tokens, completion_tokens, cache_read_tokens, cache_write_tokens, usd, estimated
+        # and cached, and route for the calls of a routed agent
+        self.calls = []
+
+    def record(
+        self,
+        model: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        estimated: bool = False,
+        cache_read_tokens: int = 0,
+        cache_write_tokens: int = 0,
+        cached: bool = False,
+        route: str | None = None,
+    ) -> dict:
+        """
+        Records one LLM call and returns its entry. `route` is the name of the model entry a routed call went to.
+        """
+        from litellm.cost_calculator import cost_per_token as litellm_cost_per_token
+
+        usd = 0.0 if cached else sum(
+            litellm_cost_per_token(
+                model=model,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                cache_read_input_tokens=cache_read_tokens,
+                cache_creation_input_tokens=cache_write_tokens,
+            )
+        )
+        entry = {
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cache_read_tokens": cache_read_tokens,
+            "cache_write_tokens": cache_write_tokens,
+            "usd": usd,
+            "estimated": estimated,
+            "cached": cached,
+        }
+        if route is not None:
+            entry["route"] = route
+        self.calls.append(entry)
+        if cached:
+            return entry
+        self.totals["prompt_tokens"] += prompt_tokens
+        self.totals["completion_tokens"] += completion_tokens
+        self.totals["cache_read_tokens"] += cache_read_tokens
+        self.totals["cache_write_tokens"] += cache_write_tokens
+        self.totals["usd"] += usd
+        return entry
+
+    def by_model(self) -> dict:
+        """
+        Calls, tokens and cost per model, or per model entry for routed calls, adding up to the totals.
+        """
+        models = {}
+        for call in self.calls:
+            if call["cached"]:
+                continue
+            model = call.get("route") or call["model"]
+            usage = models.get(model)
+            if usage is None:
+                usage = models[model] = dict.fromkeys(("calls", "prompt_tokens", "completion_tokens", "cache_read_tokens", "cache_write_tokens", "usd"), 0)
+            usage["calls"] += 1
+            for key in ("prompt_tokens", "completion_tokens", "cache_read_tokens", "cache_write_tokens", "usd"):
+                usage[key] += call[key]
+        return models
+
+    def merge(self, calls: list, totals: dict):
+        """
+        Adds the calls and totals of another ledger, e.g. of one item of a batch.
+        """
+        self.calls.extend(calls)
+        for key, value in totals.items():
+            self.totals[key] += value
+
+    def record_stream(self, model: str, usage, messages: list, completion: str, cached: bool = False, route: str | None = None) -> dict:
+        """
+        Records a streamed call from the usage reported by the provider, or counts the tokens with the
+        model's tokenizer when the provider didn't report any.
+        """
+        if usage is not None:
+            # OpenAI reports the cached tokens in the prompt token details, Anthropic also the tokens written to the cache
+            cache_read_tokens = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None) or 0
+            cache_write_tokens = getattr(usage, "cache_creation_input_tokens", None) or 0
+            return self.record(
+                model,
+                usage.prompt_tokens or 0,
+                usage.completion_tokens or 0,
+                cache_read_tokens=cache_read_tokens,
+                cache_write_tokens=cache_write_tokens,
+                cached=cached,
+                route=route,
+            )
+        from litellm import token_counter as litellm_token_counter
+
+        tokenizer_model = _tokenizer_model(model)
+        prompt_tokens = litellm_token_counter(model=tokenizer_model, messages=messages)
+        completion_tokens = litellm_token_counter(model=tokenizer_model, text=completion, count_response_tokens=True) if completion else 0
+        return self.record(model, prompt_tokens, completion_tokens, estimated=True, cached=cached, route=route)
+
+
+def _tokenizer_model(model: str) -> str:
+    # "openai/gpt-4o-mini" is looked up as a Hugging Face tokenizer, the bare model name picks tiktoken
+    from litellm import get_llm_provider as litellm_get_llm_provider
+
+    try:
+        return litellm_get_llm_provider(model)[0]
+    except Exception:
+        return model
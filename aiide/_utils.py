@@ -1,7 +1,14 @@
+import hashlib
 import inspect
-from PIL import Image
+import sys
+import threading
+import weakref
+from collections import OrderedDict
 import json
-from pandas.api.extensions import register_dataframe_accessor
+import os
+import socket
+
+MESSAGE_COLUMNS = ("role", "content", "arguments", "response")
 
 
 def find_inner_classes(cls, base_class=None):
@@ -35,131 +42,236 @@ def base64_to_image(base64_image: str):
     from PIL import Image
     import io
     import base64
+    data_url = base64_image
     base64_image = base64_image.split(",")[1]
     image = Image.open(io.BytesIO(base64.b64decode(base64_image)))
+    # keeping the original data URL so the image is sent as it came instead of being encoded again
+    image._aiide_data_url = data_url
     return image
 
-def create_messages_dataframe(messages):
-    import pandas as pd
 
-    df_messages = pd.DataFrame(
-        {
-            "role": [],
-            "content": [],
-            "arguments": [],
-            "response": [],
-        }
-    )
-    if not messages:
-        return df_messages
-    # iterate through the messages
+class LazyImage:
+    """
+    Image imported from a base64 data URL, decoded into a PIL image only when it is first used.
+
+    Attributes and methods are forwarded to the decoded PIL image, which `image` returns, so it can
+    mostly be used like one. Sending it to the LLM reuses the data URL and never decodes it.
+    """
+
+    __slots__ = ("_aiide_data_url", "_image")
+
+    def __init__(self, data_url: str):
+        self._aiide_data_url = data_url
+        self._image = None
+
+    @property
+    def image(self):
+        """
+        The decoded PIL image.
+        """
+        if self._image is None:
+            self._image = base64_to_image(self._aiide_data_url)
+        return self._image
+
+    def __getattr__(self, name):
+        # aiide's own markers are never looked up on the image, that would decode it
+        if name.startswith("_aiide"):
+            raise AttributeError(name)
+        return getattr(self.image, name)
+
+    def __repr__(self):
+        state = "decoded" if self._image is not None else f"{len(self._aiide_data_url)} bytes, not decoded"
+        return f"<aiide.LazyImage {state}>"
+
+
+class ImageCache:
+    """
+    LRU cache of encoded image data URLs with a byte budget, shared by all agents in the process.
+
+    Images are looked up by identity first and by a hash of their pixels second, so the same image
+    object or an identical copy is only JPEG encoded once. Images modified in place after they were
+    encoded keep their cached data URL, pass a copy instead.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._data_urls = OrderedDict()  # content hash -> data URL
+        self._bytes = 0
+        self._hashes = {}  # id(image) -> (weakref to image, content hash)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _content_hash(image) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{image.mode}{image.size}".encode())
+        digest.update(image.tobytes())
+        return digest.digest()
+
+    def data_url(self, image) -> str:
+        """
+        Returns the data URL of a PIL image, encoding it only if it is not cached.
+        """
+        data_url = getattr(image, "_aiide_data_url", None)
+        if data_url is not None:
+            return data_url
+        encoded = getattr(image, "_aiide_encoded", None)
+        if encoded is not None:
+            # restored from a session file with the bytes it was sent as
+            import base64
+
+            mime, data = encoded
+            image._aiide_data_url = data_url = f"data:{mime};base64,{base64.b64encode(data).decode()}"
+            return data_url
+        with self._lock:
+            entry = self._hashes.get(id(image))
+        if entry is not None and entry[0]() is image:
+            key = entry[1]
+        else:
+            key = self._content_hash(image)
+            image_id = id(image)
+            reference = weakref.ref(image, lambda _: self._forget(image_id, reference))
+            with self._lock:
+                self._hashes[image_id] = (reference, key)
+        with self._lock:
+            data_url = self._data_urls.get(key)
+            if data_url is not None:
+                self._data_urls.move_to_end(key)
+                self.hits += 1
+                return data_url
+            self.misses += 1
+        data_url = image_to_base64(image)
+        with self._lock:
+            if key not in self._data_urls:
+                self._data_urls[key] = data_url
+                self._bytes += len(data_url)
+            while self._bytes > self.max_bytes and self._data_urls:
+                _, evicted = self._data_urls.popitem(last=False)
+                self._bytes -= len(evicted)
+        return data_url
+
+    def _forget(self, image_id, reference):
+        with self._lock:
+            if self._hashes.get(image_id, (None,))[0] is reference:
+                del self._hashes[image_id]
+
+    def clear(self):
+        with self._lock:
+            self._data_urls.clear()
+            self._hashes.clear()
+            self._bytes = 0
+
+
+image_cache = ImageCache()
+
+
+def iter_jsonl(path):
+    """
+    Yields the messages of a JSONL file, one JSON object per line, without reading the whole file.
+    """
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def history_messages(history):
+    """
+    Returns an iterable of OpenAI format messages from a list or iterator of messages, or the path of a JSONL file.
+    """
+    if history is None:
+        return ()
+    if isinstance(history, (str, os.PathLike)):
+        return iter_jsonl(history)
+    return history
+
+
+def openai_messages_to_rows(messages):
+    """
+    Yields (role, content, arguments, response) rows for messages in OpenAI format, consuming them one
+    at a time so an iterator over a large history is never held in memory twice. Images are kept as
+    LazyImage and only decoded when used.
+    """
     for each_message in messages:
         if "role" in each_message:
             if each_message["role"] == "user" or each_message["role"] == "system":
                 if type(each_message["content"]) == str:
-                    df_messages = pd.concat(
-                        [
-                            df_messages,
-                            pd.DataFrame(
-                                {
-                                    "role": [each_message["role"]],
-                                    "content": [each_message["content"]],
-                                    "arguments": [None],
-                                    "response": [None],
-                                },
-                            ),
-                        ]
-                    )
+                    yield (each_message["role"], each_message["content"], None, None)
                 elif type(each_message["content"]) == list:
                     user_content = []
                     for each_content in each_message["content"]:
                         if each_content["type"] == "text":
                             user_content.append(each_content["text"])
                         elif each_content["type"] == "image_url":
-                            # converting the image base64 url to a PIL image, "url": f"data:image/jpeg;base64,{base64_image}"
-                            # convert the base64 image to a PIL image
-                            image = base64_to_image(each_content["url"])
-
-                            user_content.append(image)
-                    df_messages = pd.concat(
-                        [
-                            df_messages,
-                            pd.DataFrame(
-                                {
-                                    "role": [each_message["role"]],
-                                    "content": [user_content],
-                                    "arguments": [None],
-                                    "response": [None],
-                                },
-                            ),
-                        ]
-                    )
+                            # "url": f"data:image/jpeg;base64,{base64_image}", or nested as in the OpenAI format
+                            url = each_content["url"] if "url" in each_content else each_content["image_url"]["url"]
+                            # decoding is deferred until the image is used, sending it reuses the data URL
+                            user_content.append(LazyImage(url))
+                    yield (each_message["role"], user_content, None, None)
             elif each_message["role"] == "assistant":
                 if each_message["content"]:
-                    df_messages = pd.concat(
-                        [
-                            df_messages,
-                            pd.DataFrame(
-                                {
-                                    "role": [each_message["role"]],
-                                    "content": [each_message["content"]],
-                                    "arguments": [None],
-                                    "response": [None],
-                                },
-                            ),
-                        ]
-                    )
+                    yield (each_message["role"], each_message["content"], None, None)
                 if "tool_calls" in each_message and len(each_message["tool_calls"]) > 0:
                     for each_tool_call in each_message["tool_calls"]:
-                        df_messages = pd.concat(
-                            [
-                                df_messages,
-                                pd.DataFrame(
-                                    {
-                                        "role": ["tool"],
-                                        "content": [
-                                            {
-                                                "id": each_tool_call["id"],
-                                                "name": each_tool_call["tool"],
-                                            }
-                                        ],
-                                        "arguments": [each_tool_call["arguments"]],
-                                        "response": [each_tool_call["response"]],
-                                    },
-                                ),
-                            ]
+                        yield (
+                            "tool",
+                            {
+                                "id": each_tool_call["id"],
+                                "name": each_tool_call["tool"],
+                            },
+                            each_tool_call["arguments"],
+                            each_tool_call["response"],
                         )
-        # reset the index
-        df_messages.reset_index(drop=True, inplace=True)
-    return df_messages
+
+
+def create_messages_dataframe(messages):
+    import pandas as pd
+
+    register_accessor()
+    rows = list(openai_messages_to_rows(history_messages(messages)))
+    # building every column in one pass instead of concatenating a frame per message
+    return pd.DataFrame(
+        {column: [row[i] for row in rows] for i, column in enumerate(MESSAGE_COLUMNS)}
+    )
+
+
+def _is_image(value):
+    # PIL is only imported by the caller, if it isn't loaded yet the value can't be an image
+    if type(value) is LazyImage:
+        return True
+    image_module = sys.modules.get("PIL.Image")
+    return image_module is not None and isinstance(value, image_module.Image)
+
+
 def content_transformer(content):
     if type(content) == str:
         return content
-    elif isinstance(content, Image.Image):
-        return [{"type": "image_url", "image_url":{"url": image_to_base64(content)}}]
+    elif _is_image(content):
+        return [{"type": "image_url", "image_url":{"url": image_cache.data_url(content)}}]
     
     elif type(content) == list:
         rcontent = []
         for each_content in content:
             if type(each_content) == str:
                 rcontent.append({"type": "text", "text": each_content})
-            elif isinstance(each_content, Image.Image):
+            elif _is_image(each_content):
                 # convert the PIL image to base64
                 rcontent.append(
                     {
                         "type": "image_url",
-                        "image_url":{"url": image_to_base64(each_content)},
+                        "image_url":{"url": image_cache.data_url(each_content)},
                     }
                 )
         return rcontent
     elif type(content) == dict:
         rcontent = []
         for key, value in content.items():
-            if isinstance(value, Image.Image):
+            if _is_image(value):
                 rcontent.append(
                     {
                         "type": "image_url",
-                        "image_url": {"url": image_to_base64(value)},
+                        "image_url": {"url": image_cache.data_url(value)},
                     }
                 )
             elif type(value) == str:
@@ -168,76 +280,256 @@ def content_transformer(content):
                 raise ValueError(f"Invalid type {type(value)}")
         return rcontent
 
-@register_dataframe_accessor("aiide")
+def _same_cell(old, new):
+    # identity is the fingerprint for cells, plain values are compared by value since pandas
+    # hands out fresh objects for them (e.g. NaN in float columns)
+    if old is new:
+        return True
+    if type(old) is not type(new) or not isinstance(new, (str, int, float)):
+        return False
+    return old == new or (old != old and new != new)
+
+
+def _first_changed_row(old_columns, new_columns):
+    first = min(len(old_columns[0]), len(new_columns[0]))
+    for old, new in zip(old_columns, new_columns):
+        # list comparison checks identity before equality for every cell, so unchanged columns are
+        # compared at C speed and only a mismatch falls back to the per-cell check
+        if old[:first] == new[:first]:
+            continue
+        for i in range(first):
+            if not _same_cell(old[i], new[i]):
+                first = i
+                break
+    return first
+
+
+class OpenAIMessageCache:
+    """
+    Incrementally maintained OpenAI format of a messages DataFrame.
+
+    Every converted row is remembered together with the cell objects it was built from. On `update`
+    the DataFrame is compared against them and only the suffix starting at the first changed row is
+    converted again, so appending messages only costs the new rows.
+    Cells mutated in place (e.g. appending to a list content) keep their identity and are not
+    detected, call `invalidate()` after such edits.
+    """
+
+    def __init__(self):
+        self._columns = tuple([] for _ in MESSAGE_COLUMNS)
+        # state of the converted messages before each row: (len(messages), owner, len(owner tool_calls))
+        self._checkpoints = []
+        self._messages = []
+        # index of the assistant message the following tool rows attach to
+        self._owner = None
+
+    def invalidate(self, start: int = 0):
+        """
+        Drops the converted messages from row `start` onwards. They are rebuilt on the next `update`.
+        """
+        if start >= len(self._checkpoints):
+            return
+        length, owner, tool_calls_length = self._checkpoints[start]
+        del self._messages[length:]
+        if owner is not None:
+            if tool_calls_length is None:
+                self._messages[owner]["tool_calls"] = None
+            else:
+                del self._messages[owner]["tool_calls"][tool_calls_length:]
+        self._owner = owner
+        del self._checkpoints[start:]
+        self._columns = tuple(column[:start] for column in self._columns)
+
+    def update(self, df_messages) -> list:
+        """
+        Brings the cache up to date with `df_messages` and returns the messages in OpenAI format.
+        The returned list is new on every call but the message dicts are shared with the cache and should be treated as read-only.
+        """
+        columns = tuple(df_messages[column].tolist() for column in MESSAGE_COLUMNS)
+        return self.update_columns(columns)
+
+    def update_columns(self, columns: tuple) -> list:
+        """
+        Same as `update` but takes the message columns as lists, in the order of MESSAGE_COLUMNS.
+        """
+        self.invalidate(_first_changed_row(self._columns, columns))
+        self._columns = columns
+        return self.extend(columns)
+
+    def extend(self, columns: tuple) -> list:
+        """
+        Converts the rows added to `columns` since the last call without looking for changes, rows
+        that changed have to be dropped with `invalidate` first.
+        """
+        for row in range(len(self._checkpoints), len(columns[0])):
+            self._convert_row(*(column[row] for column in columns))
+        return list(self._messages)
+
+    def _convert_row(self, role, content, arguments, response):
+        messages = self._messages
+        owner = self._owner
+        self._checkpoints.append(
+            (
+                len(messages),
+                owner,
+                None if owner is None or messages[owner]["tool_calls"] is None else len(messages[owner]["tool_calls"]),
+            )
+        )
+        if role == "user" or role == "system":
+            messages.append(
+                {
+                    "role": role,
+                    "content": content_transformer(content),
+                }
+            )
+            if role == "user":
+                self._owner = None
+        elif role == "assistant":
+            messages.append(
+                {
+                    "role": "assistant",
+                    "content": content,
+                    "tool_calls": None,
+                }
+            )
+            # an assistant message at the very start never owns tool calls
+            self._owner = len(messages) - 1 or None
+        elif role == "tool":
+            if owner is None:
+                # adding an assistant message if there is no assistant message
+                messages.append(
+                    {
+                        "role": "assistant",
+                        "content": None,
+                        "tool_calls": None,
+                    }
+                )
+                owner = len(messages) - 1
+                self._owner = owner or None
+            owner_message = messages[owner]
+            # checking if tool_calls is None
+            if owner_message["tool_calls"] is None:
+                owner_message["tool_calls"] = []
+            owner_message["tool_calls"].append(
+                {
+                    "id": content["id"],
+                    "function": {
+                        "name": content["name"],
+                        "arguments": arguments,
+                    },
+                    "type": "function",
+                }
+            )
+            messages.append(
+                {
+                    "role": "tool",
+                    "tool_call_id": content["id"],
+                    "name": content["name"],
+                    "content": content_transformer(response),
+                }
+            )
+
+
 class CustomConverter:
     def __init__(self, pandas_obj):
         self.df_messages = pandas_obj  # Reference to the DataFrame
         # reset index
         self.df_messages.reset_index(drop=True, inplace=True)
+        # pandas keeps the accessor alive with the DataFrame, so repeated conversions are incremental
+        self._cache = OpenAIMessageCache()
 
     def to_openai_dict(self):
-        openai_json = {
-            "messages": [],
-        }
-        for index, row in self.df_messages.iterrows():
-            if row["role"] == "user" or row["role"] == "system":
-                content = content_transformer(row["content"])
-                openai_json["messages"].append(
-                    {
-                        "role": row["role"],
-                        "content": content,
-                    }
-                )
-            elif row["role"] == "assistant":
-                openai_json["messages"].append(
-                    {
-                        "role": "assistant",
-                        "content": row["content"],
-                        "tool_calls": None,
-                    }
-                )
-            elif row["role"] == "tool":
-                # finding the index of the last assistant message
-                i = 0
-                for i in range(len(openai_json["messages"]) - 1, -1, -1):
-                    if openai_json["messages"][i]["role"] == "user":
-                        i = 0
-                        break
-                    if openai_json["messages"][i]["role"] == "assistant":
-                        break
-                if i == 0:
-                    # adding an assistant message if there is no assistant message
-                    # print("adding an assistant message")
-                    openai_json["messages"].append(
-                        {
-                            "role": "assistant",
-                            "content": None,
-                            "tool_calls": None,
-                        }
-                    )
-                    i = len(openai_json["messages"]) - 1
-                # checking if tool_calls is None
-                if openai_json["messages"][i]["tool_calls"] is None:
-                    openai_json["messages"][i]["tool_calls"] = []
-                openai_json["messages"][i]["tool_calls"].append(
-                    {
-                        "id": row["content"]["id"],
-                        "function": {
-                            "name": row["content"]["name"],
-                            "arguments": row["arguments"],
-                        },
-                        "type": "function",
-                    }
-                )
-                openai_json["messages"].append(
-                    {
-                        "role": "tool",
-                        "tool_call_id": row["content"]["id"],
-                        "name": row["content"]["name"],
-                        "content": content_transformer(row["response"]),
-                    }
-                )
-        return openai_json["messages"]
+        return self._cache.update(self.df_messages)
+
+
+_accessor_registered = False
+
+
+def register_accessor():
+    """
+    Registers the `DataFrame.aiide` accessor, importing pandas if needed.
+    """
+    global _accessor_registered
+    if not _accessor_registered:
+        from pandas.api.extensions import register_dataframe_accessor
+
+        register_dataframe_accessor("aiide")(CustomConverter)
+        _accessor_registered = True
+
+
+# DataFrames built before aiide is used get the accessor right away when pandas is already loaded,
+# otherwise it is registered on first use so that importing aiide doesn't import pandas
+if "pandas" in sys.modules:
+    register_accessor()
+
+# HTTP statuses worth retrying: timeouts, conflicts, rate limits and server errors
+_TRANSIENT_STATUS = frozenset((408, 409, 429, 500, 502, 503, 504))
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """
+    Whether a failed LLM call is worth retrying: rate limits, timeouts, connection and server errors.
+    """
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    if getattr(error, "status_code", None) in _TRANSIENT_STATUS:
+        return True
+    # litellm is loaded by then if the error came from an LLM call
+    litellm = sys.modules.get("litellm")
+    return litellm is not None and isinstance(
+        error,
+        (litellm.RateLimitError, litellm.APIConnectionError, litellm.Timeout, litellm.InternalServerError, litellm.ServiceUnavailableError),
+    )
+
+
+def close_stream(response):
+    """
+    Closes a streamed completion the caller stopped reading, releasing its connection.
+    """
+    # litellm's stream wrapper has no close of its own, the OpenAI SDK stream it wraps does
+    for stream in (response, getattr(response, "completion_stream", None)):
+        close = getattr(stream, "close", None)
+        if close is not None and not inspect.iscoroutinefunction(close):
+            try:
+                close()
+            except Exception:
+                pass
+            return
+
+
+def abort_stream(response):
+    """
+    Aborts a streamed completion from any thread, unblocking a read waiting on it in another thread: its socket
+    is shut down so the read fails right away, and the connection isn't reused.
+    """
+    # our wrappers keep the stream in `response`, litellm's in `completion_stream`, the OpenAI SDK's its httpx response
+    for _ in range(8):
+        if response is None:
+            return
+        network_stream = (getattr(response, "extensions", None) or {}).get("network_stream")
+        if network_stream is not None:
+            sock = network_stream.get_extra_info("socket")
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            return
+        response = getattr(response, "response", None) or getattr(response, "completion_stream", None)
+
+
+async def aclose_stream(response):
+    for stream in (response, getattr(response, "completion_stream", None)):
+        close = getattr(stream, "aclose", None) or getattr(stream, "close", None)
+        if close is not None:
+            try:
+                closed = close()
+                if inspect.isawaitable(closed):
+                    await closed
+            except Exception:
+                pass
+            return
+
 
 def parse_json(s, strict=True):
     def on_extra_token(text, data, reminding):
@@ -1,13 +1,170 @@
-class Num:
+import abc
+import json
+import threading
+from collections import OrderedDict
+
+__all__ = [
+    "CompiledSchema",
+    "Num",
+    "Float",
+    "Str",
+    "Bool",
+    "Object",
+    "Array",
+    "AnyOf",
+    "Nullable",
+    "tool_def_gen",
+    "structured_outputs_gen",
+]
+
+
+class CompiledSchema:
     """
-    Defines an integer field for a JSON schema.
+    A compiled, immutable JSON schema, returned by the `compile` method of the field classes.
 
-    Attributes:
-        name (str): The name of the field.
-        description (str, optional): A description of the field.
-        enums (list, optional): A list of allowed values for the field.
+    Compiled schemas are hash-consed: compiling identical field trees, even from different tools, returns
+    the same CompiledSchema. Its JSON dict and serialized bytes are built once and shared, `json()` returns
+    a copy of the dict the caller is free to modify.
     """
 
+    __slots__ = ("_json", "_bytes")
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CompiledSchema is immutable")
+
+    def json(self) -> dict:
+        """
+        Returns a copy of the JSON schema as a dictionary.
+        """
+        return _copy(self._json)
+
+    @property
+    def json_bytes(self) -> bytes:
+        """
+        The JSON schema serialized to compact UTF-8 encoded JSON.
+        """
+        if self._bytes is None:
+            object.__setattr__(self, "_bytes", json.dumps(self._json, separators=(",", ":")).encode())
+        return self._bytes
+
+    def __repr__(self):
+        return f"CompiledSchema({self._json!r})"
+
+
+# compiled schemas by their structure, the oldest ones are dropped past _MAX_COMPILED
+_MAX_COMPILED = 10_000
+_compiled = OrderedDict()
+_compiled_lock = threading.Lock()
+
+
+def _copy(value):
+    if type(value) is dict:
+        return {key: _copy(each) for key, each in value.items()}
+    if type(value) is list:
+        return [_copy(each) for each in value]
+    return value
+
+
+def _freeze(value):
+    # enums and required lists are usually plain strings and used as they are
+    if type(value) is list or type(value) is tuple:
+        frozen = tuple(value)
+        for each in frozen:
+            if type(each) is not str:
+                return tuple(_freeze(each) for each in frozen)
+        return frozen
+    if isinstance(value, dict):
+        return ("dict",) + tuple((key, _freeze(each)) for key, each in value.items())
+    if value is None or isinstance(value, str):
+        return value
+    # 1, 1.0 and True are equal as keys but not as JSON
+    return (type(value), value)
+
+
+def _intern(key, build) -> CompiledSchema:
+    with _compiled_lock:
+        schema = _compiled.get(key)
+        if schema is None:
+            schema = object.__new__(CompiledSchema)
+            object.__setattr__(schema, "_json", build(key))
+            object.__setattr__(schema, "_bytes", None)
+            _compiled[key] = schema
+            if len(_compiled) > _MAX_COMPILED:
+                _compiled.popitem(last=False)
+        return schema
+
+
+def _compile(field) -> CompiledSchema:
+    if isinstance(field, _Field):
+        return field.compile()
+    # any other object with a json() method returning {name: schema}
+    schema = next(iter(field.json().values()))
+    key = ("json", _freeze(schema))
+    return _compiled.get(key) or _intern(key, lambda key: schema)
+
+
+# bumped when an attribute of a compiled field is set, the schemas cached on fields are valid until then
+_generation = 0
+
+# list attributes, kept as tuples so that a field can only change by having an attribute set
+_SEQUENCES = frozenset(("properties", "enums", "required", "options"))
+
+
+class _Field(abc.ABC):
+    # compile() builds a hashable key from the field's attributes and compiled children, the schema is
+    # only built by _build(key) the first time the key is seen. The schema is also cached on the field, so
+    # the key isn't built again until an attribute of a compiled field is set.
+    _compiled_at = -1
+    _compiled_schema = None
+
+    def __setattr__(self, name, value):
+        global _generation
+        if name in _SEQUENCES and isinstance(value, list):
+            value = tuple(value)
+        object.__setattr__(self, name, value)
+        if self._compiled_schema is not None and not name.startswith("_"):
+            _generation += 1
+
+    def compile(self) -> CompiledSchema:
+        """
+        Returns the compiled schema of this field, its children are compiled first.
+        """
+        generation = _generation
+        if self._compiled_at == generation:
+            return self._compiled_schema
+        key = self._key()
+        schema = _compiled.get(key) or _intern(key, self._build)
+        self._compiled_schema = schema
+        self._compiled_at = generation
+        return schema
+
+    @abc.abstractmethod
+    def _key(self) -> tuple:
+        """
+        The hashable key of the schema, from the field's attributes and its compiled children.
+        """
+        pass
+
+    @abc.abstractmethod
+    def _build(self, key) -> dict:
+        """
+        Builds the JSON schema of the key.
+        """
+        pass
+
+    def json(self):
+        """
+        Returns a dictionary mapping the field name to its JSON schema.
+
+        Returns:
+            dict: The JSON schema for this field.
+        """
+        return {self.name: self.compile().json()}
+
+
+class _Scalar(_Field):
+    _type = ""
+
     def __init__(
         self, name: str, description: str | None = None, enums: list | None = None
     ):
@@ -15,24 +172,21 @@ class Num:
         self.description = description
         self.enums = enums
 
-    def json(self):
-        """
-        Returns a dictionary representing the JSON schema for this integer field.
+    def _key(self):
+        return (self._type, self.description or None, _freeze(self.enums) if self.enums else None)
 
-        Returns:
-            dict: The JSON schema for this integer field.
-        """
-        schema = {"type": "integer"}
+    def _build(self, key):
+        schema = {"type": self._type}
         if self.description:
             schema["description"] = self.description
         if self.enums:
-            schema["enum"] = self.enums
-        return {self.name: schema}
+            schema["enum"] = list(self.enums)
+        return schema
 
 
-class Float:
+class Num(_Scalar):
     """
-    Defines a float field for a JSON schema.
+    Defines an integer field for a JSON schema.
 
     Attributes:
         name (str): The name of the field.
@@ -40,29 +194,23 @@ class Float:
         enums (list, optional): A list of allowed values for the field.
     """
 
-    def __init__(
-        self, name: str, description: str | None = None, enums: list | None = None
-    ):
-        self.name = name
-        self.description = description
-        self.enums = enums
+    _type = "integer"
 
-    def json(self):
-        """
-        Returns a dictionary representing the JSON schema for this float field.
 
-        Returns:
-            dict: The JSON schema for this float field.
-        """
-        schema = {"type": "number"}
-        if self.description:
-            schema["description"] = self.description
-        if self.enums:
-            schema["enum"] = self.enums
-        return {self.name: schema}
+class Float(_Scalar):
+    """
+    Defines a float field for a JSON schema.
+
+    Attributes:
+        name (str): The name of the field.
+        description (str, optional): A description of the field.
+        enums (list, optional): A list of allowed values for the field.
+    """
 
+    _type = "number"
 
-class Str:
+
+class Str(_Scalar):
     """
     Defines a string field for a JSON schema.
 
@@ -72,29 +220,10 @@ class Str:
         enums (list, optional): A list of allowed values for the field.
     """
 
-    def __init__(
-        self, name: str, description: str | None = None, enums: list | None = None
-    ):
-        self.name = name
-        self.description = description
-        self.enums = enums
-
-    def json(self):
-        """
-        Returns a dictionary representing the JSON schema for this string field.
+    _type = "string"
 
-        Returns:
-            dict: The JSON schema for this string field.
-        """
-        schema = {"type": "string"}
-        if self.description:
-            schema["description"] = self.description
-        if self.enums:
-            schema["enum"] = self.enums
-        return {self.name: schema}
 
-
-class Bool:
+class Bool(_Scalar):
     """
     Defines a boolean field for a JSON schema.
 
@@ -104,29 +233,10 @@ class Bool:
         enums (list, optional): A list of allowed values for the field.
     """
 
-    def __init__(
-        self, name: str, description: str | None = None, enums: list | None = None
-    ):
-        self.name = name
-        self.description = description
-        self.enums = enums
-
-    def json(self):
-        """
-        Returns a dictionary representing the JSON schema for this boolean field.
+    _type = "boolean"
 
-        Returns:
-            dict: The JSON schema for this boolean field.
-        """
-        schema = {"type": "boolean"}
-        if self.description:
-            schema["description"] = self.description
-        if self.enums:
-            schema["enum"] = self.enums
-        return {self.name: schema}
 
-
-class Object:
+class Object(_Field):
     """
     Defines a dictionary field for a JSON schema.
 
@@ -151,29 +261,30 @@ class Object:
         self.enums = enums
         self.required = required
 
-    def json(self):
-        """
-        Returns a dictionary representing the JSON schema for this dictionary field.
+    def _key(self):
+        return (
+            "object",
+            self.description or None,
+            tuple([(prop.name, _compile(prop)) for prop in self.properties]) if self.properties else None,
+            _freeze(self.enums) if self.enums else None,
+            _freeze(self.required) if self.required else None,
+        )
 
-        Returns:
-            dict: The JSON schema for this dictionary field.
-        """
+    def _build(self, key):
         schema: dict = {"type": "object"}
         if self.description:
             schema["description"] = self.description
-        if self.properties:
-            schema["properties"] = {
-                prop.name: next(iter(prop.json().values())) for prop in self.properties
-            }
+        if key[2]:
+            schema["properties"] = {name: prop._json for name, prop in key[2]}
         if self.enums:
-            schema["enum"] = self.enums
+            schema["enum"] = list(self.enums)
         if self.required:
-            schema["required"] = self.required
+            schema["required"] = list(self.required)
         schema["additionalProperties"] = False
-        return {self.name: schema}
+        return schema
 
 
-class Array:
+class Array(_Field):
     """
     Defines a list field for a JSON schema.
 
@@ -196,24 +307,26 @@ class Array:
         self.items = item
         self.enums = enums
 
-    def json(self):
-        """
-        Returns a dictionary representing the JSON schema for this list field.
+    def _key(self):
+        return (
+            "array",
+            self.description or None,
+            _compile(self.items) if self.items else None,
+            _freeze(self.enums) if self.enums else None,
+        )
 
-        Returns:
-            dict: The JSON schema for this list field.
-        """
+    def _build(self, key):
         schema = {"type": "array"}
         if self.description:
             schema["description"] = self.description
-        if self.items:
-            schema["items"] = next(iter(self.items.json().values()))
+        if key[2]:
+            schema["items"] = key[2]._json
         if self.enums:
-            schema["enum"] = self.enums
-        return {self.name: schema}
+            schema["enum"] = list(self.enums)
+        return schema
 
 
-class AnyOf:
+class AnyOf(_Field):
     """
     Defines an anyOf field for a JSON schema.
 
@@ -227,19 +340,14 @@ class AnyOf:
         self.name = name
         self.options = options
 
-    def json(self):
-        """
-        Returns a dictionary representing the JSON schema for this anyOf field.
+    def _key(self):
+        return ("anyOf", tuple([_compile(option) for option in self.options]))
 
-        Returns:
-            dict: The JSON schema for this anyOf field.
-        """
-        schema = {
-            "anyOf": [next(iter(option.json().values())) for option in self.options]
-        }
-        return {self.name: schema}
+    def _build(self, key):
+        return {"anyOf": [option._json for option in key[1]]}
 
-class Nullable:
+
+class Nullable(_Field):
     """
     Makes the direct child of this object nullable
 
@@ -249,10 +357,19 @@ class Nullable:
 
     def __init__(self, child: Str | Num | Float | Bool | Object | Array):
         self.child = child
-    def json(self):
-        schema = self.child.json()
-        schema[self.child.name]["type"] = [schema[self.child.name]["type"], "null"] 
-        return schema
+
+    @property
+    def name(self) -> str:
+        return self.child.name
+
+    def _key(self):
+        return ("nullable", _compile(self.child))
+
+    def _build(self, key):
+        # the compiled schema of the child with "null" added to its type, in a new dict
+        child = key[1]._json
+        return {name: [child["type"], "null"] if name == "type" else value for name, value in child.items()}
+
 
 def tool_def_gen(
     name: str,
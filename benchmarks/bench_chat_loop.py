@@ -0,0 +1,210 @@
+"""
+Framework overhead of the chat loop, measured offline against the fake streaming backend.
+
+- per_chunk: time spent by chat() per streamed chunk for text, tool call and structured output streams
+- turns_per_second: complete text turns and tool turns (tool calls, tool run and answer) per second
+- memory: traced memory as the conversation grows, per turn
+- to_openai_dict: cost of bringing the request messages up to date after a new message, and of a full
+  conversion, as the history grows from 10 to 10,000 messages
+
+Results are printed as tables and, with --json, written to a file for tracking regressions.
+
+    python -m benchmarks.bench_chat_loop --json results.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+# the model cost map is otherwise downloaded when litellm is first imported for the usage cost
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+
+import aiide
+from aiide import Aiide, Tool
+from aiide._utils import OpenAIMessageCache
+from aiide.schema import Array, Num, Object, Str, structured_outputs_gen, tool_def_gen
+
+from .fake_backend import FakeBackend, structured_stream, text_stream, tool_stream
+
+CHUNK_SIZES = [1, 4, 16, 64]
+HISTORY_SIZES = [10, 100, 1_000, 10_000]
+
+
+class WeatherTool(Tool):
+    def __init__(self, parent):
+        pass
+
+    def tool_def(self):
+        return tool_def_gen(
+            name="get_current_weather",
+            description="Get the current weather in a given location",
+            properties=[Str(name="location"), Str(name="notes")],
+        )
+
+    def main(self, location, notes=""):
+        return json.dumps({"location": location, "temperature": 72})
+
+
+class Agent(Aiide):
+    def __init__(self):
+        self.weatherTool = WeatherTool(self)
+        self.setup(system_message="You are a helpful assistant.", model="gpt-4o-mini")
+
+    def structured_outputs(self):
+        return structured_outputs_gen(
+            name="forecast",
+            properties=[Array(name="days", item=Object(name="day", properties=[Str(name="summary"), Num(name="temperature")]))],
+            required=["days"],
+        )
+
+
+def answer(length=4_000):
+    return ("It is sunny and 72 degrees in San Francisco today. " * (length // 50 + 1))[:length]
+
+
+def tool_calls(count=4, notes=500):
+    return [("get_current_weather", {"location": f"City {index}", "notes": "n" * notes}) for index in range(count)]
+
+
+def forecast(length=4_000):
+    days = []
+    while len(json.dumps({"days": days})) < length:
+        days.append({"summary": f"Sunny with a light breeze on day {len(days)}", "temperature": 72})
+    return {"days": days}
+
+
+def turn_streams(kind, chunk_size):
+    """
+    Streams served for one chat() turn of the given kind.
+    """
+    if kind == "text":
+        return [text_stream(answer(), chunk_size)]
+    if kind == "tool":
+        return [tool_stream(tool_calls(), chunk_size), text_stream(answer(400), chunk_size)]
+    return [structured_stream(forecast(), chunk_size)]
+
+
+def run_turn(agent, kind):
+    if kind == "tool":
+        deltas = agent.chat("What's the weather like?", tools=[agent.weatherTool])
+    else:
+        deltas = agent.chat("What's the weather like?", json_mode=kind == "structured")
+    for _ in deltas:
+        pass
+
+
+def bench_per_chunk(repeat):
+    results = []
+    for kind in ("text", "tool", "structured"):
+        for chunk_size in CHUNK_SIZES:
+            streams = turn_streams(kind, chunk_size)
+            chunks = sum(len(stream) for stream in streams)
+            best = float("inf")
+            for _ in range(repeat):
+                agent = Agent()
+                with FakeBackend(list(streams)):
+                    start = time.perf_counter()
+                    run_turn(agent, kind)
+                    best = min(best, time.perf_counter() - start)
+            results.append({"stream": kind, "chunk_size": chunk_size, "chunks": chunks, "us_per_chunk": best / chunks * 1e6})
+    return results
+
+
+def bench_turns_per_second(turns):
+    results = []
+    for kind in ("text", "tool"):
+        streams = turn_streams(kind, 4) if kind == "tool" else [text_stream(answer(200), 4)]
+        served = iter(range(len(streams) * turns))
+        agent = Agent()
+        with FakeBackend(lambda request: streams[next(served) % len(streams)]):
+            start = time.perf_counter()
+            for _ in range(turns):
+                run_turn(agent, kind)
+            elapsed = time.perf_counter() - start
+        results.append({"turn": kind, "turns": turns, "turns_per_second": turns / elapsed, "messages": len(agent._store)})
+    return results
+
+
+def bench_memory(turns, checkpoints=4):
+    stream = text_stream(answer(200), 4)
+    agent = Agent()
+    results = []
+    with FakeBackend(lambda request: stream):
+        run_turn(agent, "text")
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        done = 0
+        for checkpoint in range(1, checkpoints + 1):
+            while done < turns * checkpoint // checkpoints:
+                run_turn(agent, "text")
+                done += 1
+            current = tracemalloc.get_traced_memory()[0]
+            results.append({"turns": done, "messages": len(agent._store), "bytes": current - baseline, "bytes_per_turn": (current - baseline) / done})
+        tracemalloc.stop()
+    return results
+
+
+def bench_to_openai_dict(appends=20):
+    results = []
+    for size in HISTORY_SIZES:
+        agent = Agent()
+        rows = [("user", f"What's the weather like in city {i}?", None, None) if i % 2 else ("assistant", answer(200), None, None) for i in range(size - 1)]
+        agent._store.extend(rows)
+        start = time.perf_counter()
+        agent._store.to_openai_dict()
+        first = time.perf_counter() - start
+        incremental = 0.0
+        for i in range(appends):
+            agent._store.append("user", f"And in city {i}?")
+            start = time.perf_counter()
+            agent._store.to_openai_dict()
+            incremental += time.perf_counter() - start
+        start = time.perf_counter()
+        OpenAIMessageCache().extend(agent._store._columns)
+        full = time.perf_counter() - start
+        results.append({"messages": size, "first_ms": first * 1e3, "incremental_ms": incremental / appends * 1e3, "full_ms": full * 1e3})
+    return results
+
+
+def print_table(title, rows):
+    print(f"\n{title}")
+    columns = list(rows[0])
+    print(" ".join(f"{column:>16}" for column in columns))
+    for row in rows:
+        print(" ".join(f"{value:>16.3f}" if isinstance(value, float) else f"{value:>16}" for value in row.values()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--quick", action="store_true", help="fewer repetitions, for a smoke run")
+    args = parser.parse_args(argv)
+    # warming up the lazy imports and caches outside of the measurements
+    with FakeBackend(lambda request: text_stream("Hello", 4)):
+        run_turn(Agent(), "text")
+    results = {
+        "per_chunk": bench_per_chunk(repeat=1 if args.quick else 5),
+        "turns_per_second": bench_turns_per_second(turns=20 if args.quick else 500),
+        "memory": bench_memory(turns=40 if args.quick else 2_000),
+        "to_openai_dict": bench_to_openai_dict(appends=5 if args.quick else 20),
+    }
+    for name, rows in results.items():
+        print_table(name, rows)
+    if args.json:
+        report = {
+            "aiide": aiide.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "results": results,
+        }
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
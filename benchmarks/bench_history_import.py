@@ -0,0 +1,119 @@
+"""
+Scaling of importing a conversation history in OpenAI format, from 100 to 50,000 messages.
+
+- list: setup(history_openai_format=[...]) with the messages in memory
+- jsonl: setup(history_openai_format="history.jsonl"), streaming the file line by line
+- dataframe: create_messages_dataframe(messages)
+- concat: one pd.concat per message, the way the history used to be imported (up to 5,000 messages)
+
+Every 10th user message carries an image, which is kept as a data URL and not decoded. The time
+per message should stay flat as the history grows.
+
+    python -m benchmarks.bench_history_import
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+from PIL import Image
+
+from aiide import Aiide
+from aiide._utils import ImageCache, create_messages_dataframe, openai_messages_to_rows
+
+SIZES = [100, 1_000, 5_000, 10_000, 50_000]
+CONCAT_MAX_SIZE = 5_000
+
+
+class Agent(Aiide):
+    def __init__(self, history):
+        self.setup(model="gpt-4o-mini", history_openai_format=history)
+
+
+def history(size):
+    data_url = ImageCache().data_url(Image.new("RGB", (256, 256), "blue"))
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    turn = 0
+    while len(messages) < size:
+        if turn % 10:
+            messages.append({"role": "user", "content": f"What's the weather like in city {turn}?"})
+        else:
+            content = [{"type": "text", "text": "What's the weather like here?"}, {"type": "image_url", "url": data_url}]
+            messages.append({"role": "user", "content": content})
+        messages.append(
+            {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {
+                        "id": f"call_{turn}",
+                        "tool": "get_current_weather",
+                        "arguments": json.dumps({"location": f"city {turn}"}),
+                        "response": json.dumps({"temperature": 72}),
+                    }
+                ],
+            }
+        )
+        messages.append({"role": "assistant", "content": f"It is 72 degrees in city {turn}."})
+        turn += 1
+    return messages[:size]
+
+
+def concat_import(messages):
+    df = pd.DataFrame({"role": [], "content": [], "arguments": [], "response": []})
+    for role, content, arguments, response in openai_messages_to_rows(messages):
+        row = pd.DataFrame({"role": [role], "content": [content], "arguments": [arguments], "response": [response]})
+        df = pd.concat([df, row])
+    return df
+
+
+def timed(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench(size, directory, repeat):
+    messages = history(size)
+    path = os.path.join(directory, f"history_{size}.jsonl")
+    with open(path, "w") as file:
+        for message in messages:
+            file.write(json.dumps(message) + "\n")
+    result = {"messages": size}
+    timings = {
+        "list": lambda: Agent(messages),
+        "jsonl": lambda: Agent(path),
+        "dataframe": lambda: create_messages_dataframe(messages),
+    }
+    if size <= CONCAT_MAX_SIZE:
+        timings["concat"] = lambda: concat_import(messages)
+    for name, function in timings.items():
+        elapsed = timed(function, repeat if name != "concat" else 1)
+        result[f"{name}_ms"] = elapsed * 1e3
+        result[f"{name}_us_per_message"] = elapsed / size * 1e6
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--quick", action="store_true", help="smaller histories, for a smoke run")
+    args = parser.parse_args(argv)
+    sizes = SIZES[:3] if args.quick else SIZES
+    with tempfile.TemporaryDirectory() as directory:
+        results = [bench(size, directory, repeat=1 if args.quick else 3) for size in sizes]
+    print(f"{'messages':>10} {'list ms':>10} {'jsonl ms':>10} {'df ms':>10} {'concat ms':>10}  us/message (list, jsonl, df, concat)")
+    for result in results:
+        concat = f"{result['concat_ms']:>10.1f}" if "concat_ms" in result else f"{'-':>10}"
+        per_message = ", ".join(f"{result[key]:.1f}" for key in result if key.endswith("us_per_message"))
+        print(f"{result['messages']:>10} {result['list_ms']:>10.1f} {result['jsonl_ms']:>10.1f} {result['dataframe_ms']:>10.1f} {concat}  {per_message}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
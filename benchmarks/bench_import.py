@@ -0,0 +1,46 @@
+"""
+Import time of aiide, measured in a fresh interpreter for every run.
+
+Importing aiide must not import litellm, pandas, PIL, openai or jiter, those are deferred until an
+agent is set up or chats. Exits with status 1 when a budget is exceeded or a heavy module is imported.
+Use `python -X importtime -c "from aiide import Aiide"` to see where the time goes.
+
+    python -m benchmarks.bench_import
+"""
+import subprocess
+import sys
+
+# best of RUNS, in milliseconds
+BUDGETS = {
+    "import aiide.schema": 30,
+    "from aiide import Aiide, Tool": 150,
+}
+HEAVY_MODULES = ("litellm", "openai", "pandas", "PIL", "jiter", "numpy")
+RUNS = 5
+
+
+def import_time(statement):
+    """
+    Returns the time `statement` takes in milliseconds and the heavy modules it imported.
+    """
+    script = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        f"{statement}\n"
+        "elapsed = (time.perf_counter() - start) * 1000\n"
+        f"print(elapsed, *[module for module in {HEAVY_MODULES!r} if module in sys.modules])\n"
+    )
+    milliseconds, *heavy = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout.split()
+    return float(milliseconds), heavy
+
+
+if __name__ == "__main__":
+    failed = False
+    print(f"{'statement':<32} {'best (ms)':>10} {'budget (ms)':>12}  heavy modules")
+    for statement, budget in BUDGETS.items():
+        runs = [import_time(statement) for _ in range(RUNS)]
+        best = min(milliseconds for milliseconds, _ in runs)
+        heavy = runs[0][1]
+        failed |= best > budget or bool(heavy)
+        print(f"{statement:<32} {best:>10.1f} {budget:>12}  {', '.join(heavy) or '-'}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,87 @@
+"""
+Per-turn cost of building the OpenAI format history as the conversation grows.
+
+Each turn appends a user message, two tool calls and an assistant answer, building the request
+messages before each of the turn's two LLM calls.
+
+- store: what Aiide.chat() does, `MessageStore.append`/`set` and `MessageStore.to_openai_dict()`,
+  which only converts the rows appended since the previous call. What still grows with the history
+  is the copy of the message list handed to each request, about 0.1 ms per call at 10k messages
+- dataframe: the `df.aiide.to_openai_dict()` accessor on a DataFrame of the history, incremental too
+  but comparing every row of the DataFrame to find the changed ones
+- full: the whole history converted from scratch, the way every turn used to
+
+    python -m benchmarks.bench_openai_messages
+"""
+import time
+
+import pandas as pd
+
+from aiide._store import MessageStore
+from aiide._utils import MESSAGE_COLUMNS, OpenAIMessageCache
+
+SIZES = [10, 100, 1_000, 10_000]
+
+
+def turn_rows(turn):
+    return [
+        ("user", f"What's the weather like in city {turn}?", None, None),
+        ("tool", {"name": "get_current_weather", "id": f"call_{turn}_a"}, '{"location": "a"}', '{"temperature": 72}'),
+        ("tool", {"name": "get_current_weather", "id": f"call_{turn}_b"}, '{"location": "b"}', '{"temperature": 10}'),
+        ("assistant", f"It is 72 degrees in city {turn}.", None, None),
+    ]
+
+
+def history(size):
+    rows = [("system", "You are a helpful assistant.", None, None)]
+    turn = 0
+    while len(rows) < size:
+        rows.extend(turn_rows(turn))
+        turn += 1
+    return rows[:size]
+
+
+def store_turn(store, rows):
+    # the order chat() writes in: the user message, the tool calls answered one by one, the answer
+    user, *tools, assistant = rows
+    store.append(*user)
+    store.to_openai_dict()
+    for role, content, arguments, response in tools:
+        row = store.append(role, content, arguments)
+        store.set(row, "response", response)
+    store.to_openai_dict()
+    store.append(*assistant)
+
+
+def bench(size, turns=20):
+    rows = history(size)
+    store = MessageStore(rows)
+    store.to_openai_dict()
+    df = pd.DataFrame(rows, columns=list(MESSAGE_COLUMNS))
+    cache = OpenAIMessageCache()
+    cache.update(df)
+    incremental = dataframe = full = 0.0
+    for turn in range(turns):
+        new_rows = turn_rows(size + turn)
+        start = time.perf_counter()
+        store_turn(store, new_rows)
+        incremental += time.perf_counter() - start
+        user, *tools, assistant = new_rows
+        for added in ([user], tools):
+            # the copies made by concat are the cost of keeping the history in a DataFrame, not of converting it
+            df = pd.concat([df, pd.DataFrame(added, columns=df.columns)], ignore_index=True)
+            start = time.perf_counter()
+            cache.update(df)
+            dataframe += time.perf_counter() - start
+            start = time.perf_counter()
+            OpenAIMessageCache().update(df)
+            full += time.perf_counter() - start
+        df = pd.concat([df, pd.DataFrame([assistant], columns=df.columns)], ignore_index=True)
+    return incremental / turns, dataframe / turns, full / turns
+
+
+if __name__ == "__main__":
+    print(f"{'messages':>10} {'store (ms)':>12} {'dataframe (ms)':>16} {'full (ms)':>12}")
+    for size in SIZES:
+        incremental, dataframe, full = bench(size)
+        print(f"{size:>10} {incremental * 1e3:>12.3f} {dataframe * 1e3:>16.3f} {full * 1e3:>12.3f}")
@@ -0,0 +1,60 @@
+"""
+Cost of yielding the partial structured output on every chunk of a ~50 KB response.
+
+`jiter` re-parses the whole accumulated text on every chunk the way chat() used to, `incremental`
+feeds only the new chunk to PartialJSONParser.
+
+    python -m benchmarks.bench_partial_json
+"""
+import json
+import time
+
+from jiter import from_json
+
+from aiide._partial_json import PartialJSONParser
+
+CHUNK_SIZES = [4, 16, 64]
+
+
+def document(size=50_000):
+    items = []
+    doc = {"thinking": "Let me break the question down step by step. " * 40, "items": items}
+    while len(json.dumps(doc)) < size:
+        items.append(
+            {
+                "title": f"Item {len(items)}",
+                "tags": ["#weather", "#forecast", "#city"],
+                "score": len(items) * 0.5,
+                "done": len(items) % 2 == 0,
+                "note": None,
+            }
+        )
+    return json.dumps(doc)
+
+
+def bench_jiter(chunks):
+    text = ""
+    for chunk in chunks:
+        text += chunk
+        from_json(text.encode(), partial_mode=True)
+
+
+def bench_incremental(chunks):
+    parser = PartialJSONParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+        parser.value()
+
+
+if __name__ == "__main__":
+    doc = document()
+    print(f"document: {len(doc) / 1000:.1f} KB")
+    print(f"{'chunk size':>10} {'chunks':>8} {'jiter (ms)':>12} {'incremental (ms)':>18}")
+    for size in CHUNK_SIZES:
+        chunks = [doc[i : i + size] for i in range(0, len(doc), size)]
+        timings = []
+        for bench in (bench_jiter, bench_incremental):
+            start = time.perf_counter()
+            bench(chunks)
+            timings.append(time.perf_counter() - start)
+        print(f"{size:>10} {len(chunks):>8} {timings[0] * 1e3:>12.1f} {timings[1] * 1e3:>18.1f}")
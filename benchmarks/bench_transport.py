@@ -0,0 +1,95 @@
+"""
+Time to first chunk of chat turns with and without the pooled HTTP transport, against the local OpenAI stub.
+
+- connect: every turn on a new connection, the cost paid without keep-alive
+- litellm: litellm's own clients (transport=None, the default)
+- pooled: a shared Transport, prewarmed before the first turn
+
+Turns run one after another and from several threads at once, and p50/p99 of the time from the
+chat() call to the first delta are printed per mode. The stub runs on localhost, so the connection
+setup measured here is a lower bound of what a remote provider (DNS, TCP and TLS) costs.
+
+    python -m benchmarks.bench_transport
+"""
+import argparse
+import concurrent.futures
+import os
+import statistics
+import sys
+import time
+
+# the model cost map is otherwise downloaded when litellm is first imported for the usage cost
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+
+from aiide import Aiide, Transport
+
+from tests.openai_stub import OpenAIStub, text_response
+
+MODES = ["connect", "litellm", "pooled"]
+
+
+class Agent(Aiide):
+    def __init__(self, base_url, transport):
+        self.setup(model="openai/gpt-4o-mini", api_key="sk-bench", api_base=base_url, transport=transport)
+
+
+def first_chunk_seconds(agent):
+    start = time.perf_counter()
+    deltas = agent.chat("What's the weather like?")
+    next(deltas)
+    elapsed = time.perf_counter() - start
+    for _ in deltas:
+        pass
+    return elapsed
+
+
+def turn(base_url, mode, pooled):
+    if mode == "connect":
+        transport = Transport()
+        try:
+            return first_chunk_seconds(Agent(base_url, transport))
+        finally:
+            transport.close()
+    return first_chunk_seconds(Agent(base_url, pooled if mode == "pooled" else None))
+
+
+def percentile(samples, q):
+    return statistics.quantiles(samples, n=100, method="inclusive")[q - 1] if len(samples) > 1 else samples[0]
+
+
+def bench(mode, turns, threads):
+    with OpenAIStub(lambda body: text_response("It is sunny and 72 degrees.")) as stub:
+        pooled = Transport(max_keepalive_connections=max(threads, 20))
+        if mode == "pooled":
+            pooled.prewarm(stub.base_url + "/models", connections=threads)
+        # one untimed turn per thread for the lazy imports and litellm's own client cache
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(lambda _: turn(stub.base_url, mode, pooled), range(threads)))
+            samples = list(pool.map(lambda _: turn(stub.base_url, mode, pooled), range(turns)))
+        pooled.close()
+        return {
+            "mode": mode,
+            "threads": threads,
+            "turns": turns,
+            "p50_ms": percentile(samples, 50) * 1e3,
+            "p99_ms": percentile(samples, 99) * 1e3,
+            "connections": len(stub.connections),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--quick", action="store_true", help="fewer turns, for a smoke run")
+    args = parser.parse_args(argv)
+    turns = 20 if args.quick else 200
+    results = [bench(mode, turns, threads) for threads in (1, 8) for mode in MODES]
+    print(f"{'mode':>10} {'threads':>8} {'turns':>6} {'p50 ms':>8} {'p99 ms':>8} {'connections':>12}")
+    for result in results:
+        print(
+            f"{result['mode']:>10} {result['threads']:>8} {result['turns']:>6} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['connections']:>12}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""
+Fake streaming completion backend for benchmarking the chat loop offline.
+
+Streams are built up front from plain objects shaped like litellm's streaming chunks, so timing a
+chat turn measures aiide's own per-chunk work rather than the network, the provider or litellm.
+
+    with FakeBackend(lambda request: text_stream("Hello there", chunk_size=4)):
+        list(agent.chat("Hi"))
+"""
+import json
+from types import SimpleNamespace
+
+import aiide._aiide
+
+
+def chunk(content=None, tool_call=None, finish_reason=None):
+    delta = SimpleNamespace(content=content, tool_calls=[tool_call] if tool_call is not None else None)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=finish_reason)], usage=None)
+
+
+def usage_chunk(prompt_tokens, completion_tokens):
+    return SimpleNamespace(choices=[], usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens))
+
+
+def text_stream(text, chunk_size=4, finish_reason="stop"):
+    """
+    Chunks streaming `text` in pieces of `chunk_size` characters, followed by the finish reason and usage.
+    """
+    chunks = [chunk(text[i : i + chunk_size]) for i in range(0, len(text), chunk_size)]
+    return chunks + [chunk(finish_reason=finish_reason), usage_chunk(10, len(chunks))]
+
+
+def tool_stream(calls, chunk_size=4):
+    """
+    Chunks calling tools, `calls` is a list of (name, arguments dict) tuples.
+    """
+    chunks = []
+    for index, (name, arguments) in enumerate(calls):
+        chunks.append(chunk(tool_call=SimpleNamespace(id=f"call_{index}", function=SimpleNamespace(name=name, arguments=""))))
+        arguments = json.dumps(arguments)
+        for i in range(0, len(arguments), chunk_size):
+            chunks.append(chunk(tool_call=SimpleNamespace(id=None, function=SimpleNamespace(name=None, arguments=arguments[i : i + chunk_size]))))
+    return chunks + [chunk(finish_reason="tool_calls"), usage_chunk(10, len(chunks))]
+
+
+def structured_stream(document, chunk_size=4):
+    """
+    Chunks streaming a structured output, `document` is serialized to JSON.
+    """
+    return text_stream(json.dumps(document), chunk_size)
+
+
+class FakeBackend:
+    """
+    Replaces the completion calls of aiide while used as a context manager.
+
+    `responses` is a list of streams (see `text_stream`, `tool_stream` and `structured_stream`) served in
+    order, or a callable taking the request and returning one. Requests are kept in `requests`.
+    """
+
+    def __init__(self, responses, keep_requests=False):
+        self._responses = responses if callable(responses) else list(responses)
+        self._keep_requests = keep_requests
+        self.requests = []
+        self._patched = None
+
+    def _next(self, request):
+        if self._keep_requests:
+            self.requests.append(request)
+        if callable(self._responses):
+            return self._responses(request)
+        return self._responses.pop(0)
+
+    def completion(self, **request):
+        return iter(self._next(request))
+
+    async def acompletion(self, **request):
+        chunks = self._next(request)
+
+        async def stream():
+            for each in chunks:
+                yield each
+
+        return stream()
+
+    def __enter__(self):
+        self._patched = (aiide._aiide.litellm_completion, aiide._aiide.litellm_acompletion)
+        aiide._aiide.litellm_completion = self.completion
+        aiide._aiide.litellm_acompletion = self.acompletion
+        return self
+
+    def __exit__(self, *exc):
+        aiide._aiide.litellm_completion, aiide._aiide.litellm_acompletion = self._patched
@@ -0,0 +1,179 @@
+import json
+import select
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def text_response(text, chunk_size=4):
+    """
+    Scripted response streaming `text` in chunks of `chunk_size` characters.
+    """
+    deltas = [{"role": "assistant", "content": text[i : i + chunk_size]} for i in range(0, len(text), chunk_size)]
+    return deltas, "stop"
+
+
+def tool_calls_response(calls, chunk_size=8):
+    """
+    Scripted response calling tools, `calls` is a list of (name, arguments dict) tuples.
+    """
+    deltas = []
+    for index, (name, arguments) in enumerate(calls):
+        deltas.append(
+            {
+                "role": "assistant",
+                "tool_calls": [
+                    {"index": index, "id": f"call_{index}", "type": "function", "function": {"name": name, "arguments": ""}}
+                ],
+            }
+        )
+        arguments = json.dumps(arguments)
+        for i in range(0, len(arguments), chunk_size):
+            deltas.append({"tool_calls": [{"index": index, "function": {"arguments": arguments[i : i + chunk_size]}}]})
+    return deltas, "tool_calls"
+
+
+def paused(response, seconds, after=0):
+    """
+    Scripted response stalling for `seconds` before its chunk number `after`, e.g. before the first one.
+    """
+    deltas, finish_reason = response
+    return deltas, finish_reason, (after, seconds)
+
+
+class _Server(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # clients hang up on stalled responses they have given up on
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class OpenAIStub:
+    """
+    Local OpenAI compatible chat completions server streaming scripted responses.
+
+    `responses` is a list of scripted responses (see `text_response`, `tool_calls_response` and `paused`)
+    served in order, or a callable taking the request body and returning one. A response can also be an HTTP
+    error status code, e.g. 429, which is answered with an OpenAI style error. Requests are kept in
+    `requests` and their Authorization headers in `authorizations`, the client address of every connection
+    in `connections` and of those closed by the client while a response was streaming in `hangups`.
+    `chunk_delay` seconds are waited before each chunk is sent, and `usage` is added to the usage
+    reported in the last chunk, e.g. the cached prompt tokens.
+
+        with OpenAIStub([text_response("Hello")]) as stub:
+            agent.setup(model="openai/gpt-4o-mini", api_base=stub.base_url, api_key="sk-test")
+    """
+
+    def __init__(self, responses, chunk_delay=0, usage=None):
+        self.requests = []
+        self.authorizations = []
+        self.chunk_delay = chunk_delay
+        self.usage = usage or {}
+        # client (host, port) pairs seen, one per connection
+        self.connections = set()
+        self.hangups = set()
+        self._responses = responses if callable(responses) else list(responses)
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # chunks are small writes, sent right away rather than held back waiting for an ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                # the model list, also used to open connections ahead of the first completion
+                stub.connections.add(self.client_address)
+                body = json.dumps({"object": "list", "data": [{"id": "gpt-4o-mini", "object": "model"}]}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                stub.connections.add(self.client_address)
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                stub.authorizations.append(self.headers.get("Authorization"))
+                response = stub._next_response(body)
+                if isinstance(response, int):
+                    error = json.dumps({"error": {"message": f"Stub error {response}", "type": "stub_error", "code": response}}).encode()
+                    self.send_response(response)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(error)))
+                    self.end_headers()
+                    self.wfile.write(error)
+                    return
+                deltas, finish_reason, *pause = response
+                pause_after, pause_seconds = pause[0] if pause else (None, 0)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for index, delta in enumerate(deltas):
+                    if not self._wait(pause_seconds if index == pause_after else stub.chunk_delay):
+                        stub.hangups.add(self.client_address)
+                        self.close_connection = True
+                        return
+                    self._send(stub._chunk(body, [{"index": 0, "delta": delta, "finish_reason": None}]))
+                self._send(stub._chunk(body, [{"index": 0, "delta": {}, "finish_reason": finish_reason}]))
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    usage = {"prompt_tokens": 10, "completion_tokens": len(deltas), "total_tokens": 10 + len(deltas), **stub.usage}
+                    self._send(stub._chunk(body, [], usage))
+                self._write(b"data: [DONE]\n\n")
+                self._write(b"")
+
+            def _wait(self, seconds):
+                # sleeps, returns False as soon as the client hangs up
+                if not seconds:
+                    return True
+                if select.select([self.connection], [], [], seconds)[0]:
+                    try:
+                        return bool(self.connection.recv(1, socket.MSG_PEEK))
+                    except ConnectionError:
+                        return False
+                return True
+
+            def _send(self, chunk):
+                self._write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+            def _write(self, data):
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+        self._server = _Server(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def _next_response(self, body):
+        with self._lock:
+            self.requests.append(body)
+            if callable(self._responses):
+                return self._responses(body)
+            return self._responses.pop(0)
+
+    @staticmethod
+    def _chunk(body, choices, usage=None):
+        chunk = {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": body.get("model", "gpt-4o-mini"),
+            "choices": choices,
+        }
+        if usage is not None:
+            chunk["usage"] = usage
+        return chunk
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,692 @@
+import asyncio
+import json
+import threading
+import time
+from aiide import Aiide, Tool
+from aiide.schema import tool_def_gen, Str
+from .openai_stub import OpenAIStub, paused, text_response, tool_calls_response
+
+
+class WeatherTool(Tool):
+    def __init__(self, parent):
+        self.calls = []
+
+    def tool_def(self):
+        return tool_def_gen(
+            name="get_current_weather",
+            description="Get the current weather in a given location",
+            properties=[Str(name="location")],
+        )
+
+    def main(self, location):
+        self.calls.append(location)
+        return json.dumps({"location": location, "temperature": 72})
+
+
+class SlowWeatherTool(WeatherTool):
+    # SF only answers once Tokyo has, so it can only complete when both calls run at the same time
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.tokyo_done = threading.Event()
+
+    def main(self, location):
+        if location == "SF":
+            assert self.tokyo_done.wait(5)
+            time.sleep(0.05)
+        response = super().main(location)
+        if location == "Tokyo":
+            self.tokyo_done.set()
+        return response
+
+
+class AsyncWeatherTool(WeatherTool):
+    # like SlowWeatherTool, with SF waiting on Tokyo in the event loop
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.tokyo_done = asyncio.Event()
+
+    async def main(self, location):
+        if location == "SF":
+            await asyncio.wait_for(self.tokyo_done.wait(), 5)
+            await asyncio.sleep(0.05)
+        response = super().main(location)
+        if location == "Tokyo":
+            self.tokyo_done.set()
+        return response
+
+
+class Agent(Aiide):
+    def __init__(self, stub, model="openai/gpt-4o-mini", **kwargs):
+        self.weatherTool = WeatherTool(self)
+        self.setup(
+            system_message="You are a helpful assistant.",
+            model=model,
+            api_key="sk-test",
+            api_base=stub.base_url,
+            **kwargs,
+        )
+
+
+def warm_up():
+    # litellm's first sync and async calls take a while, for tests timing the calls
+    with OpenAIStub([text_response("Sunny.")] * 2) as stub:
+        list(Agent(stub).chat("Weather?"))
+        asyncio.run(Agent(stub).achat("Weather?").__anext__())
+
+
+def weather_script():
+    return [
+        tool_calls_response([("get_current_weather", {"location": "SF"}), ("get_current_weather", {"location": "Tokyo"})]),
+        text_response("It is 72 degrees in both cities."),
+    ]
+
+
+def test_chat():
+    with OpenAIStub(weather_script()) as stub:
+        agent = Agent(stub)
+        deltas = list(agent.chat("What's the weather like in SF and Tokyo?", tools=[agent.weatherTool]))
+    assert [delta["type"] for delta in deltas[:4]] == ["tool_call", "tool_response", "tool_call", "tool_response"]
+    assert deltas[-1]["content"] == "It is 72 degrees in both cities."
+    assert agent.weatherTool.calls == ["SF", "Tokyo"]
+    assert agent.messages["role"].tolist() == ["system", "user", "tool", "tool", "assistant"]
+    assert [message["role"] for message in stub.requests[1]["messages"]] == ["system", "user", "assistant", "tool", "tool"]
+
+
+def test_achat():
+    async def run():
+        with OpenAIStub(weather_script()) as stub:
+            agent = Agent(stub)
+            return agent, [delta async for delta in agent.achat("What's the weather like in SF and Tokyo?", tools=[agent.weatherTool])]
+
+    agent, deltas = asyncio.run(run())
+    assert [delta["type"] for delta in deltas[:4]] == ["tool_call", "tool_response", "tool_call", "tool_response"]
+    assert deltas[-1]["content"] == "It is 72 degrees in both cities."
+    assert agent.messages["content"].tolist()[-1] == "It is 72 degrees in both cities."
+    assert agent.usage["completion_tokens"] > 0
+
+
+def test_achat_sync_tools_leave_the_loop_running():
+    class BlockingWeatherTool(WeatherTool):
+        # only answers once a task on the event loop has run, which can't happen if the tool blocks the loop
+        def __init__(self, parent):
+            super().__init__(parent)
+            self.loop_ran = threading.Event()
+
+        def main(self, location):
+            self.loop_ran.clear()
+            assert self.loop_ran.wait(2)
+            return super().main(location)
+
+    async def run():
+        with OpenAIStub(weather_script() * 2) as stub:
+            for eager_tools in (False, True):
+                agent = Agent(stub, eager_tools=eager_tools)
+                agent.weatherTool = BlockingWeatherTool(agent)
+                ticking = True
+
+                async def tick():
+                    while ticking:
+                        agent.weatherTool.loop_ran.set()
+                        await asyncio.sleep(0.01)
+
+                ticker = asyncio.ensure_future(tick())
+                deltas = [delta async for delta in agent.achat("What's the weather like in SF and Tokyo?", tools=[agent.weatherTool])]
+                ticking = False
+                await ticker
+                assert deltas[-1]["content"] == "It is 72 degrees in both cities."
+                assert agent.weatherTool.calls == ["SF", "Tokyo"]
+
+    asyncio.run(run())
+
+
+def test_achat_concurrent_sessions():
+    async def run():
+        with OpenAIStub(lambda body: text_response(f"Echo: {body['messages'][-1]['content']}")) as stub:
+            agents = [Agent(stub) for _ in range(20)]
+
+            async def converse(index, agent):
+                return [delta async for delta in agent.achat(f"message {index}")][-1]["content"]
+
+            return await asyncio.gather(*(converse(index, agent) for index, agent in enumerate(agents)))
+
+    assert asyncio.run(run()) == [f"Echo: message {index}" for index in range(20)]
+
+
+def test_concurrent_tool_calls():
+    with OpenAIStub(weather_script() + weather_script()) as stub:
+        agent = Agent(stub, tool_concurrency=4)
+        agent.weatherTool = SlowWeatherTool(agent)
+        deltas = list(agent.chat("What's the weather like in SF and Tokyo?", tools=[agent.weatherTool]))
+        # tool responses are yielded as they complete but stored in the order of the tool calls
+        assert [(delta["type"], json.loads(delta["arguments"])["location"]) for delta in deltas[:4]] == [
+            ("tool_call", "SF"),
+            ("tool_call", "Tokyo"),
+            ("tool_response", "Tokyo"),
+            ("tool_response", "SF"),
+        ]
+        assert [json.loads(response)["location"] for response in agent.messages["response"].tolist()[2:4]] == ["SF", "Tokyo"]
+
+        async def run():
+            agent.weatherTool = SlowWeatherTool(agent)
+            return [delta async for delta in agent.achat("And now?", tools=[agent.weatherTool])]
+
+        deltas = asyncio.run(run())
+        assert [delta["type"] for delta in deltas[:4]] == ["tool_call", "tool_call", "tool_response", "tool_response"]
+        assert json.loads(deltas[2]["response"])["location"] == "Tokyo"
+    assert [message["role"] for message in stub.requests[1]["messages"]] == ["system", "user", "assistant", "tool", "tool"]
+
+
+def test_async_tools():
+    assert AsyncWeatherTool._async_main and not WeatherTool._async_main
+    with OpenAIStub(weather_script() * 3) as stub:
+        agent = Agent(stub, tool_concurrency=2)
+        agent.weatherTool = AsyncWeatherTool(agent)
+        deltas = list(agent.chat("What's the weather like in SF and Tokyo?", tools=[agent.weatherTool]))
+        assert [json.loads(delta["response"])["location"] for delta in deltas if delta["type"] == "tool_response"] == ["Tokyo", "SF"]
+
+        async def run():
+            agent.weatherTool = AsyncWeatherTool(agent)
+            return [delta async for delta in agent.achat("And now?", tools=[agent.weatherTool])]
+
+        deltas = asyncio.run(run())
+        assert [json.loads(delta["response"])["location"] for delta in deltas if delta["type"] == "tool_response"] == ["Tokyo", "SF"]
+        # one call at a time the async tool is awaited in order, errors are reported back to the model as usual
+        agent = Agent(stub)
+        agent.weatherTool = AsyncWeatherTool(agent)
+        agent.weatherTool.tokyo_done.set()
+        deltas = list(agent.chat("And now?", tools=[agent.weatherTool]))
+        assert [delta["type"] for delta in deltas[:4]] == ["tool_call", "tool_response", "tool_call", "tool_response"]
+        assert agent.weatherTool.calls == ["SF", "Tokyo"]
+
+
+def test_tool_definitions_are_cached():
+    class CountingWeatherTool(WeatherTool):
+        def __init__(self, parent):
+            super().__init__(parent)
+            self.tool_def_calls = 0
+
+        def tool_def(self):
+            self.tool_def_calls += 1
+            return super().tool_def()
+
+    with OpenAIStub(weather_script() * 3) as stub:
+        agent = Agent(stub)
+        agent.weatherTool = CountingWeatherTool(agent)
+        list(agent.chat("What's the weather like in SF and Tokyo?", tools=[agent.weatherTool]))
+        list(agent.chat("And now?", tools=[agent.weatherTool]))
+        assert agent.weatherTool.tool_def_calls == 1
+        agent.weatherTool.invalidate()
+        agent.weatherTool.dynamic = True
+        list(agent.chat("And now?", tools=[agent.weatherTool]))
+        # once for the name mapping and once per LLM call
+        assert agent.weatherTool.tool_def_calls == 4
+    assert stub.requests[-1]["tools"] == stub.requests[0]["tools"]
+
+
+
+def test_eager_tool_dispatch():
+    class TimedWeatherTool(WeatherTool):
+        def main(self, location):
+            self.started = getattr(self, "started", {})
+            self.started[location] = time.monotonic()
+            return super().main(location)
+
+    def check(agent, timed_deltas):
+        # the SF call starts while the Tokyo call is still streaming, responses stay in call order
+        assert agent.weatherTool.started["SF"] < next(at for delta, at in timed_deltas if delta["type"] == "tool_call")
+        deltas = [delta for delta, _ in timed_deltas]
+        assert [delta["type"] for delta in deltas[:4]] == ["tool_call", "tool_response", "tool_call", "tool_response"]
+        assert [json.loads(delta["response"])["location"] for delta in deltas if delta["type"] == "tool_response"] == ["SF", "Tokyo"]
+
+    with OpenAIStub(weather_script() * 2, chunk_delay=0.01) as stub:
+        agent = Agent(stub, eager_tools=True)
+        agent.weatherTool = TimedWeatherTool(agent)
+        check(agent, [(delta, time.monotonic()) for delta in agent.chat("What's the weather like in SF and Tokyo?", tools=[agent.weatherTool])])
+
+        async def run():
+            agent.weatherTool = TimedWeatherTool(agent)
+            return [(delta, time.monotonic()) async for delta in agent.achat("And now?", tools=[agent.weatherTool])]
+
+        check(agent, asyncio.run(run()))
+
+
+def test_usage_ledger():
+    with OpenAIStub(weather_script() * 2) as stub:
+        agent = Agent(stub)
+        list(agent.chat("What's the weather like in SF and Tokyo?", tools=[agent.weatherTool]))
+        # one entry per LLM call, with the usage streamed by the provider
+        calls = agent.usage_ledger.calls
+        assert [(call["prompt_tokens"], call["estimated"]) for call in calls] == [(10, False), (10, False)]
+        assert agent.usage["prompt_tokens"] == 20
+        assert agent.usage["completion_tokens"] == sum(call["completion_tokens"] for call in calls)
+        assert agent.usage["usd"] == sum(call["usd"] for call in calls) > 0
+        assert stub.requests[0]["stream_options"] == {"include_usage": True}
+        # without streamed usage the tokens are counted with the tokenizer
+        agent = Agent(stub, stream_options={"include_usage": False})
+        list(agent.chat("What's the weather like in SF and Tokyo?", tools=[agent.weatherTool]))
+        assert all(call["estimated"] and call["prompt_tokens"] > 0 and call["completion_tokens"] > 0 for call in agent.usage_ledger.calls)
+
+
+def test_context_window():
+    def history():
+        for turn in range(20):
+            yield {"role": "user", "content": f"What's the weather like in city {turn}? " * 5}
+            yield {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {
+                        "id": f"call_{turn}",
+                        "tool": "get_current_weather",
+                        "arguments": json.dumps({"location": f"city {turn}"}),
+                        "response": json.dumps({"location": f"city {turn}", "temperature": 72}),
+                    }
+                ],
+            }
+            yield {"role": "assistant", "content": f"It is 72 degrees in city {turn}. " * 5}
+
+    from litellm import token_counter
+
+    with OpenAIStub([text_response("It is 72 degrees.")] * 4) as stub:
+        for max_prompt_tokens in (300, 330, 360, 390):
+            agent = Agent(
+                stub,
+                history_openai_format=list(history()),
+                context_window={"max_prompt_tokens": max_prompt_tokens, "completion_reserve": 50},
+            )
+            list(agent.chat("And in Tokyo?"))
+            sent = stub.requests[-1]["messages"]
+            # the system message and the latest messages within the budget, the history itself is kept
+            assert [message["role"] for message in sent].count("system") == 1 and sent[-1]["content"] == "And in Tokyo?"
+            assert 2 < len(sent) < 62 and len(agent.messages) == 63
+            assert sum(token_counter(model="gpt-4o-mini", messages=[message]) for message in sent) <= max_prompt_tokens - 50
+            # tool responses are sent with the tool call they answer
+            for index, message in enumerate(sent):
+                if message["role"] == "tool":
+                    assert sent[index - 1]["tool_calls"][0]["id"] == message["tool_call_id"]
+    try:
+        Agent(stub, context_window={"max_prompt_tokens": 100, "completion_reserve": 100})
+    except ValueError:
+        pass
+    else:
+        assert False, "expected a ValueError"
+
+
+def test_prompt_cache():
+    class ForecastTool(WeatherTool):
+        def tool_def(self):
+            return tool_def_gen(name="get_forecast", description="Get the forecast for a given location", properties=[Str(name="location")])
+
+    usage = {"prompt_tokens_details": {"cached_tokens": 8}, "cache_creation_input_tokens": 2}
+    with OpenAIStub([text_response("Sunny."), text_response("Still sunny.")] * 2, usage=usage) as stub:
+        agent = Agent(stub, prompt_cache="cache_control")
+        tools = [ForecastTool(agent), agent.weatherTool]
+        list(agent.chat("What's the weather like?", tools=tools))
+        list(agent.chat("And tomorrow?", tools=tools[::-1]))
+        first, second = stub.requests
+        # tools ordered by name with a breakpoint after the last one, whatever order they are passed in
+        assert [tool["function"]["name"] for tool in second["tools"]] == ["get_current_weather", "get_forecast"]
+        assert [tool.get("cache_control") for tool in second["tools"]] == [None, {"type": "ephemeral"}]
+        # breakpoints on the system message and the last message, the prefix is byte-identical
+        assert second["messages"][0]["content"] == [{"type": "text", "text": "You are a helpful assistant.", "cache_control": {"type": "ephemeral"}}]
+        assert second["messages"][-1]["content"][-1] == {"type": "text", "text": "And tomorrow?", "cache_control": {"type": "ephemeral"}}
+        assert json.dumps([first["tools"], first["messages"][0]]) == json.dumps([second["tools"], second["messages"][0]])
+        assert [(message["role"], message["content"]) for message in second["messages"][1:3]] == [("user", "What's the weather like?"), ("assistant", "Sunny.")]
+        assert "cache_control" not in json.dumps(agent._store.to_openai_dict())
+        assert agent.usage["cache_read_tokens"] == 16 and agent.usage["cache_write_tokens"] == 4
+        assert agent.usage_ledger.calls[0]["cache_read_tokens"] == 8
+        # OpenAI models cache the prefix on their own, only the order is kept stable
+        agent = Agent(stub, prompt_cache=True)
+        list(agent.chat("What's the weather like?", tools=tools[::-1]))
+        assert "cache_control" not in json.dumps(stub.requests[-1])
+        assert [tool["function"]["name"] for tool in stub.requests[-1]["tools"]] == ["get_current_weather", "get_forecast"]
+
+
+def test_completion_cache(tmp_path):
+    from aiide import CompletionCache
+
+    path = tmp_path / "completions.sqlite"
+    with OpenAIStub(weather_script()) as stub:
+        agent = Agent(stub, completion_cache=str(path))
+        recorded = list(agent.chat("What's the weather like in SF and Tokyo?", tools=[agent.weatherTool]))
+    assert len(CompletionCache(path)) == 2
+    assert not any(call["cached"] for call in agent.usage_ledger.calls)
+    # replayed through the streaming path, tool calls included, without calling the LLM
+    with OpenAIStub([]) as stub:
+        replayed_agent = Agent(stub, completion_cache=CompletionCache(path, read_only=True))
+        replayed = list(replayed_agent.chat("What's the weather like in SF and Tokyo?", tools=[replayed_agent.weatherTool]))
+
+        async def run():
+            async_agent = Agent(stub, completion_cache=str(path))
+            return async_agent, [delta async for delta in async_agent.achat("What's the weather like in SF and Tokyo?", tools=[async_agent.weatherTool])]
+
+        async_agent, async_replayed = asyncio.run(run())
+        assert stub.requests == []
+    assert replayed == recorded == async_replayed
+    assert replayed_agent.weatherTool.calls == ["SF", "Tokyo"]
+    assert replayed_agent._store.to_openai_dict() == agent._store.to_openai_dict() == async_agent._store.to_openai_dict()
+    # replays cost nothing, the ledger keeps the usage of the original calls
+    assert [(call["cached"], call["prompt_tokens"], call["usd"]) for call in replayed_agent.usage_ledger.calls] == [(True, 10, 0.0)] * 2
+    assert replayed_agent.usage["prompt_tokens"] == 0 and replayed_agent.usage["usd"] == 0
+    # misses are not stored in read-only mode, and the least recently used completions are evicted
+    with OpenAIStub([text_response("Sunny.")] * 2) as stub:
+        list(Agent(stub, completion_cache=CompletionCache(path, read_only=True)).chat("And tomorrow?"))
+        assert len(CompletionCache(path)) == 2
+        list(Agent(stub, completion_cache=CompletionCache(path, max_bytes=1)).chat("And tomorrow?"))
+        assert len(CompletionCache(path)) == 1
+
+    # achat looks up and stores completions on worker threads, SQLite doesn't block the event loop
+    class ThreadRecordingCache(CompletionCache):
+        threads = []
+
+        def get(self, key):
+            self.threads.append(threading.get_ident())
+            return super().get(key)
+
+        def put(self, key, records):
+            self.threads.append(threading.get_ident())
+            super().put(key, records)
+
+    async def run():
+        cache = ThreadRecordingCache(tmp_path / "async.sqlite")
+        for _ in range(2):
+            cached_agent = Agent(stub, completion_cache=cache)
+            assert [delta async for delta in cached_agent.achat("And next week?")][-1]["content"] == "Sunny."
+        return threading.get_ident()
+
+    with OpenAIStub([text_response("Sunny.")]) as stub:
+        loop_thread = asyncio.run(run())
+        assert len(stub.requests) == 1
+    assert len(ThreadRecordingCache.threads) == 3 and loop_thread not in ThreadRecordingCache.threads
+
+
+def test_batch(tmp_path):
+    failures = {"flaky": [429], "broken": [400]}
+
+    def respond(body):
+        question = body["messages"][-1]["content"]
+        if failures.get(question):
+            return failures[question].pop(0)
+        if question == "weather" and body["messages"][-1]["role"] == "user":
+            return tool_calls_response([("get_current_weather", {"location": "SF"})])
+        return text_response(f"Answer to {question} after {len(body['messages'])} messages")
+
+    inputs = ["one", "flaky", "broken", {"id": "w", "user_message": "weather"}, {"id": "h", "history": [{"role": "user", "content": "two"}]}]
+    results_path = tmp_path / "results.jsonl"
+    with OpenAIStub(respond) as stub:
+        agent = Agent(stub, max_retries=0)
+        results = {result["id"]: result for result in agent.batch(inputs, tools=[agent.weatherTool], concurrency=3, retry_backoff=0, results_path=results_path)}
+        assert set(results) == {0, 1, 2, "w", "h"}
+        # every input runs on its own copy of the messages
+        assert results[0]["content"] == "Answer to one after 2 messages"
+        assert results["h"]["content"] == "Answer to two after 2 messages"
+        assert results["w"]["content"].endswith("after 4 messages")
+        assert [message["role"] for message in results["w"]["messages"]] == ["system", "user", "assistant", "tool", "assistant"]
+        assert len(agent._store) == 1 and agent.weatherTool.calls == ["SF"]
+        # transient errors are retried, others are reported
+        assert (results[1]["ok"], results[1]["attempts"]) == (True, 2)
+        assert (results[2]["ok"], results[2]["attempts"], results[2]["content"]) == (False, 1, None) and "BadRequestError" in results[2]["error"]
+        # per input usage, adding up to the agent's usage
+        assert results["w"]["usage"]["prompt_tokens"] == 20 and len(results["w"]["calls"]) == 2
+        assert agent.usage["prompt_tokens"] == sum(result["usage"]["prompt_tokens"] for result in results.values()) == 50
+        # resuming only runs the inputs without a successful result
+        requests = len(stub.requests)
+        resumed = list(agent.batch(inputs, tools=[agent.weatherTool], retry_backoff=0, results_path=results_path))
+        assert [(result["id"], result["ok"]) for result in resumed] == [(2, True)]
+        assert len(stub.requests) == requests + 1
+    lines = [json.loads(line) for line in results_path.read_text().splitlines()]
+    assert len(lines) == 6 and lines[-1]["id"] == 2
+    # every input counts its tokens in its own context window, the agent's isn't shared between threads
+    with OpenAIStub(respond) as stub:
+        agent = Agent(stub, context_window={"max_prompt_tokens": 1000})
+        results = list(agent.batch([f"question {index}" for index in range(8)], concurrency=4))
+        assert all(result["ok"] for result in results) and agent._context_window._counts == {}
+
+
+def test_transport():
+    from aiide import Transport
+
+    transport = Transport(max_connections=4)
+    with OpenAIStub([text_response("Sunny.")] * 6) as stub:
+        transport.prewarm(stub.base_url + "/models")
+        # turns and agents share the pooled connection opened ahead of them
+        agents = [Agent(stub, transport=transport) for _ in range(2)]
+        for agent in agents:
+            for question in ("Weather?", "And tomorrow?"):
+                assert list(agent.chat(question))[-1]["content"] == "Sunny."
+        assert len(stub.connections) == 1
+
+        async def run():
+            return [delta async for delta in agents[0].achat("And next week?")][-1]["content"]
+
+        assert asyncio.run(run()) == "Sunny."
+        assert len(stub.connections) == 2
+        # without a transport litellm's own clients are used
+        list(Agent(stub).chat("Weather?"))
+        assert len(stub.requests) == 6
+    transport.close()
+    assert Agent(stub, transport=True)._transport is Agent(stub, transport=True)._transport
+    try:
+        Agent(stub, transport="pooled")
+        assert False
+    except ValueError:
+        pass
+
+
+def test_rate_limiter_order():
+    from aiide import RateLimiter
+
+    # the clock is stopped, a request is only let through when the one before it hands its tokens back
+    limiter = RateLimiter(tpm=600, burst_seconds=60, clock=lambda: 0.0)
+    request = {"model": "m", "messages": [{"role": "user", "content": "Weather?"}], "max_tokens": 400}
+    held = limiter.acquire(request, session="held")
+    order = []
+
+    def wait(name, session, priority):
+        grant = limiter.acquire(request, session=session, priority=priority)
+        order.append(name)
+        grant.settle(0)
+
+    waiters = [("a1", "a", "batch"), ("a2", "a", "batch"), ("b1", "b", "interactive"), ("b2", "b", "interactive"), ("c1", "c", "interactive"), ("d1", "d", "batch")]
+    threads = []
+    for queued, waiter in enumerate(waiters, 1):
+        threads.append(threading.Thread(target=wait, args=waiter))
+        threads[-1].start()
+        while limiter.stats()["m"]["queued"] < queued:
+            time.sleep(0.001)
+    assert limiter.stats()["m"]["queued_by_priority"] == {"interactive": 3, "batch": 3}
+    assert limiter.stats()["m"]["waiting_sessions"] == 4
+    held.settle(0)
+    for thread in threads:
+        thread.join()
+    # interactive before batch, sessions taking turns within a class
+    assert order == ["b1", "c1", "b2", "a1", "d1", "a2"]
+    stats = limiter.stats()["m"]
+    assert (stats["queued"], stats["in_flight"], stats["granted"]) == (0, 0, 7)
+
+
+def test_rate_limiter():
+    from aiide import RateLimiter
+
+    # the backend enforces 600 requests per minute as a token bucket holding one second of quota
+    quota = {}
+    statuses = []
+    lock = threading.Lock()
+
+    def respond(body):
+        with lock:
+            now = time.monotonic()
+            quota["level"] = min(10.0, quota.get("level", 10.0) + (now - quota.get("updated", now)) * 10)
+            quota["updated"] = now
+            # slack for the time between a request being let through and its arrival
+            if quota["level"] < -3:
+                statuses.append(429)
+                return 429
+            quota["level"] -= 1
+            statuses.append(200)
+        return text_response("Sunny.")
+
+    def run(agents):
+        def chat(agent):
+            for _ in range(4):
+                try:
+                    list(agent.chat("Weather?"))
+                except Exception:
+                    pass
+
+        async def achat(agent):
+            for _ in range(4):
+                try:
+                    [delta async for delta in agent.achat("Weather?")]
+                except Exception:
+                    pass
+
+        threads = [threading.Thread(target=chat, args=(agent,)) for agent in agents[:-1]]
+        threads.append(threading.Thread(target=asyncio.run, args=(achat(agents[-1]),)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    # litellm's first calls are slow, spreading out the requests
+    warm_up()
+    limiter = RateLimiter(rpm=600, burst_seconds=1)
+    with OpenAIStub(respond) as stub:
+        # six agents calling on their own go over the quota
+        run([Agent(stub, max_retries=0) for _ in range(6)])
+        assert 429 in statuses
+        time.sleep(1)
+        quota.clear()
+        statuses.clear()
+        run([Agent(stub, rate_limiter=limiter, max_retries=0) for _ in range(6)])
+    assert statuses == [200] * 24
+    stats = limiter.stats()["openai/gpt-4o-mini"]
+    assert (stats["queued"], stats["in_flight"], stats["granted"], stats["rate_limited"]) == (0, 0, 24, 0)
+    assert stats["max_wait_seconds"] > 0.3
+    try:
+        Agent(stub, rate_limiter=limiter, priority="urgent")
+        assert False
+    except ValueError:
+        pass
+
+
+def test_stream_policy():
+    from aiide import RateLimiter
+
+    def texts(deltas):
+        return [delta["delta"] for delta in deltas if delta["type"] == "text"]
+
+    def aborted(stub, hangups):
+        # the attempts given up on are closed right away, not once their stalled chunk arrives
+        deadline = time.monotonic() + 1
+        while time.monotonic() < deadline:
+            if len(stub.hangups) == hangups and not any(thread.name == "aiide-stream" for thread in threading.enumerate()):
+                return True
+            time.sleep(0.01)
+        return False
+
+    warm_up()
+
+    # a call that doesn't stream in time, or fails, is made again
+    with OpenAIStub([paused(text_response("Slow."), 5), 503, text_response("Sunny.")]) as stub:
+        agent = Agent(stub, max_retries=0, stream_policy={"first_chunk_timeout": 0.5, "retry_backoff": 0})
+        start = time.monotonic()
+        assert texts(agent.chat("Weather?")) == ["Sunn", "y."]
+        assert time.monotonic() - start < 3 and len(stub.requests) == 3
+        assert aborted(stub, 1)
+    # a hedged call is made once the first one is late, the first to stream is used
+    with OpenAIStub([paused(text_response("Slow answer."), 5), text_response("Fast answer.")] * 2) as stub:
+        agent = Agent(stub, stream_policy={"hedge_percentile": 95, "hedge_delay": 0.2})
+        start = time.monotonic()
+        assert texts(agent.chat("Weather?")) == ["Fast", " ans", "wer."]
+        assert aborted(stub, 1)
+
+        async def run():
+            return texts([delta async for delta in agent.achat("And tomorrow?")])
+
+        assert asyncio.run(run()) == ["Fast", " ans", "wer."]
+        assert time.monotonic() - start < 3 and len(stub.requests) == 4
+        assert [message["content"] for message in agent._store.to_openai_dict()[-3:]] == ["Fast answer.", "And tomorrow?", "Fast answer."]
+    # once chunks have been yielded a stalled stream isn't made again
+    with OpenAIStub([paused(text_response("It is sunny today."), 5, after=2)]) as stub:
+        limiter = RateLimiter(rpm=600)
+        agent = Agent(stub, stream_policy={"chunk_timeout": 0.3}, rate_limiter=limiter)
+        deltas = []
+        try:
+            for delta in agent.chat("Weather?"):
+                deltas.append(delta)
+            assert False
+        except TimeoutError:
+            pass
+        assert texts(deltas) == ["It i", "s su"] and len(stub.requests) == 1
+        assert aborted(stub, 1) and limiter.stats()["openai/gpt-4o-mini"]["in_flight"] == 0
+    # text held back by the stream_commit policy is kept too
+    with OpenAIStub([paused(text_response("It is sunny today."), 5, after=2)] * 2) as stub:
+        agent = Agent(stub, stream_policy={"chunk_timeout": 0.3}, stream_commit="finish")
+
+        async def achat():
+            return [delta async for delta in agent.achat("Weather?")]
+
+        for chat in (lambda: list(agent.chat("Weather?")), lambda: asyncio.run(achat())):
+            try:
+                chat()
+                assert False
+            except TimeoutError:
+                pass
+            assert agent._store.to_openai_dict()[-1]["content"] == "It is su"
+        assert agent._store.to_openai_dict()[-1]["content"] == "It is su"
+    try:
+        Agent(stub, stream_policy={"hedge": True})
+        assert False
+    except ValueError:
+        pass
+
+
+def test_model_routing():
+    slow = {"gpt-4o-mini": 0.3}
+    failing = set()
+
+    def respond(body):
+        if body["model"] in failing:
+            return 503
+        return paused(text_response(f"Answer from {body['model']}"), slow.get(body["model"], 0))
+
+    warm_up()
+    with OpenAIStub(respond) as stub:
+        agent = Agent(stub, model=["openai/gpt-4o-mini", "openai/gpt-4o"], routing={"explore": 0}, max_retries=0)
+        # every model is tried once, then the calls go to the fastest
+        answers = [list(agent.chat("Weather?"))[-1]["content"] for _ in range(4)]
+        assert answers == ["Answer from gpt-4o-mini"] + ["Answer from gpt-4o"] * 3
+        stats = agent.model_stats()
+        assert stats["openai/gpt-4o-mini"]["first_chunk_seconds"] > stats["openai/gpt-4o"]["first_chunk_seconds"]
+        # a failing model falls back to the next one, until it is out of its cooldown
+        failing.add("gpt-4o")
+
+        async def run():
+            return [delta async for delta in agent.achat("Weather?")][-1]["content"]
+
+        assert asyncio.run(run()) == "Answer from gpt-4o-mini"
+        assert list(agent.chat("Weather?"))[-1]["content"] == "Answer from gpt-4o-mini"
+        assert [body["model"] for body in stub.requests[-4:]] == ["gpt-4o", "gpt-4o-mini", "gpt-4o", "gpt-4o-mini"]
+        assert list(agent.chat("Weather?"))[-1]["content"] == "Answer from gpt-4o-mini"
+        assert stub.requests[-1]["model"] == "gpt-4o-mini" and agent.model_stats()["openai/gpt-4o"]["healthy"] is False
+        # each call is counted and priced for the model that answered it
+        by_model = agent.usage_ledger.by_model()
+        assert {model: usage["calls"] for model, usage in by_model.items()} == {"openai/gpt-4o-mini": 4, "openai/gpt-4o": 3}
+        assert by_model["openai/gpt-4o"]["usd"] > by_model["openai/gpt-4o-mini"]["usd"] > 0
+        assert abs(sum(usage["usd"] for usage in by_model.values()) - agent.usage["usd"]) < 1e-12
+    # deployments of one model behind their own endpoints and keys, the agent's key only goes to its own
+    with OpenAIStub(lambda body: text_response("Sunny.")) as east, OpenAIStub(lambda body: text_response("Sunny.")) as west:
+        deployment = {"model": "openai/gpt-4o-mini", "name": "west", "api_base": west.base_url, "api_key": "sk-west"}
+        agent = Agent(east, model=["openai/gpt-4o-mini", deployment], routing={"explore": 0})
+        for _ in range(2):
+            list(agent.chat("Weather?"))
+        assert (east.authorizations, west.authorizations) == (["Bearer sk-test"], ["Bearer sk-west"])
+        assert set(agent.model_stats()) == set(agent.usage_ledger.by_model()) == {"openai/gpt-4o-mini", "west"}
+        assert agent.usage_ledger.calls[-1]["model"] == "openai/gpt-4o-mini" and agent.usage_ledger.calls[-1]["usd"] > 0
+    for model, routing in (("openai/gpt-4o-mini", {"explore": 0}), (["openai/gpt-4o-mini", {"model": "openai/gpt-4o-mini"}], None)):
+        try:
+            Agent(stub, model=model, routing=routing)
+            assert False
+        except ValueError:
+            pass
@@ -0,0 +1,28 @@
+import subprocess
+import sys
+
+HEAVY_MODULES = ("litellm", "openai", "pandas", "PIL", "jiter")
+
+
+def imported_heavy_modules(statement):
+    script = f"import sys\n{statement}\nprint(*[module for module in {HEAVY_MODULES!r} if module in sys.modules])"
+    return subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout.split()
+
+
+def test_import_is_lazy():
+    assert imported_heavy_modules("import aiide.schema") == []
+    # setting up an agent doesn't need them either, they are imported by the first chat or DataFrame access
+    assert imported_heavy_modules(
+        "from aiide import Aiide\n"
+        "class Agent(Aiide):\n"
+        "    def __init__(self):\n"
+        "        self.setup(system_message='You are a helpful assistant.')\n"
+        "Agent()._store.to_openai_dict()"
+    ) == []
+    assert imported_heavy_modules(
+        "from aiide import Aiide\n"
+        "class Agent(Aiide):\n"
+        "    def __init__(self):\n"
+        "        self.setup(system_message='You are a helpful assistant.')\n"
+        "assert Agent().messages.aiide.to_openai_dict() == [{'role': 'system', 'content': 'You are a helpful assistant.'}]"
+    ) == ["pandas"]
@@ -0,0 +1,244 @@
+import json
+import pandas as pd
+from PIL import Image
+from aiide import Aiide
+from aiide._store import MessageStore, StreamingText
+from aiide._utils import ImageCache, OpenAIMessageCache, create_messages_dataframe
+
+
+def make_messages():
+    return pd.DataFrame(
+        {
+            "role": ["system", "user", "assistant", "tool", "tool", "user"],
+            "content": [
+                "You are a helpful assistant.",
+                "What's the weather like in SF and Tokyo?",
+                "Let me check.",
+                {"name": "get_current_weather", "id": "call_1"},
+                {"name": "get_current_weather", "id": "call_2"},
+                "Thanks",
+            ],
+            "arguments": [None, None, None, '{"location": "SF"}', '{"location": "Tokyo"}', None],
+            "response": [None, None, None, '{"temperature": 72}', '{"temperature": 10}', None],
+        }
+    )
+
+
+def test_to_openai_dict():
+    messages = make_messages().aiide.to_openai_dict()
+    assert [message["role"] for message in messages] == ["system", "user", "assistant", "tool", "tool", "user"]
+    assert [tool_call["id"] for tool_call in messages[2]["tool_calls"]] == ["call_1", "call_2"]
+    assert messages[4] == {
+        "role": "tool",
+        "tool_call_id": "call_2",
+        "name": "get_current_weather",
+        "content": '{"temperature": 10}',
+    }
+
+
+def test_tool_row_without_assistant():
+    df = make_messages().drop(index=2)
+    messages = df.aiide.to_openai_dict()
+    assert messages[2] == {
+        "role": "assistant",
+        "content": None,
+        "tool_calls": messages[2]["tool_calls"],
+    }
+    assert len(messages[2]["tool_calls"]) == 2
+
+
+def test_cache_appends_and_edits():
+    df = make_messages()
+    cache = OpenAIMessageCache()
+    first = cache.update(df)
+    # appending only converts the new rows, earlier messages are reused
+    df.loc[len(df)] = {"role": "assistant", "content": "You're welcome", "arguments": None, "response": None}
+    second = cache.update(df)
+    assert second[0] is first[0]
+    assert second[-1]["content"] == "You're welcome"
+    # editing a row rebuilds the suffix, including the tool calls owned by earlier assistant messages
+    df.at[4, "content"] = {"name": "get_current_weather", "id": "call_3"}
+    df.at[4, "arguments"] = '{"location": "Paris"}'
+    assert cache.update(df) == OpenAIMessageCache().update(df)
+    df = df.drop(index=[3, 4]).reset_index(drop=True)
+    assert cache.update(df) == OpenAIMessageCache().update(df)
+    assert cache.update(df)[2]["tool_calls"] is None
+
+
+def test_store_view_is_rebuilt_after_writes():
+    store = MessageStore()
+    store.append("system", "You are a helpful assistant.")
+    view = store.dataframe()
+    assert store.dataframe() is view
+    row = store.append("assistant", "Hello")
+    store.set(row, "content", "Hello there")
+    assert store.dataframe() is not view
+    assert store.dataframe()["content"].tolist() == ["You are a helpful assistant.", "Hello there"]
+    assert store.to_openai_dict()[-1]["content"] == "Hello there"
+
+
+def test_store_syncs_view_edits():
+    store = MessageStore(make_messages().itertuples(index=False))
+    assert len(store.to_openai_dict()) == 6
+    view = store.dataframe()
+    view.at[5, "content"] = "Thank you"
+    view.loc[len(view)] = {"role": "assistant", "content": "You're welcome", "arguments": None, "response": None}
+    assert store.to_openai_dict()[-2:] == [
+        {"role": "user", "content": "Thank you"},
+        {"role": "assistant", "content": "You're welcome", "tool_calls": None},
+    ]
+    # edits made before the next write are kept
+    view.drop(index=[3, 4], inplace=True)
+    store.append("user", "Bye")
+    assert store.dataframe()["role"].tolist() == ["system", "user", "assistant", "user", "assistant", "user"]
+    assert store.to_openai_dict() == OpenAIMessageCache().update(store.dataframe())
+
+
+def test_aiide_messages_setter():
+    class Agent(Aiide):
+        def __init__(self):
+            self.setup(system_message="You are a helpful assistant.")
+
+    agent = Agent()
+    agent.messages = make_messages()
+    assert agent.messages["role"].tolist() == make_messages()["role"].tolist()
+    assert len(agent._store.to_openai_dict()) == 6
+
+
+def test_streaming_text_commit_policies():
+    for policy, commits in [("chunk", ["It ", "It is ", "It is 72"]), ("finish", [None, None, None]), ({"chars": 5}, [None, "It is ", "It is "])]:
+        store = MessageStore()
+        store.append("user", "How warm is it?")
+        streaming_text = StreamingText(store, policy)
+        committed = []
+        for delta in ["It ", "is ", "72"]:
+            streaming_text.write(delta)
+            committed.append(store.row(-1)[1] if streaming_text.row is not None else None)
+        assert committed == commits
+        streaming_text.flush()
+        assert store.row(-1)[:2] == ("assistant", "It is 72")
+        assert streaming_text.text == "It is 72"
+
+
+def test_image_cache():
+    image = Image.new("RGB", (8, 8), "red")
+    cache = ImageCache()
+    data_url = cache.data_url(image)
+    assert data_url.startswith("data:image/jpeg;base64,")
+    assert cache.data_url(image) is data_url
+    assert cache.data_url(image.copy()) is data_url
+    assert (cache.hits, cache.misses) == (2, 1)
+    # history imported in OpenAI format keeps its original data URL
+    messages = create_messages_dataframe(
+        [{"role": "user", "content": [{"type": "image_url", "url": data_url[:-4] + data_url[-4:]}]}]
+    )
+    imported = messages.aiide.to_openai_dict()[0]["content"][0]["image_url"]["url"]
+    assert imported == data_url and imported is not data_url
+
+
+def test_save_and_load_session(tmp_path):
+    image = Image.new("RGB", (16, 16), "red")
+
+    class Agent(Aiide):
+        def __init__(self, **kwargs):
+            self.setup(api_key="sk-test", **kwargs)
+
+    agent = Agent(
+        system_message="You are a helpful assistant.",
+        model="gpt-4o",
+        temperature=0.2,
+        context_window={"max_prompt_tokens": 1000},
+        stream_policy={"chunk_timeout": 10, "hedge_percentile": 95},
+        api_base="http://localhost",
+    )
+    agent.messages = make_messages()
+    agent._store.append("user", [image, "What's in the image?"])
+    agent._store.append("user", {"photo": image, "question": "And now?"})
+    agent.usage_ledger.record("gpt-4o", 100, 10)
+    expected = agent._store.to_openai_dict()
+    for name in ("session.parquet", "session.arrow"):
+        agent.save_session(tmp_path / name)
+        restored = Agent()
+        restored.load_session(tmp_path / name)
+        assert restored._store.to_openai_dict() == expected
+        assert restored.messages.drop(columns="content").equals(agent.messages.drop(columns="content"))
+        assert restored.messages["content"].tolist()[:-2] == agent.messages["content"].tolist()[:-2]
+        # images are restored without being decoded, and sent with their saved bytes
+        restored_image = restored.messages["content"].iloc[-2][0]
+        assert restored_image.size == (16, 16) and restored_image.im is None
+        assert restored.usage == agent.usage and restored.usage_ledger.calls == agent.usage_ledger.calls
+        assert (restored._model, restored._temperature, restored._context_window.max_prompt_tokens) == ("gpt-4o", 0.2, 1000)
+        assert restored._kwargs == {"api_base": "http://localhost"} and restored._api_key == "sk-test"
+        policy = restored._stream_policy
+        assert (policy.chunk_timeout, policy.hedge_percentile, policy.retries) == (10, 95, 2)
+    assert b"sk-test" not in (tmp_path / "session.parquet").read_bytes()
+    # the routing settings are kept with the models
+    deployment = {"model": "azure/gpt-4o", "name": "west", "api_base": "http://west", "api_key": "sk-west"}
+    agent = Agent(model=["gpt-4o", deployment], routing={"alpha": 0.5, "cooldown": 5.0, "explore": 0})
+    agent.save_session(tmp_path / "routed.parquet")
+    assert b"sk-west" not in (tmp_path / "routed.parquet").read_bytes()
+    restored = Agent()
+    restored.load_session(tmp_path / "routed.parquet")
+    router = restored._router
+    assert (router.models, router.alpha, router.error_threshold, router.cooldown, router.explore) == (["gpt-4o", "west"], 0.5, 0.5, 5.0, 0)
+    assert router.routes["west"] == {"model": "azure/gpt-4o", "api_base": "http://west"}
+    # the keys of the entries come from the agent the session is loaded into
+    restored = Agent(model=["gpt-4o", deployment])
+    restored.load_session(tmp_path / "routed.parquet")
+    assert restored._router.routes["west"]["api_key"] == "sk-west" and restored._router.alpha == 0.5
+
+
+def test_history_import_is_lazy(tmp_path):
+    data_url = ImageCache().data_url(Image.new("RGB", (8, 8), "blue"))
+    history = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": [{"type": "text", "text": "What's this?"}, {"type": "image_url", "image_url": {"url": data_url}}]},
+        {"role": "assistant", "content": "A blue square."},
+    ]
+    path = tmp_path / "history.jsonl"
+    path.write_text("".join(json.dumps(message) + "\n" for message in history))
+
+    class Agent(Aiide):
+        def __init__(self, history):
+            self.setup(history_openai_format=history)
+
+    for source in (history, iter(history), str(path)):
+        agent = Agent(source)
+        image = agent.messages["content"].iloc[1][1]
+        # the image isn't decoded to be sent, only when it is used
+        assert agent._store.to_openai_dict()[1]["content"][1]["image_url"]["url"] == data_url
+        assert image._image is None
+        assert image.size == (8, 8) and image.image.getpixel((0, 0))[2] > 200
+
+
+def test_session_manager(tmp_path):
+    from aiide import SessionManager
+
+    class Agent(Aiide):
+        def __init__(self, session_id):
+            self.session_id = session_id
+            self.setup(system_message=f"You are helping {session_id}.")
+
+    manager = SessionManager(Agent, tmp_path, max_bytes=300_000)
+    for session_id in ("a", "b", "c"):
+        agent = manager.get(session_id)
+        agent._store.append("user", [Image.new("RGB", (200, 200), "red"), "What's in the image?"])
+        agent.usage_ledger.record("gpt-4o", 100, 10)
+    # a and b hold an image of 120 KB each, the least recently used one is spilled
+    assert manager.get("a") is not None and list(manager._sessions) == ["c", "a"]
+    assert "b" in manager and (tmp_path / "b.arrow").exists()
+    assert manager.memory_bytes <= 300_000 and manager.stats["spilled"] == 1
+    # rehydrated on access, with its messages and usage
+    with manager.session("b") as agent:
+        assert agent.session_id == "b" and agent.usage["prompt_tokens"] == 100
+        assert agent.messages["content"].tolist()[0] == "You are helping b."
+        assert agent._store.row(-1)[1][0].size == (200, 200)
+        # sessions in use are not spilled
+        manager.get("c")
+        manager.get("a")
+        assert "b" in manager._sessions
+    assert manager.stats["rehydrated"] == 1 and manager.stats["created"] == 3
+    manager.spill_all()
+    assert len(manager) == 0 and manager.memory_bytes == 0
+    manager.drop("a")
+    assert "a" not in manager and "c" in manager
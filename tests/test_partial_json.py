@@ -0,0 +1,34 @@
+import json
+from jiter import from_json
+from aiide._partial_json import PartialJSONParser
+
+
+def test_partial_json_matches_jiter():
+    doc = json.dumps(
+        {
+            "image_description": "A \"quoted\" caption\nwith an escape \\u00e9 and é",
+            "tags": ["#sky", "#sea", 12, -1.5e-3, True, False, None],
+            "nested": {"empty": {}, "list": [[], [1, [2, {"k": "v"}]]]},
+            "refusal": None,
+        }
+    )
+    for chunk_size in (1, 3, 7):
+        parser = PartialJSONParser()
+        for end in range(chunk_size, len(doc) + chunk_size, chunk_size):
+            parser.feed(doc[end - chunk_size : end])
+            assert parser.value() == from_json(doc[:end].encode(), partial_mode=True)
+    assert parser.value() == json.loads(doc)
+
+
+def test_partial_json_shares_completed_subtrees():
+    parser = PartialJSONParser()
+    parser.feed('{"done": {"a": [1, 2]}, "open": [{"b": 1}, "tex')
+    first = parser.value()
+    assert first == {"done": {"a": [1, 2]}, "open": [{"b": 1}]}
+    parser.feed('t", 3')
+    second = parser.value()
+    assert second == {"done": {"a": [1, 2]}, "open": [{"b": 1}, "text", 3]}
+    assert second["done"] is first["done"]
+    assert second["open"][0] is first["open"][0]
+    # values handed out earlier are not mutated by later chunks
+    assert first["open"] == [{"b": 1}]
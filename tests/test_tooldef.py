@@ -30,4 +30,64 @@ def test_weather_tooldef():
                     "required": ["location"],
                 },
             },
-        }
\ No newline at end of file
+        }
+
+def test_compiled_schemas_are_shared():
+    def unit():
+        return Str(name="unit", enums=["celsius", "fahrenheit"])
+
+    forecast = Object(name="forecast", properties=[unit(), Array(name="days", item=Num(name="day"))])
+    # identical sub-schemas compile to the same object, across field trees and tools
+    assert forecast.compile() is Object(name="other", properties=[unit(), Array(name="days", item=Num(name="day"))]).compile()
+    assert Num(name="n", enums=[1]).compile() is not Num(name="n", enums=[True]).compile()
+    # the dicts handed out are copies, changing one doesn't change the others
+    tool = tool_def_gen(name="a", properties=[forecast])
+    tool["function"]["parameters"]["properties"]["forecast"]["properties"]["unit"]["enum"].append("kelvin")
+    forecast.json()["forecast"]["properties"]["days"]["items"]["type"] = "string"
+    assert Object(name="x", properties=[unit()]).json()["x"]["properties"]["unit"] == {"type": "string", "enum": ["celsius", "fahrenheit"]}
+    assert forecast.compile().json() == Object(name="y", properties=[unit(), Array(name="days", item=Num(name="day"))]).json()["y"]
+    # the compiled schema is cached on the field until one of its attributes, or a child's, is set
+    days = forecast.properties[1]
+    compiled = forecast.compile()
+    assert forecast.compile() is compiled
+    days.items = Str(name="day")
+    assert forecast.compile() is not compiled and forecast.json()["forecast"]["properties"]["days"]["items"] == {"type": "string"}
+    # lists can't be changed in place behind the cache, only replaced
+    unit_field = forecast.properties[0]
+    for change in (lambda: unit_field.enums.append("kelvin"), lambda: forecast.properties.append(Num(name="n"))):
+        try:
+            change()
+            assert False
+        except AttributeError:
+            pass
+    unit_field.enums = [*unit_field.enums, "kelvin"]
+    forecast.properties = [*forecast.properties, Num(name="n")]
+    properties = forecast.json()["forecast"]["properties"]
+    assert properties["unit"]["enum"] == ["celsius", "fahrenheit", "kelvin"] and list(properties) == ["unit", "days", "n"]
+    assert forecast.compile().json_bytes.startswith(b'{"type":"object","properties":{"unit":')
+    try:
+        forecast.compile()._json = {}
+        assert False
+    except AttributeError:
+        pass
+
+
+def test_fields_must_compile():
+    from aiide.schema._definitions import _Field
+
+    class Untyped(_Field):
+        def __init__(self, name):
+            self.name = name
+
+    try:
+        Untyped(name="x")
+        assert False
+    except TypeError:
+        pass
+
+
+def test_nullable_leaves_child_unchanged():
+    location = Str(name="location", description="City")
+    assert Nullable(location).json() == {"location": {"type": ["string", "null"], "description": "City"}}
+    assert location.json() == {"location": {"type": "string", "description": "City"}}
+    assert Object(name="place", properties=[Nullable(location)]).json()["place"]["properties"]["location"]["type"] == ["string", "null"]